@@ -6,3 +6,6 @@ GRANT ALL PRIVILEGES ON DATABASE flights TO program;
 
 CREATE DATABASE privileges;
 GRANT ALL PRIVILEGES ON DATABASE privileges TO program;
+
+CREATE DATABASE gateway;
+GRANT ALL PRIVILEGES ON DATABASE gateway TO program;
@@ -0,0 +1,200 @@
+"""Open-loop load generator for the gateway: fixed request rate per scenario, latency percentiles.
+
+    python scripts/bench/load/loadgen.py --duration 30 --rps flights=50,tickets=20,me=20,buy=10,cancel=5 \
+        --json result.json --baseline previous.json
+
+Requests are fired on schedule whether or not earlier ones finished, and latency is measured
+from the scheduled start, so a stalled gateway shows up in the percentiles instead of
+silently lowering the rate. With --baseline the run fails when a scenario's p95 grew by
+more than --max-regression.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import aiohttp
+
+SCENARIOS = ('flights', 'tickets', 'me', 'buy', 'cancel')
+
+
+@dataclass
+class Stats:
+    latencies: list[float] = field(default_factory=list)
+    sent: int = 0
+    errors: int = 0
+    skipped: int = 0
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def summary(self, duration_sec: float) -> dict:
+        return {
+            'sent': self.sent,
+            'ok': len(self.latencies) - self.errors,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'rps': len(self.latencies) / duration_sec,
+            'p50Ms': self.percentile(0.50) * 1000,
+            'p95Ms': self.percentile(0.95) * 1000,
+            'p99Ms': self.percentile(0.99) * 1000,
+            'maxMs': max(self.latencies, default=0.0) * 1000,
+        }
+
+
+class Scenarios:
+    def __init__(self, session: aiohttp.ClientSession, url: str, users: int, flights: int):
+        self.session = session
+        self.url = url.rstrip('/') + '/api/v1'
+        self.users = [f'bench-user-{i}' for i in range(users)]
+        self.flights = [f'AFL{i:03}' for i in range(flights)]
+        self.bought: deque[tuple[str, str]] = deque(maxlen=10000)
+
+    def user(self) -> dict:
+        return {'X-User-Name': random.choice(self.users)}
+
+    async def flights_page(self) -> int:
+        async with self.session.get(f'{self.url}/flights', params={'page': random.randint(1, 10), 'size': 10}) as resp:
+            await resp.read()
+            return resp.status
+
+    async def tickets(self) -> int:
+        async with self.session.get(f'{self.url}/tickets', headers=self.user()) as resp:
+            await resp.read()
+            return resp.status
+
+    async def me(self) -> int:
+        async with self.session.get(f'{self.url}/me', headers=self.user()) as resp:
+            await resp.read()
+            return resp.status
+
+    async def buy(self) -> int:
+        headers = self.user()
+        body = {'flightNumber': random.choice(self.flights), 'price': 1500,
+                'paidFromBalance': random.random() < 0.3}
+        async with self.session.post(f'{self.url}/tickets', headers=headers, json=body) as resp:
+            dat = await resp.json(content_type=None) if resp.status == 200 else None
+            if dat is not None:
+                self.bought.append((headers['X-User-Name'], dat['ticketUid']))
+            return resp.status
+
+    async def cancel(self) -> int:
+        user_name, ticket_uid = self.bought.popleft()
+        async with self.session.delete(f'{self.url}/tickets/{ticket_uid}', headers={'X-User-Name': user_name}) as resp:
+            await resp.read()
+            return resp.status
+
+    def get(self, name: str):
+        return {'flights': self.flights_page, 'tickets': self.tickets, 'me': self.me,
+                'buy': self.buy, 'cancel': self.cancel}[name]
+
+
+async def fire(scenarios: Scenarios, name: str, scheduled_at: float, stats: Stats):
+    if name == 'cancel' and not scenarios.bought:
+        stats.skipped += 1
+        return
+    stats.sent += 1
+    try:
+        status = await scenarios.get(name)()
+        failed = status >= 400
+    except Exception:
+        failed = True
+    stats.latencies.append(time.perf_counter() - scheduled_at)
+    stats.errors += failed
+
+
+async def drive(scenarios: Scenarios, name: str, rps: float, duration_sec: float, stats: Stats):
+    interval = 1 / rps
+    start = time.perf_counter()
+    pending = set()
+    i = 0
+    while True:
+        scheduled_at = start + i * interval
+        if scheduled_at - start >= duration_sec:
+            break
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(fire(scenarios, name, scheduled_at, stats))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        i += 1
+    if pending:
+        await asyncio.wait(pending)
+
+
+def parse_rps(value: str) -> dict[str, float]:
+    ret = {}
+    for part in filter(None, value.split(',')):
+        name, rps = part.split('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name}')
+        ret[name] = float(rps)
+    return ret
+
+
+def print_report(results: dict):
+    print(f'{"scenario":<10}{"sent":>8}{"errors":>8}{"rps":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, r in results.items():
+        print(f'{name:<10}{r["sent"]:>8}{r["errors"]:>8}{r["rps"]:>9.1f}'
+              f'{r["p50Ms"]:>10.1f}{r["p95Ms"]:>10.1f}{r["p99Ms"]:>10.1f}{r["maxMs"]:>10.1f}')
+
+
+def regressions(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    ret = []
+    for name, r in results.items():
+        before = baseline.get(name)
+        if before is None or before['p95Ms'] <= 0:
+            continue
+        growth = r['p95Ms'] / before['p95Ms'] - 1
+        if growth > max_regression:
+            ret.append(f'{name}: p95 {before["p95Ms"]:.1f} ms -> {r["p95Ms"]:.1f} ms (+{growth:.0%})')
+    return ret
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--rps', type=parse_rps, default=parse_rps('flights=50,tickets=20,me=20,buy=10,cancel=5'))
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--flights', type=int, default=100, help='must match the stubs --flights')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds of unrecorded traffic first')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare p95 against')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+        scenarios = Scenarios(session, args.url, args.users, args.flights)
+        if args.warmup > 0:
+            await asyncio.gather(*(drive(scenarios, name, rps, args.warmup, Stats())
+                                   for name, rps in args.rps.items()))
+        stats = {name: Stats() for name in args.rps}
+        await asyncio.gather(*(drive(scenarios, name, rps, args.duration, stats[name])
+                               for name, rps in args.rps.items()))
+
+    results = {name: s.summary(args.duration) for name, s in stats.items()}
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failed = regressions(results, json.load(f), args.max_regression)
+        for line in failed:
+            print(f'REGRESSION {line}')
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+#!/usr/bin/env bash
+
+set -e
+
+# Boots the stub services and the gateway locally, then runs the load generator.
+#   STUB_ARGS="--latency flight=5,ticket=10,bonus=10 --jitter 2" scripts/bench/load/run.sh --duration 30 --json out.json
+# Everything after the script name goes to loadgen.py.
+path=$(cd "$(dirname "$0")" && pwd)
+root=$(cd "$path/../../.." && pwd)
+workdir=$(mktemp -d)
+
+cleanup() {
+  [[ -n "$gateway_pid" ]] && kill "$gateway_pid" 2>/dev/null || true
+  [[ -n "$stubs_pid" ]] && kill "$stubs_pid" 2>/dev/null || true
+  rm -rf "$workdir"
+}
+trap cleanup EXIT
+
+# shellcheck disable=SC2086
+python3 "$path"/stubs.py $STUB_ARGS >"$workdir"/stubs.log 2>&1 &
+stubs_pid=$!
+
+(
+  cd "$root"/src/apigateway
+  FLIGHT_BASEURL='http://127.0.0.1:9060/api/v1' \
+  TICKET_BASEURL='http://127.0.0.1:9070/api/v1' \
+  BONUS_BASEURL='http://127.0.0.1:9080/api/v1' \
+  RETRY_QUEUE_PATH="$workdir"/retry-queue.sqlite3 \
+    exec python3 main.py
+) >"$workdir"/gateway.log 2>&1 &
+gateway_pid=$!
+
+"$root"/scripts/wait-for.sh -t 60 http://localhost:8080/manage/health -- echo "Gateway is active"
+
+python3 "$path"/loadgen.py "$@"
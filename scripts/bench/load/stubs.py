@@ -0,0 +1,256 @@
+"""In-memory stand-ins for flight/ticket/bonus services with latency and error injection.
+
+    python scripts/bench/load/stubs.py --latency flight=5,ticket=10,bonus=10 --jitter 2 --errors bonus=0.01
+
+Each service listens on its own port (flight 9060, ticket 9070, bonus 9080 by default) and
+speaks the same API as the real service, so the gateway can't tell the difference.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import uuid
+
+from aiohttp import web
+from aiohttp.web_middlewares import middleware
+
+SERVICES = ('flight', 'ticket', 'bonus')
+
+
+def per_service(value: str, cast=float) -> dict:
+    ret = {}
+    for part in filter(None, value.split(',')):
+        name, v = part.split('=')
+        if name not in SERVICES:
+            raise argparse.ArgumentTypeError(f'unknown service {name}')
+        ret[name] = cast(v)
+    return ret
+
+
+def fault_injection(latency_ms: float, jitter_ms: float, error_rate: float):
+    @middleware
+    async def inject(req: web.Request, handler):
+        if req.path.startswith('/manage/'):
+            return await handler(req)
+        delay = max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+        if error_rate and random.random() < error_rate:
+            return web.Response(status=500, text='injected failure')
+        return await handler(req)
+
+    return inject
+
+
+async def healthcheck(req: web.Request):
+    return web.Response()
+
+
+def flight_app(flight_count: int, **kwargs) -> web.Application:
+    flights = {}
+    for i in range(flight_count):
+        number = f'AFL{i:03}'
+        flights[number] = {'id': i + 1, 'flightNumber': number, 'date': '2021-10-08 20:00',
+                           'fromAirport': 'Санкт-Петербург Пулково', 'toAirport': 'Москва Шереметьево',
+                           'price': 1500}
+    ordered = list(flights.values())
+    routes = web.RouteTableDef()
+
+    @routes.get('/api/v1/flight/{number}')
+    async def get_flight(req: web.Request):
+        flight = flights.get(req.match_info['number'])
+        if flight is None:
+            return web.Response(status=404)
+        return web.json_response(flight)
+
+    @routes.get('/api/v1/flights/batch')
+    async def get_flights_batch(req: web.Request):
+        return web.json_response([flights[n] for n in req.query['numbers'].split(',') if n in flights])
+
+    @routes.get('/api/v1/flights')
+    async def get_flights(req: web.Request):
+        page = int(req.query.get('page', 0))
+        size = int(req.query.get('size', 100))
+        return web.json_response({'page': page, 'pageSize': size, 'totalElements': len(ordered),
+                                  'items': ordered[page * size:(page + 1) * size]})
+
+    app = web.Application(**kwargs)
+    app.add_routes(routes)
+    return app
+
+
+def ticket_app(**kwargs) -> web.Application:
+    tickets: dict[str, dict] = {}
+    by_user: dict[str, list[dict]] = {}
+    routes = web.RouteTableDef()
+
+    @routes.post('/api/v1/ticket')
+    async def post_ticket(req: web.Request):
+        body = await req.json()
+        ticket = {'ticket_id': len(tickets) + 1, 'ticket_uid': str(uuid.uuid4()),
+                  'username': req.headers['X-User-Name'], 'flight_number': body['flightNumber'],
+                  'price': body['price'], 'status': 'PAID'}
+        tickets[ticket['ticket_uid']] = ticket
+        by_user.setdefault(ticket['username'], []).append(ticket)
+        return web.json_response({'ticketUid': ticket['ticket_uid'], 'flightNumber': ticket['flight_number'],
+                                  'price': ticket['price'], 'status': ticket['status']})
+
+    @routes.post('/api/v1/tickets/batch')
+    async def post_tickets_batch(req: web.Request):
+        body = await req.json()
+        ret = []
+        for item in body['items']:
+            ticket = {'ticket_id': len(tickets) + 1, 'ticket_uid': str(uuid.uuid4()),
+                      'username': req.headers['X-User-Name'], 'flight_number': item['flightNumber'],
+                      'price': item['price'], 'status': 'PAID'}
+            tickets[ticket['ticket_uid']] = ticket
+            by_user.setdefault(ticket['username'], []).append(ticket)
+            ret.append({'ticketUid': ticket['ticket_uid'], 'flightNumber': ticket['flight_number'],
+                        'price': ticket['price'], 'status': ticket['status']})
+        return web.json_response(ret)
+
+    @routes.delete('/api/v1/tickets/batch')
+    async def delete_tickets_batch(req: web.Request):
+        body = await req.json()
+        revoked = []
+        for uid in body['ticketUids']:
+            ticket = tickets.get(uid)
+            if ticket is not None and ticket['username'] == req.headers['X-User-Name']:
+                ticket['status'] = 'CANCELED'
+                revoked.append(uid)
+        return web.json_response({'revoked': revoked})
+
+    @routes.get('/api/v1/tickets')
+    async def get_tickets(req: web.Request):
+        user_tickets = by_user.get(req.headers['X-User-Name'], [])
+        after = int(req.query.get('after', 0) or 0)
+        user_tickets = [t for t in user_tickets if t['ticket_id'] > after]
+        if 'application/x-ndjson' in req.headers.get('Accept', ''):
+            res = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await res.prepare(req)
+            await res.write(''.join(json.dumps(t) + '\n' for t in user_tickets).encode())
+            await res.write_eof()
+            return res
+        if 'size' in req.query:
+            size = int(req.query['size'])
+            res = web.json_response(user_tickets[:size])
+            if len(user_tickets) > size:
+                res.headers['X-Next-Cursor'] = str(user_tickets[size - 1]['ticket_id'])
+            return res
+        return web.json_response(user_tickets)
+
+    @routes.get('/api/v1/tickets/{uid}')
+    async def get_ticket(req: web.Request):
+        ticket = tickets.get(req.match_info['uid'])
+        if ticket is None:
+            return web.Response(status=404)
+        return web.json_response(ticket)
+
+    @routes.delete('/api/v1/tickets/{uid}')
+    async def delete_ticket(req: web.Request):
+        ticket = tickets.get(req.match_info['uid'])
+        if ticket is not None:
+            ticket['status'] = 'CANCELED'
+        return web.json_response({})
+
+    app = web.Application(**kwargs)
+    app.add_routes(routes)
+    return app
+
+
+def bonus_app(**kwargs) -> web.Application:
+    privileges: dict[str, dict] = {}
+    routes = web.RouteTableDef()
+
+    def privilege(user: str) -> dict:
+        return privileges.setdefault(user, {'balance': 0, 'status': 'BRONZE', 'history': []})
+
+    @routes.get('/api/v1/privilege')
+    async def get_privilege(req: web.Request):
+        return web.json_response(privilege(req.headers['X-User-Name']))
+
+    @routes.get('/api/v1/privilege/balance')
+    async def get_balance(req: web.Request):
+        p = privilege(req.headers['X-User-Name'])
+        return web.json_response({'balance': p['balance'], 'status': p['status']})
+
+    @routes.post('/api/v1/privilege')
+    async def push_privilege(req: web.Request):
+        body = await req.json()
+        p = privilege(req.headers['X-User-Name'])
+        if body['operationType'] == 'FILL_IN_BALANCE':
+            diff = int(body['price'] * 0.1)
+        else:
+            diff = -min(p['balance'], body['price'])
+        p['balance'] += diff
+        p['history'].append({'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                             'ticketUid': body['ticket_uid'], 'balanceDiff': abs(diff),
+                             'operationType': body['operationType']})
+        return web.json_response({'balance': p['balance'], 'status': p['status'], 'balanceDiff': diff})
+
+    @routes.post('/api/v1/privilege/batch')
+    async def push_privilege_batch(req: web.Request):
+        body = await req.json()
+        p = privilege(req.headers['X-User-Name'])
+        items = []
+        for item in body['items']:
+            if item['operationType'] == 'FILL_IN_BALANCE':
+                diff = int(item['price'] * 0.1)
+            else:
+                diff = -min(p['balance'], item['price'])
+            p['balance'] += diff
+            items.append({'ticket_uid': item['ticket_uid'], 'balanceDiff': diff})
+        return web.json_response({'balance': p['balance'], 'status': p['status'], 'items': items})
+
+    @routes.delete('/api/v1/privilege/batch')
+    async def drop_privilege_batch(req: web.Request):
+        body = await req.json()
+        return web.json_response({'dropped': body['ticketUids']})
+
+    @routes.delete('/api/v1/privilege/{uid}')
+    async def drop_privilege(req: web.Request):
+        return web.json_response({})
+
+    app = web.Application(**kwargs)
+    app.add_routes(routes)
+    return app
+
+
+async def serve(args):
+    factories = {'flight': lambda **kw: flight_app(args.flights, **kw), 'ticket': ticket_app, 'bonus': bonus_app}
+    runners = []
+    for i, name in enumerate(SERVICES):
+        inject = fault_injection(args.latency.get(name, 0.0), args.jitter, args.errors.get(name, 0.0))
+        app = factories[name](middlewares=[inject])
+        app.router.add_get('/manage/health', healthcheck)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        port = args.port_base + 60 + 10 * i
+        await web.TCPSite(runner, args.host, port).start()
+        print(f'{name} stub on {args.host}:{port}')
+        runners.append(runner)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port-base', type=int, default=9000, help='services listen on base+60, +70 and +80')
+    parser.add_argument('--latency', type=per_service, default={}, help='mean latency in ms, e.g. flight=5,bonus=20')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency standard deviation in ms')
+    parser.add_argument('--errors', type=per_service, default={}, help='share of 500s, e.g. bonus=0.05')
+    parser.add_argument('--flights', type=int, default=100)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
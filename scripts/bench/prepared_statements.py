@@ -0,0 +1,73 @@
+"""Per-query latency of ticket_service hot queries: plain text queries vs prepared statements.
+
+    DB_NAME=tickets DB_USER=program DB_PASSWORD=test DB_HOST=localhost DB_PORT=5431 \
+        python scripts/bench/prepared_statements.py --iterations 5000
+
+Runs against an already migrated ticket database; picks an existing user and ticket to query.
+No results have been recorded yet, so services run plain queries unless DB_PREPARED_STATEMENTS=1;
+make that the default only once a run here shows prepared statements are faster.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import aiopg
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'src' / 'ticket_service'))
+import db  # noqa: E402
+import queries  # noqa: E402
+
+
+async def run(cur: aiopg.Cursor, foo, iterations: int) -> list[float]:
+    times = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        await foo()
+        await cur.fetchall()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def report(name: str, times: list[float]):
+    times = sorted(times)
+    p = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000
+    print(f'{name:<40} mean {statistics.mean(times) * 1000:7.3f} ms   '
+          f'p50 {p(0.5):7.3f} ms   p99 {p(0.99):7.3f} ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    dsn = (f"dbname={os.environ.get('DB_NAME', 'tickets')} user={os.environ.get('DB_USER', 'postgres')} "
+           f"password={os.environ.get('DB_PASSWORD', 'postgres')} host={os.environ.get('DB_HOST', 'localhost')} "
+           f"port={os.environ.get('DB_PORT', 5432)}")
+    async with aiopg.connect(dsn) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT ticket_uid, username FROM ticket ORDER BY id LIMIT 1;')
+            row = await cur.fetchone()
+            if row is None:
+                sys.exit('ticket table is empty, load some data first')
+            ticket_uid, username = row
+
+            db.use_prepared = True
+            cases = [(queries.TICKET_BY_UID, (ticket_uid,)),
+                     (queries.TICKETS_BY_USERNAME, (username, 0, 100))]
+            for statement, params in cases:
+                sql = statement.text_sql()
+                # warm both paths up so the first-call planning cost is not in the numbers
+                await cur.execute(sql, params)
+                await db.execute(cur, statement, params)
+                report(f'{statement.name} (text)',
+                       await run(cur, lambda: cur.execute(sql, params), args.iterations))
+                report(f'{statement.name} (prepared)',
+                       await run(cur, lambda: db.execute(cur, statement, params), args.iterations))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
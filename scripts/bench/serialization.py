@@ -0,0 +1,76 @@
+"""Encoding cost of the gateway's /flights and /me responses: stdlib json vs orjson.
+
+    python scripts/bench/serialization.py --flights 100 --tickets 500
+
+Each case decodes a downstream payload, reshapes it the way the gateway handler does
+and encodes the public response. 'cached' is a /flights page served from the page cache,
+which now holds the encoded body.
+"""
+import argparse
+import json
+import timeit
+import uuid
+
+import orjson
+
+
+def downstream_flights_page(n: int) -> bytes:
+    items = [{'id': i, 'flightNumber': f'AFL{i:03}', 'date': '2021-10-08 20:00',
+              'fromAirport': 'Санкт-Петербург Пулково', 'toAirport': 'Москва Шереметьево', 'price': 1500}
+             for i in range(n)]
+    return json.dumps({'page': 0, 'pageSize': n, 'totalElements': n, 'items': items, 'nextCursor': None}).encode()
+
+
+def downstream_tickets(n: int) -> bytes:
+    return json.dumps([{'ticket_id': i, 'ticket_uid': str(uuid.uuid4()), 'username': 'Test Max',
+                        'flight_number': f'AFL{i % 100:03}', 'price': 1500, 'status': 'PAID'}
+                       for i in range(n)]).encode()
+
+
+def flights_page(flights: dict) -> dict:
+    dat = flights.copy()
+    dat['items'] = [{'flightNumber': f['flightNumber'], 'fromAirport': f['fromAirport'],
+                     'toAirport': f['toAirport'], 'date': f['date'], 'price': f['price']}
+                    for f in flights['items']]
+    return dat
+
+
+def me(tickets: list, flights: dict) -> dict:
+    items = []
+    for t in tickets:
+        flight_data = flights.get(t['flight_number'], {})
+        items.append({'ticketUid': t['ticket_uid'], 'status': t['status'], 'flightNumber': t['flight_number'],
+                      'fromAirport': flight_data.get('fromAirport'), 'toAirport': flight_data.get('toAirport'),
+                      'date': flight_data.get('date'), 'price': t['price']})
+    return {'tickets': items, 'privilege': {'balance': 1500, 'status': 'GOLD'}}
+
+
+def report(name: str, foo, number: int):
+    best = min(timeit.repeat(foo, number=number, repeat=5)) / number
+    print(f'{name:<28} {best * 1e6:10.1f} us')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flights', type=int, default=100)
+    parser.add_argument('--tickets', type=int, default=500)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    page = downstream_flights_page(args.flights)
+    tickets = downstream_tickets(args.tickets)
+    flights = {f['flightNumber']: f for f in json.loads(page)['items']}
+    cached = orjson.dumps(flights_page(orjson.loads(page)))
+
+    print(f'/flights ({args.flights} items)')
+    report('stdlib json', lambda: json.dumps(flights_page(json.loads(page))).encode(), args.number)
+    report('orjson', lambda: orjson.dumps(flights_page(orjson.loads(page))), args.number)
+    report('orjson, cached page', lambda: bytes(cached), args.number)
+
+    print(f'/me ({args.tickets} tickets)')
+    report('stdlib json', lambda: json.dumps(me(json.loads(tickets), flights)).encode(), args.number)
+    report('orjson', lambda: orjson.dumps(me(orjson.loads(tickets), flights)), args.number)
+
+
+if __name__ == '__main__':
+    main()
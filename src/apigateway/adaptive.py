@@ -0,0 +1,86 @@
+from __future__ import annotations
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import aiohttp
+
+from cb_policy import CountWindow
+
+
+class LatencyTracker:
+    # time to response headers of the last `window_size` successful calls per (service, method)
+    window_size: int = 1000
+    min_samples: int = 100
+
+    def __init__(self, window_size=1000, min_samples=100):
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.windows: dict[tuple[str, str], CountWindow] = {}
+
+    @classmethod
+    def from_env(cls) -> LatencyTracker:
+        return cls(window_size=int(os.environ.get('LATENCY_WINDOW_SIZE', 1000)),
+                   min_samples=int(os.environ.get('LATENCY_MIN_SAMPLES', 100)))
+
+    def observe(self, service_name: str, method: str, req_time_sec: float):
+        window = self.windows.get((service_name, method))
+        if window is None:
+            window = self.windows[(service_name, method)] = CountWindow(self.window_size)
+        window.add(req_time_sec, True)
+
+    def quantile(self, service_name: str, method: str, q: float) -> Optional[float]:
+        window = self.windows.get((service_name, method))
+        if window is None or window.count < self.min_samples:
+            return None
+        return window.latency.quantile(q)
+
+    def trace_config(self, service_name: str) -> aiohttp.TraceConfig:
+        async def on_request_start(session, ctx: SimpleNamespace, params):
+            ctx.t = time.perf_counter()
+
+        async def on_request_end(session, ctx: SimpleNamespace, params):
+            # 5xx answers are often fast failures and would drag the quantiles down
+            if params.response.status < 500:
+                self.observe(service_name, params.method, time.perf_counter() - ctx.t)
+
+        async def on_request_exception(session, ctx: SimpleNamespace, params):
+            # a call that timed out or lost a hedge took at least this long; counting it keeps
+            # the tail honest, so a slowdown widens the timeout instead of locking it in
+            if isinstance(params.exception, (asyncio.TimeoutError, asyncio.CancelledError)):
+                self.observe(service_name, params.method, time.perf_counter() - ctx.t)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+
+class HedgeBudget:
+    # every hedgeable call earns `ratio` of a token and a hedge spends a whole one, so hedges
+    # stay under `ratio` of the traffic; `burst` caps what a quiet period can save up
+    ratio: float = 0.05
+    burst: float = 10.0
+
+    def __init__(self, ratio=0.05, burst=10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens: dict[str, float] = {}
+
+    @classmethod
+    def from_env(cls) -> HedgeBudget:
+        return cls(ratio=float(os.environ.get('HEDGE_BUDGET_PERCENT', 5)) / 100,
+                   burst=float(os.environ.get('HEDGE_BUDGET_BURST', 10)))
+
+    def earn(self, service_name: str):
+        self.tokens[service_name] = min(self.burst, self.tokens.get(service_name, 0.0) + self.ratio)
+
+    def try_spend(self, service_name: str) -> bool:
+        tokens = self.tokens.get(service_name, 0.0)
+        if tokens < 1:
+            return False
+        self.tokens[service_name] = tokens - 1
+        return True
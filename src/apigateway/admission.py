@@ -0,0 +1,173 @@
+from __future__ import annotations
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+from aiohttp import web
+from aiohttp.web_middlewares import middleware
+
+import metrics
+from fastjson import json_response
+from schema import ErrorResponse
+
+
+class TokenBuckets:
+    # one bucket per key, refilled lazily on lookup; the least recently seen keys are
+    # dropped past `max_keys`, which only ever hands a forgotten user a full bucket
+    rate: float = 20.0
+    burst: float = 40.0
+    max_keys: int = 100000
+
+    def __init__(self, rate=20.0, burst=40.0, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    # None when `key` had a token, otherwise seconds until it gets one
+    def try_take(self, key: str) -> Optional[float]:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait_sec = None
+        else:
+            wait_sec = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait_sec
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ConcurrencyLimiter:
+    max_concurrency: int = 256
+    max_queue: int = 512
+    queue_timeout_sec: float = 1.0
+
+    def __init__(self, max_concurrency=256, max_queue=512, queue_timeout_sec=1.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout_sec = queue_timeout_sec
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def try_acquire(self) -> bool:
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+            return True
+        return False
+
+    async def acquire(self) -> bool:
+        if self.try_acquire():
+            return True
+        if len(self._waiters) >= self.max_queue:
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout_sec)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            # the slot may have been handed over just before the client went away
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        finally:
+            if not fut.done() or fut.cancelled():
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+
+    def release(self):
+        # a finished request passes its slot straight to the oldest waiter
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class AdmissionControl:
+    exempt_prefixes: tuple[str, ...] = ('/manage/',)
+
+    def __init__(self, limiter: ConcurrencyLimiter, buckets: Optional[TokenBuckets],
+                 exempt_prefixes=('/manage/',)):
+        self.limiter = limiter
+        self.buckets = buckets
+        self.exempt_prefixes = tuple(exempt_prefixes)
+
+    @classmethod
+    def from_env(cls) -> AdmissionControl:
+        limiter = ConcurrencyLimiter(max_concurrency=int(os.environ.get('ADMISSION_MAX_CONCURRENCY', 256)),
+                                     max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 512)),
+                                     queue_timeout_sec=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SEC', 1.0)))
+        rate = float(os.environ.get('ADMISSION_USER_RPS', 20))
+        buckets = None
+        if rate > 0:
+            buckets = TokenBuckets(rate=rate,
+                                   burst=float(os.environ.get('ADMISSION_USER_BURST', 2 * rate)),
+                                   max_keys=int(os.environ.get('ADMISSION_USER_BUCKETS', 100000)))
+        return cls(limiter, buckets)
+
+    def stats(self) -> dict:
+        return {
+            'inFlight': self.limiter.in_flight,
+            'queued': self.limiter.queued(),
+            'maxConcurrency': self.limiter.max_concurrency,
+            'maxQueue': self.limiter.max_queue,
+            'users': len(self.buckets) if self.buckets is not None else 0,
+        }
+
+
+controller = AdmissionControl.from_env()
+metrics.instrument_admission(controller)
+
+
+def _reject(status: int, reason: str, retry_after_sec: float) -> web.Response:
+    metrics.ADMISSION_REQUESTS.labels(reason).inc()
+    # runs outside the api sub-app and its exc_handler, so the error body is built here
+    error = ErrorResponse(status, reason.replace('_', ' ').capitalize())
+    return json_response(error.to_json(), status=error.status,
+                         headers={'Retry-After': str(max(1, math.ceil(retry_after_sec)))})
+
+
+@middleware
+async def admission_middleware(req: web.Request, handler):
+    # health checks and metrics are always answered, an overloaded gateway is still alive
+    if req.path.startswith(controller.exempt_prefixes):
+        return await handler(req)
+
+    user_name = req.headers.get('X-User-Name')
+    if controller.buckets is not None and user_name is not None:
+        wait_sec = controller.buckets.try_take(user_name)
+        if wait_sec is not None:
+            return _reject(429, 'rate_limited', wait_sec)
+
+    limiter = controller.limiter
+    if limiter.try_acquire():
+        metrics.ADMISSION_REQUESTS.labels('admitted').inc()
+    elif limiter.queued() >= limiter.max_queue:
+        return _reject(503, 'queue_full', limiter.queue_timeout_sec)
+    elif await limiter.acquire():
+        metrics.ADMISSION_REQUESTS.labels('queued').inc()
+    else:
+        return _reject(503, 'queue_timeout', limiter.queue_timeout_sec)
+    try:
+        return await handler(req)
+    finally:
+        limiter.release()
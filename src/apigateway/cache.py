@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Optional
+
+from singleflight import SingleFlight
+
+
+# Entries older than ttl_sec are no longer hits but are kept up to stale_ttl_sec
+# as a fallback (get_stale). Loaders return None for missing keys, those are not cached.
+class AsyncTTLCache:
+    name: str
+    max_size: int
+    ttl_sec: float
+    stale_ttl_sec: float
+
+    def __init__(self, name: str, max_size: int = 1024, ttl_sec: float = 60.0, stale_ttl_sec: float = 3600.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.stale_ttl_sec = stale_ttl_sec
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._flight = SingleFlight(name)
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls, name: str, **defaults) -> AsyncTTLCache:
+        prefix = name.upper()
+        cache = cls(name, **defaults)
+        cache.max_size = int(os.environ.get(f'{prefix}_CACHE_SIZE', cache.max_size))
+        cache.ttl_sec = float(os.environ.get(f'{prefix}_CACHE_TTL_SEC', cache.ttl_sec))
+        cache.stale_ttl_sec = float(os.environ.get(f'{prefix}_CACHE_STALE_TTL_SEC', cache.stale_ttl_sec))
+        return cache
+
+    def _lookup(self, key: Hashable, max_age_sec: float) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        age = time.monotonic() - stored_at
+        if age >= self.stale_ttl_sec:
+            del self._entries[key]
+            return None
+        if age >= max_age_sec:
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        return self._lookup(key, self.ttl_sec)
+
+    def get_stale(self, key: Hashable) -> Optional[Any]:
+        value = self._lookup(key, self.stale_ttl_sec)
+        if value is not None:
+            self.stale_hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_many_or_load(self, keys: Iterable[Hashable],
+                               loader: Callable[[list], Awaitable[dict]]) -> dict:
+        ret = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                ret[key] = value
+            else:
+                missing.append(key)
+                if self._flight.in_flight(key):
+                    self.coalesced += 1
+                else:
+                    self.misses += 1
+        if not missing:
+            return ret
+
+        async def load(keys: list) -> dict:
+            loaded = await loader(keys)
+            for key in keys:
+                value = loaded.get(key)
+                if value is not None:
+                    self.put(key, value)
+            return loaded
+
+        loaded = await self._flight.do_many(missing, load)
+        ret.update((key, value) for key, value in loaded.items() if value is not None)
+        return ret
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[Hashable], Awaitable[Optional[Any]]]) -> Optional[Any]:
+        async def load_one(keys: list) -> dict:
+            return {key: await loader(key)}
+
+        return (await self.get_many_or_load([key], load_one)).get(key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'size': len(self._entries),
+            'maxSize': self.max_size,
+            'ttlSec': self.ttl_sec,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'staleHits': self.stale_hits,
+            'evictions': self.evictions,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,175 @@
+from __future__ import annotations
+import math
+import time
+from dataclasses import dataclass
+
+
+class LatencySketch:
+    # Log-bucketed histogram: bucket i holds latencies up to min_sec * growth ** i,
+    # so quantiles are accurate to one bucket (10% with the default growth)
+    min_sec: float = 0.001
+    growth: float = 1.1
+    size: int = 128
+
+    def __init__(self):
+        self.counts = [0] * self.size
+
+    @classmethod
+    def index(cls, req_time_sec: float) -> int:
+        if req_time_sec <= cls.min_sec:
+            return 0
+        return min(cls.size - 1, math.ceil(math.log(req_time_sec / cls.min_sec, cls.growth)))
+
+    @classmethod
+    def upper_bound(cls, index: int) -> float:
+        return cls.min_sec * cls.growth ** index
+
+    def add(self, index: int, n: int = 1):
+        self.counts[index] += n
+
+    def add_sketch(self, other: LatencySketch, sign: int = 1):
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += sign * c
+
+    def reset(self):
+        self.counts = [0] * self.size
+
+    def quantile(self, q: float) -> float:
+        total = sum(self.counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.upper_bound(i)
+        return self.upper_bound(self.size - 1)
+
+
+class CountWindow:
+    # last `size` calls, running aggregates so add() and reads are O(1)
+    def __init__(self, size: int):
+        self.size = size
+        self.successes = [False] * size
+        self.times = [0.0] * size
+        self.bins = [0] * size
+        self.latency = LatencySketch()
+        self.reset()
+
+    def reset(self):
+        self.pos = 0
+        self.count = 0
+        self.success_count = 0
+        self.time_sum = 0.0
+        self.latency.reset()
+
+    def add(self, req_time_sec: float, was_success: bool):
+        if self.count == self.size:
+            self.success_count -= self.successes[self.pos]
+            self.time_sum -= self.times[self.pos]
+            self.latency.add(self.bins[self.pos], -1)
+        else:
+            self.count += 1
+        index = LatencySketch.index(req_time_sec)
+        self.successes[self.pos] = was_success
+        self.times[self.pos] = req_time_sec
+        self.bins[self.pos] = index
+        self.success_count += was_success
+        self.time_sum += req_time_sec
+        self.latency.add(index)
+        self.pos = (self.pos + 1) % self.size
+
+
+class _Bucket:
+    __slots__ = ('epoch', 'count', 'success_count', 'time_sum', 'latency')
+
+    def __init__(self):
+        self.epoch = -1
+        self.count = 0
+        self.success_count = 0
+        self.time_sum = 0.0
+        self.latency = LatencySketch()
+
+
+class TimeWindow:
+    # calls of the last `window_sec` seconds, kept in `buckets` time slices
+    def __init__(self, window_sec: float, buckets: int = 10):
+        self.window_sec = window_sec
+        self.bucket_sec = window_sec / buckets
+        self.buckets = [_Bucket() for _ in range(buckets)]
+        self.latency = LatencySketch()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.success_count = 0
+        self.time_sum = 0.0
+        self.latency.reset()
+        for b in self.buckets:
+            b.epoch = -1
+            b.count = b.success_count = 0
+            b.time_sum = 0.0
+            b.latency.reset()
+
+    def _expire(self, bucket: _Bucket):
+        self.count -= bucket.count
+        self.success_count -= bucket.success_count
+        self.time_sum -= bucket.time_sum
+        self.latency.add_sketch(bucket.latency, -1)
+        bucket.count = bucket.success_count = 0
+        bucket.time_sum = 0.0
+        bucket.latency.reset()
+
+    def advance(self):
+        epoch = int(time.monotonic() / self.bucket_sec)
+        for b in self.buckets:
+            if b.epoch != -1 and b.epoch <= epoch - len(self.buckets):
+                self._expire(b)
+                b.epoch = -1
+        return epoch
+
+    def add(self, req_time_sec: float, was_success: bool):
+        epoch = self.advance()
+        bucket = self.buckets[epoch % len(self.buckets)]
+        if bucket.epoch != epoch:
+            self._expire(bucket)
+            bucket.epoch = epoch
+        index = LatencySketch.index(req_time_sec)
+        bucket.count += 1
+        bucket.success_count += was_success
+        bucket.time_sum += req_time_sec
+        bucket.latency.add(index)
+        self.count += 1
+        self.success_count += was_success
+        self.time_sum += req_time_sec
+        self.latency.add(index)
+
+
+@dataclass
+class FailureRatePolicy:
+    min_success_rate: float = 0.75
+    min_calls: int = 1
+
+    def should_open(self, window) -> bool:
+        return window.count >= self.min_calls and window.success_count / window.count <= self.min_success_rate
+
+
+@dataclass
+class MeanLatencyPolicy:
+    threshold_sec: float = 3.2
+    min_calls: int = 1
+
+    def should_open(self, window) -> bool:
+        return window.count >= self.min_calls and max(window.time_sum, 0.0) / window.count >= self.threshold_sec
+
+
+@dataclass
+class SlowCallPolicy:
+    threshold_sec: float
+    quantile: float = 0.95
+    min_calls: int = 20
+
+    def should_open(self, window) -> bool:
+        return window.count >= self.min_calls and window.latency.quantile(self.quantile) >= self.threshold_sec
@@ -0,0 +1,284 @@
+from __future__ import annotations
+import ctypes
+import fcntl
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Union
+
+from cb_policy import LatencySketch, CountWindow, TimeWindow
+from circuit_breaker import CircuitBreaker, CircuitBreakerState
+
+STATES = list(CircuitBreakerState)
+
+
+# The shared variants keep every field in an anonymous shared mapping made before the
+# workers fork, so all of them count into the same windows and flip the same state.
+# A zero-filled slot is a valid empty window and a CLOSED breaker.
+def _shared_field(name: str) -> property:
+    return property(lambda self: getattr(self._data, name),
+                    lambda self, value: setattr(self._data, name, value))
+
+
+def _sketch_type():
+    return ctypes.c_long * LatencySketch.size
+
+
+class SharedLatencySketch(LatencySketch):
+    def __init__(self, counts):
+        self.counts = counts
+
+    def reset(self):
+        ctypes.memset(ctypes.addressof(self.counts), 0, ctypes.sizeof(self.counts))
+
+
+def count_window_type(size: int):
+    class _CountWindowData(ctypes.Structure):
+        _fields_ = [('pos', ctypes.c_long),
+                    ('count', ctypes.c_long),
+                    ('success_count', ctypes.c_long),
+                    ('time_sum', ctypes.c_double),
+                    ('successes', ctypes.c_bool * size),
+                    ('times', ctypes.c_double * size),
+                    ('bins', ctypes.c_int * size),
+                    ('latency', _sketch_type())]
+
+    return _CountWindowData
+
+
+class SharedCountWindow(CountWindow):
+    pos = _shared_field('pos')
+    count = _shared_field('count')
+    success_count = _shared_field('success_count')
+    time_sum = _shared_field('time_sum')
+
+    def __init__(self, size: int, data):
+        self.size = size
+        self._data = data
+        self.successes = data.successes
+        self.times = data.times
+        self.bins = data.bins
+        self.latency = SharedLatencySketch(data.latency)
+
+
+class _BucketData(ctypes.Structure):
+    _fields_ = [('epoch', ctypes.c_long),
+                ('count', ctypes.c_long),
+                ('success_count', ctypes.c_long),
+                ('time_sum', ctypes.c_double),
+                ('latency', _sketch_type())]
+
+
+class _SharedBucket:
+    epoch = _shared_field('epoch')
+    count = _shared_field('count')
+    success_count = _shared_field('success_count')
+    time_sum = _shared_field('time_sum')
+
+    def __init__(self, data: _BucketData):
+        self._data = data
+        self.latency = SharedLatencySketch(data.latency)
+
+
+def time_window_type(buckets: int):
+    class _TimeWindowData(ctypes.Structure):
+        _fields_ = [('count', ctypes.c_long),
+                    ('success_count', ctypes.c_long),
+                    ('time_sum', ctypes.c_double),
+                    ('latency', _sketch_type()),
+                    ('buckets', _BucketData * buckets)]
+
+    return _TimeWindowData
+
+
+class SharedTimeWindow(TimeWindow):
+    count = _shared_field('count')
+    success_count = _shared_field('success_count')
+    time_sum = _shared_field('time_sum')
+
+    def __init__(self, window_sec: float, buckets: int, data):
+        self.window_sec = window_sec
+        self.bucket_sec = window_sec / buckets
+        self._data = data
+        self.buckets = [_SharedBucket(b) for b in data.buckets]
+        self.latency = SharedLatencySketch(data.latency)
+
+
+class _SharedServiceState:
+    opened_at = _shared_field('opened_at')
+    probes_in_flight = _shared_field('probes_in_flight')
+    probe_successes = _shared_field('probe_successes')
+
+    def __init__(self, data, window: Union[SharedCountWindow, SharedTimeWindow]):
+        self._data = data
+        self.window = window
+
+    @property
+    def state(self) -> CircuitBreakerState:
+        return STATES[self._data.state]
+
+    @state.setter
+    def state(self, value: CircuitBreakerState):
+        self._data.state = STATES.index(value)
+
+
+class _ProcessLock:
+    # fcntl record locks belong to the process: the kernel drops them when a worker dies,
+    # so a worker killed mid-update cannot wedge the others. They are re-entrant within a
+    # process, which `_depth` mirrors so only the outermost release unlocks.
+    # The holder keeps it for a few microseconds, yet it is taken on the event loop, so a
+    # caller never waits on it: a few non-blocking attempts, yielding the CPU to the holder
+    # in between, and `held()` tells whether the caller got it.
+    attempts: int = 3
+
+    def __init__(self, attempts=3):
+        self.attempts = attempts
+        self._file = tempfile.TemporaryFile()
+        self._depth = 0
+
+    def acquire(self, blocking=False) -> bool:
+        if self._depth:
+            self._depth += 1
+            return True
+        if blocking:
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            self._depth = 1
+            return True
+        for attempt in range(self.attempts):
+            if attempt:
+                os.sched_yield()
+            try:
+                fcntl.lockf(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._depth = 1
+                return True
+            except OSError:
+                pass
+        return False
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def held(self, blocking=False):
+        locked = self.acquire(blocking)
+        try:
+            yield locked
+        finally:
+            if locked:
+                self.release()
+
+
+class SharedCircuitBreaker(CircuitBreaker):
+    max_services: int = 16
+    name_size: int = 64
+    time_window_buckets: int = 10
+
+    def __init__(self, *args, lock_attempts=3, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.window_sec is not None:
+            window_type = time_window_type(self.time_window_buckets)
+        else:
+            window_type = count_window_type(self.store_limit)
+
+        class _Slot(ctypes.Structure):
+            _fields_ = [('state', ctypes.c_int),
+                        ('probes_in_flight', ctypes.c_int),
+                        ('probe_successes', ctypes.c_int),
+                        ('opened_at', ctypes.c_double),
+                        ('window', window_type)]
+
+        class _Table(ctypes.Structure):
+            _fields_ = [('names', (ctypes.c_char * self.name_size) * self.max_services),
+                        ('slots', _Slot * self.max_services)]
+
+        # MAP_SHARED and anonymous: inherited by every forked worker, gone with the last one
+        self._mapping = mmap.mmap(-1, ctypes.sizeof(_Table))
+        self._table = _Table.from_buffer(self._mapping)
+        self._lock = _ProcessLock(lock_attempts)
+        self._seen: dict[str, CircuitBreakerState] = {}
+
+    @classmethod
+    def from_env(cls) -> SharedCircuitBreaker:
+        cb = super().from_env()
+        cb._lock.attempts = int(os.environ.get('CB_LOCK_ATTEMPTS', cb._lock.attempts))
+        return cb
+
+    def _slot(self, service_name: str):
+        name = service_name.encode()
+        # a name is claimed once per worker, so this one may wait for the lock
+        with self._lock.held(blocking=True):
+            for i in range(self.max_services):
+                if self._table.names[i].value == name:
+                    return self._table.slots[i]
+                if not self._table.names[i].value:
+                    self._table.names[i].value = name
+                    return self._table.slots[i]
+        raise ValueError(f'no room for breaker state of {service_name}, max_services={self.max_services}')
+
+    def _service(self, service_name: str) -> _SharedServiceState:
+        s = self.services.get(service_name)
+        if s is None:
+            slot = self._slot(service_name)
+            if self.window_sec is not None:
+                window = SharedTimeWindow(self.window_sec, self.time_window_buckets, slot.window)
+            else:
+                window = SharedCountWindow(self.store_limit, slot.window)
+            s = self.services[service_name] = _SharedServiceState(slot, window)
+        return s
+
+    def _set_state(self, service_name: str, s: _SharedServiceState, state: CircuitBreakerState):
+        super()._set_state(service_name, s, state)
+        self._seen[service_name] = state
+
+    def _catch_up(self, service_name: str, state: CircuitBreakerState):
+        # another worker may have moved the breaker; only the state listeners hear about it,
+        # the transition itself was already counted by the worker that made it
+        seen = self._seen.get(service_name, CircuitBreakerState.CLOSED)
+        if seen != state:
+            self._seen[service_name] = state
+            for listener in self.state_listeners:
+                listener(service_name, seen, state)
+
+    def _busy(self, what: str, service_name: str):
+        # fail closed: an update the lock was not got for is dropped, never written unlocked
+        print(f'[CB] shared state of {service_name} busy in {os.getpid()}, skipping {what}')
+
+    def get_state(self, service_name: str) -> CircuitBreakerState:
+        with self._lock.held() as locked:
+            if locked:
+                state = super().get_state(service_name)
+            else:
+                # the state is a single word, it reads fine without the lock; only moving it needs it
+                self._busy('the transition check', service_name)
+                state = self._service(service_name).state
+        self._catch_up(service_name, state)
+        return state
+
+    def try_acquire(self, service_name: str) -> CircuitBreakerState:
+        with self._lock.held() as locked:
+            if locked:
+                return super().try_acquire(service_name)
+        self._busy('the state check', service_name)
+        state = self._service(service_name).state
+        # a probe slot cannot be counted without the lock, so no probe is let through
+        if state == CircuitBreakerState.HALF_OPENED:
+            return CircuitBreakerState.OPENED
+        return state
+
+    def release(self, service_name: str, probe: bool = False):
+        if not probe:
+            return
+        # a lost probe release would keep the breaker half-open for good, so it waits its turn
+        with self._lock.held(blocking=True):
+            super().release(service_name, probe=probe)
+
+    def observe(self, service_name: str, req_time_sec: float, was_success: bool, probe: bool = False):
+        # probes are few and their outcome moves the breaker, so they wait their turn as well
+        with self._lock.held(blocking=probe) as locked:
+            if locked:
+                super().observe(service_name, req_time_sec, was_success, probe=probe)
+                return
+        self._busy('a call outcome', service_name)
@@ -1,12 +1,15 @@
 from __future__ import annotations
+import os
 import time
-from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Callable, Optional, Union
 
 import aiohttp.web_exceptions
 
+import deadline
+from cb_policy import CountWindow, TimeWindow, FailureRatePolicy, MeanLatencyPolicy, SlowCallPolicy
+
 
 class CircuitBreakerState(Enum):
     CLOSED = 'CLOSED'
@@ -20,39 +23,107 @@ class _CBGuard:
     service_name: str
 
     def __enter__(self):
-        state = self.cb.get_state(self.service_name)
+        state = self.cb.try_acquire(self.service_name)
         print(f'[CB/G] state of {self.service_name} is {state.name}')
         if state == CircuitBreakerState.OPENED:
             raise aiohttp.web_exceptions.HTTPInternalServerError(
                 text=f'Service {self.service_name} temporarly unavailable')
-        self.t = time.time()
+        self.probe = state == CircuitBreakerState.HALF_OPENED
+        self.t = time.perf_counter()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        t = int(time.time() - self.t)
+        t = time.perf_counter() - self.t
+        if exc_val is not None and deadline.budget_spent(exc_val):
+            # the request ran out of time, not the service: no verdict either way
+            self.cb.release(self.service_name, probe=self.probe)
+            return
         successed = exc_val is None
-        self.cb.observe(self.service_name, t, successed)
+        self.cb.observe(self.service_name, t, successed, probe=self.probe)
+
+
+@dataclass
+class _ServiceState:
+    window: Union[CountWindow, TimeWindow]
+    state: CircuitBreakerState = CircuitBreakerState.CLOSED
+    opened_at: float = 0.0
+    probes_in_flight: int = 0
+    probe_successes: int = 0
 
 
 class CircuitBreaker:
-    req_success: dict[str, list[bool]]
-    req_times: dict[str, list[int]]
+    services: dict[str, _ServiceState]
+    policies: list
+    # `listeners` hear the transitions this process makes; `state_listeners` also hear the ones
+    # it only finds out about, made by another worker sharing the breaker, so they must not count
+    listeners: list[Callable[[str, CircuitBreakerState, CircuitBreakerState], None]]
+    state_listeners: list[Callable[[str, CircuitBreakerState, CircuitBreakerState], None]]
     store_limit: int = 100
-    error_rate: int = 75
-    time_threshold_sec: float = 3.2
-    half_open_threshold_sec: int = 10
-    closed_at_sec: dict[str, Optional[int]]
+    window_sec: Optional[float] = None
+    half_open_threshold_sec: float = 10
+    half_open_probes: int = 1
 
     def guard(self, service_name: str) -> _CBGuard:
         return _CBGuard(self, service_name)
 
-    def __init__(self, store_limit=100, error_rate=75, time_threshold_sec=3.2, half_open_threshold_sec=10):
-        self.req_success = defaultdict(list)
-        self.req_times = defaultdict(list)
-        self.closed_at_sec = defaultdict(lambda: None)
+    def __init__(self, store_limit=100, error_rate=75, time_threshold_sec=3.2, half_open_threshold_sec=10,
+                 window_sec=None, policies=None, half_open_probes=1):
+        self.services = {}
+        self.listeners = []
+        self.state_listeners = []
         self.store_limit = store_limit
-        self.error_rate = error_rate
-        self.time_threshold_sec = time_threshold_sec
+        self.window_sec = window_sec
         self.half_open_threshold_sec = half_open_threshold_sec
+        self.half_open_probes = half_open_probes
+        if policies is None:
+            policies = [FailureRatePolicy(min_success_rate=error_rate / 100),
+                        MeanLatencyPolicy(threshold_sec=time_threshold_sec)]
+        self.policies = policies
+
+    @classmethod
+    def from_env(cls) -> CircuitBreaker:
+        min_calls = int(os.environ.get('CB_MIN_CALLS', 1))
+        policies = [FailureRatePolicy(min_success_rate=float(os.environ.get('CB_ERROR_RATE', 75)) / 100,
+                                      min_calls=min_calls),
+                    MeanLatencyPolicy(threshold_sec=float(os.environ.get('CB_TIME_THRESHOLD_SEC', 3.2)),
+                                      min_calls=min_calls)]
+        if 'CB_SLOW_CALL_SEC' in os.environ:
+            policies.append(SlowCallPolicy(threshold_sec=float(os.environ['CB_SLOW_CALL_SEC']),
+                                           quantile=float(os.environ.get('CB_SLOW_CALL_QUANTILE', 0.95)),
+                                           min_calls=max(min_calls, int(os.environ.get('CB_SLOW_CALL_MIN_CALLS', 20)))))
+        window_sec = os.environ.get('CB_WINDOW_SEC')
+        return cls(store_limit=int(os.environ.get('CB_WINDOW_SIZE', 100)),
+                   half_open_threshold_sec=float(os.environ.get('CB_HALF_OPEN_SEC', 10)),
+                   window_sec=float(window_sec) if window_sec else None,
+                   half_open_probes=int(os.environ.get('CB_HALF_OPEN_PROBES', 1)),
+                   policies=policies)
+
+    def _service(self, service_name: str) -> _ServiceState:
+        s = self.services.get(service_name)
+        if s is None:
+            if self.window_sec is not None:
+                window = TimeWindow(self.window_sec)
+            else:
+                window = CountWindow(self.store_limit)
+            s = self.services[service_name] = _ServiceState(window)
+        return s
+
+    def window(self, service_name: str) -> Union[CountWindow, TimeWindow]:
+        return self._service(service_name).window
+
+    def _set_state(self, service_name: str, s: _ServiceState, state: CircuitBreakerState):
+        old, s.state = s.state, state
+        for listener in self.listeners + self.state_listeners:
+            listener(service_name, old, state)
+
+    def _open(self, service_name: str, s: _ServiceState):
+        print(f'[CB] opening service {service_name}')
+        self._set_state(service_name, s, CircuitBreakerState.OPENED)
+        s.opened_at = time.monotonic()
+
+    def _close(self, service_name: str, s: _ServiceState):
+        print(f'[CB] closing service {service_name}')
+        self._set_state(service_name, s, CircuitBreakerState.CLOSED)
+        s.window.reset()
 
     def get_combo_state(self, service_names: list[str]) -> CircuitBreakerState:
         ret = CircuitBreakerState.CLOSED
@@ -65,38 +136,59 @@ class CircuitBreaker:
         return ret
 
     def get_state(self, service_name: str) -> CircuitBreakerState:
-        if self.closed_at_sec[service_name] is not None:
-            if time.time() - self.closed_at_sec[service_name] >= self.half_open_threshold_sec:
+        s = self._service(service_name)
+        if s.state == CircuitBreakerState.OPENED:
+            if time.monotonic() - s.opened_at >= self.half_open_threshold_sec:
                 print('[CB] trying to close')
-                self.closed_at_sec[service_name] = int((time.time() + self.closed_at_sec[service_name]) / 2)
-                return CircuitBreakerState.HALF_OPENED
-            else:
+                self._set_state(service_name, s, CircuitBreakerState.HALF_OPENED)
+                s.probes_in_flight = 0
+                s.probe_successes = 0
+        elif s.state == CircuitBreakerState.CLOSED and self.should_open(service_name):
+            self._open(service_name, s)
+        return s.state
+
+    def try_acquire(self, service_name: str) -> CircuitBreakerState:
+        state = self.get_state(service_name)
+        if state == CircuitBreakerState.HALF_OPENED:
+            s = self._service(service_name)
+            if s.probes_in_flight >= self.half_open_probes:
                 return CircuitBreakerState.OPENED
-        if len(self.req_success) >= self.store_limit:
-            self.req_success[service_name] = self.req_success[service_name][-self.store_limit:]
-            self.req_times[service_name] = self.req_times[service_name][-self.store_limit:]
+            s.probes_in_flight += 1
+        return state
 
-        if (not self.check_req_time_closed(service_name)
-                or not self.check_req_success_closed(service_name)):
-            print(f'[CB] opening service {service_name}')
-            self.closed_at_sec[service_name] = int(time.time())
-            return CircuitBreakerState.OPENED
-        return CircuitBreakerState.CLOSED
+    def should_open(self, service_name: str) -> bool:
+        window = self.window(service_name)
+        if isinstance(window, TimeWindow):
+            window.advance()
+        return any(p.should_open(window) for p in self.policies)
 
     def check_req_success_closed(self, service_name: str) -> bool:
-        if len(self.req_success[service_name]) == 0:
-            return True
-        return (len(list(filter(lambda x: x, self.req_success[service_name]))) /
-                len(self.req_success[service_name]) > self.error_rate / 100)
+        window = self.window(service_name)
+        return not any(p.should_open(window) for p in self.policies if isinstance(p, FailureRatePolicy))
 
     def check_req_time_closed(self, service_name: str) -> bool:
-        if len(self.req_times[service_name]) == 0:
-            return True
-        return sum(self.req_times[service_name]) / len(self.req_times[service_name]) < self.time_threshold_sec
-
-    def observe(self, service_name: str, req_time_sec: int, was_success: bool):
-        self.req_times[service_name].append(req_time_sec)
-        self.req_success[service_name].append(was_success)
+        window = self.window(service_name)
+        return not any(p.should_open(window) for p in self.policies if not isinstance(p, FailureRatePolicy))
+
+    def release(self, service_name: str, probe: bool = False):
+        if probe:
+            s = self._service(service_name)
+            s.probes_in_flight = max(0, s.probes_in_flight - 1)
+
+    def observe(self, service_name: str, req_time_sec: float, was_success: bool, probe: bool = False):
+        s = self._service(service_name)
+        if probe:
+            s.probes_in_flight = max(0, s.probes_in_flight - 1)
+            if s.state != CircuitBreakerState.HALF_OPENED:
+                return
+            if not was_success:
+                self._open(service_name, s)
+                return
+            s.probe_successes += 1
+            if s.probe_successes >= self.half_open_probes:
+                self._close(service_name, s)
+            return
+        s.window.add(req_time_sec, was_success)
 
 
 @dataclass
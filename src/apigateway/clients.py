@@ -0,0 +1,212 @@
+from __future__ import annotations
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+import deadline
+import fastjson
+import metrics
+from adaptive import LatencyTracker, HedgeBudget
+from metrics import downstream_trace_config
+
+
+@dataclass
+class ServiceConfig:
+    name: str
+    base_url: str
+    conn_limit: int = 100
+    conn_limit_per_host: int = 0
+    keepalive_timeout_sec: float = 30.0
+    dns_cache_ttl_sec: int = 300
+    connect_timeout_sec: float = 1.0
+    total_timeout_sec: float = 10.0
+    # GETs time out after timeout_multiplier x the observed timeout_quantile, within
+    # [min_timeout_sec, total_timeout_sec]; a multiplier of 0 keeps the static timeout
+    timeout_quantile: float = 0.99
+    timeout_multiplier: float = 3.0
+    min_timeout_sec: float = 0.25
+    # a hedged GET sends a second request once the first outlived this quantile, 0 disables
+    hedge_quantile: float = 0.95
+
+    @classmethod
+    def from_env(cls, name: str, default_base_url: str) -> ServiceConfig:
+        prefix = name.upper()
+
+        def env(key: str, default):
+            return type(default)(os.environ.get(f'{prefix}_{key}', default))
+
+        return cls(name=name,
+                   base_url=os.environ.get(f'{prefix}_BASEURL', default_base_url),
+                   conn_limit=env('CONN_LIMIT', cls.conn_limit),
+                   conn_limit_per_host=env('CONN_LIMIT_PER_HOST', cls.conn_limit_per_host),
+                   keepalive_timeout_sec=env('KEEPALIVE_SEC', cls.keepalive_timeout_sec),
+                   dns_cache_ttl_sec=env('DNS_CACHE_TTL_SEC', cls.dns_cache_ttl_sec),
+                   connect_timeout_sec=env('CONNECT_TIMEOUT_SEC', cls.connect_timeout_sec),
+                   total_timeout_sec=env('TIMEOUT_SEC', cls.total_timeout_sec),
+                   timeout_quantile=env('TIMEOUT_QUANTILE', cls.timeout_quantile),
+                   timeout_multiplier=env('TIMEOUT_MULTIPLIER', cls.timeout_multiplier),
+                   min_timeout_sec=env('MIN_TIMEOUT_SEC', cls.min_timeout_sec),
+                   hedge_quantile=env('HEDGE_QUANTILE', cls.hedge_quantile))
+
+
+@dataclass
+class DownstreamError(Exception):
+    service_name: str
+    status: int
+    body: bytes = b''
+
+
+@dataclass
+class BufferedResponse:
+    status: int
+    body: bytes
+    content_type: str
+    headers: dict[str, str]
+
+    def json(self):
+        return fastjson.loads(self.body)
+
+    def to_response(self) -> web.Response:
+        return web.Response(status=self.status, body=self.body, content_type=self.content_type)
+
+
+@dataclass
+class ServiceClients:
+    configs: dict[str, ServiceConfig]
+    sessions: dict[str, aiohttp.ClientSession] = field(default_factory=dict)
+    latency: LatencyTracker = field(default_factory=LatencyTracker.from_env)
+    hedge_budget: HedgeBudget = field(default_factory=HedgeBudget.from_env)
+
+    def _create_session(self, config: ServiceConfig) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit=config.conn_limit,
+                                         limit_per_host=config.conn_limit_per_host,
+                                         keepalive_timeout=config.keepalive_timeout_sec,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=config.dns_cache_ttl_sec)
+        timeout = aiohttp.ClientTimeout(total=config.total_timeout_sec,
+                                        connect=config.connect_timeout_sec)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, json_serialize=fastjson.dumps_str,
+                                     trace_configs=[downstream_trace_config(config.name),
+                                                    self.latency.trace_config(config.name)])
+
+    async def start(self, app: Optional[web.Application] = None):
+        for name, config in self.configs.items():
+            if name not in self.sessions:
+                self.sessions[name] = self._create_session(config)
+
+    async def close(self, app: Optional[web.Application] = None):
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+    def session(self, service_name: str) -> aiohttp.ClientSession:
+        session = self.sessions.get(service_name)
+        if session is None or session.closed:
+            session = self._create_session(self.configs[service_name])
+            self.sessions[service_name] = session
+        return session
+
+    def url(self, service_name: str, path: str) -> str:
+        return self.configs[service_name].base_url + path
+
+    def timeout_for(self, service_name: str, method: str) -> float:
+        config = self.configs[service_name]
+        # writes keep the static timeout: cutting one short can leave a booking half-done
+        if method != 'GET' or config.timeout_multiplier <= 0:
+            return config.total_timeout_sec
+        observed = self.latency.quantile(service_name, method, config.timeout_quantile)
+        if observed is None:
+            return config.total_timeout_sec
+        timeout_sec = min(config.total_timeout_sec, max(config.min_timeout_sec, observed * config.timeout_multiplier))
+        metrics.DOWNSTREAM_TIMEOUT.labels(service_name).set(timeout_sec)
+        return timeout_sec
+
+    def request(self, service_name: str, method: str, path: str, **kwargs):
+        config = self.configs[service_name]
+        timeout_sec = deadline.call_timeout(self.timeout_for(service_name, method))
+        kwargs['headers'] = {**(kwargs.get('headers') or {}), deadline.TIMEOUT_HEADER: str(int(timeout_sec * 1000))}
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(total=timeout_sec, connect=config.connect_timeout_sec))
+        return self.session(service_name).request(method, self.url(service_name, path), **kwargs)
+
+    def get(self, service_name: str, path: str, **kwargs):
+        return self.request(service_name, 'GET', path, **kwargs)
+
+    def post(self, service_name: str, path: str, **kwargs):
+        return self.request(service_name, 'POST', path, **kwargs)
+
+    def delete(self, service_name: str, path: str, **kwargs):
+        return self.request(service_name, 'DELETE', path, **kwargs)
+
+    async def open_stream(self, service_name: str, path: str, **kwargs) -> aiohttp.ClientResponse:
+        # a streamed body can rightly outlive any total timeout: the adaptive GET timeout only
+        # bounds the wait for response headers, after that each read gets the static timeout
+        config = self.configs[service_name]
+        headers_timeout_sec = deadline.call_timeout(self.timeout_for(service_name, 'GET'))
+        kwargs['headers'] = {**(kwargs.get('headers') or {}),
+                             deadline.TIMEOUT_HEADER: str(int(deadline.call_timeout(config.total_timeout_sec) * 1000))}
+        kwargs['timeout'] = aiohttp.ClientTimeout(total=None, connect=config.connect_timeout_sec,
+                                                  sock_read=config.total_timeout_sec)
+        request = self.session(service_name).get(self.url(service_name, path), **kwargs)
+        return await asyncio.wait_for(request, headers_timeout_sec)
+
+    async def fetch(self, service_name: str, method: str, path: str, **kwargs) -> BufferedResponse:
+        async with self.request(service_name, method, path, **kwargs) as resp:
+            return BufferedResponse(resp.status, await resp.read(), resp.content_type, dict(resp.headers))
+
+    async def hedged_get(self, service_name: str, path: str, **kwargs) -> BufferedResponse:
+        config = self.configs[service_name]
+        self.hedge_budget.earn(service_name)
+        delay = None
+        if config.hedge_quantile > 0:
+            delay = self.latency.quantile(service_name, 'GET', config.hedge_quantile)
+        tasks = [asyncio.create_task(self.fetch(service_name, 'GET', path, **kwargs))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if self.hedge_budget.try_spend(service_name):
+                        metrics.HEDGES.labels(service_name, 'sent').inc()
+                        tasks.append(asyncio.create_task(self.fetch(service_name, 'GET', path, **kwargs)))
+                    else:
+                        metrics.HEDGES.labels(service_name, 'denied').inc()
+            return await self._first_answer(service_name, tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    @staticmethod
+    async def _first_answer(service_name: str, tasks: list[asyncio.Task]) -> BufferedResponse:
+        # the first non-5xx answer wins; otherwise the last failure is what the caller sees
+        failed: Optional[BufferedResponse] = None
+        error: Optional[BaseException] = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    res = task.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if res.status < 500:
+                    if task is not tasks[0]:
+                        metrics.HEDGES.labels(service_name, 'won').inc()
+                    return res
+                failed = res
+        if failed is not None:
+            return failed
+        raise error
+
+
+clients = ServiceClients({
+    'flight': ServiceConfig.from_env('flight', 'http://0.0.0.0:8060/api/v1'),
+    'ticket': ServiceConfig.from_env('ticket', 'http://0.0.0.0:8070/api/v1'),
+    'bonus': ServiceConfig.from_env('bonus', 'http://0.0.0.0:8080/api/v1'),
+})
@@ -1,33 +1,142 @@
+from __future__ import annotations
+import asyncio
 import os
-from typing import Optional
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
 
+import aiopg
 import psycopg2
-import psycopg2.extensions
-
-import psycopg2.pool
-
-db_pool: Optional[psycopg2.pool.SimpleConnectionPool] = None
-
-
-class db_conn:
-    def __enter__(self) -> psycopg2.extensions.connection:
-        global db_pool
-        if db_pool is None:
-            db_username = os.environ.get('PSQL_USER', 'postgres')
-            db_password = os.environ.get('PSQL_PASSWORD', 'pass')
-            db_hostname = os.environ.get('PSQL_HOST', '127.0.0.1')
-            db_name = os.environ.get('PSQL_NAME', 'postgres')
-            db_port = os.environ.get('PSQL_PORT', 15432)
-            db_pool = psycopg2.pool.SimpleConnectionPool(maxconn=16,
-                                                         minconn=2,
-                                                         database=db_name,
-                                                         user=db_username,
-                                                         password=db_password,
-                                                         host=db_hostname,
-                                                         port=db_port)
-
-        self._con = db_pool.getconn()
-        return self._con
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        db_pool.putconn(self._con)
+
+import metrics
+
+
+class DbUnavailable(Exception):
+    pass
+
+
+class DbPool:
+    dsn: str
+    min_size: int = 1
+    max_size: int = 16
+    acquire_timeout_sec: float = 2.0
+    health_check_idle_sec: float = 30.0
+    recycle_sec: float = 600.0
+
+    def __init__(self, dsn: str, min_size=1, max_size=16, acquire_timeout_sec=2.0, health_check_idle_sec=30.0,
+                 recycle_sec=600.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout_sec = acquire_timeout_sec
+        self.health_check_idle_sec = health_check_idle_sec
+        self.recycle_sec = recycle_sec
+        self.schema: list[str] = []
+        self._pool: Optional[aiopg.Pool] = None
+        self._starting: Optional[asyncio.Lock] = None
+        self._released_at: weakref.WeakKeyDictionary[aiopg.Connection, float] = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_env(cls) -> DbPool:
+        dsn = (f"dbname={os.environ.get('PSQL_NAME', 'postgres')} "
+               f"user={os.environ.get('PSQL_USER', 'postgres')} "
+               f"password={os.environ.get('PSQL_PASSWORD', 'pass')} "
+               f"host={os.environ.get('PSQL_HOST', '127.0.0.1')} "
+               f"port={os.environ.get('PSQL_PORT', 15432)}")
+        return cls(dsn,
+                   min_size=int(os.environ.get('PSQL_POOL_MIN', 1)),
+                   max_size=int(os.environ.get('PSQL_POOL_MAX', 16)),
+                   acquire_timeout_sec=float(os.environ.get('PSQL_ACQUIRE_TIMEOUT_SEC', 2.0)),
+                   health_check_idle_sec=float(os.environ.get('PSQL_HEALTH_CHECK_IDLE_SEC', 30.0)),
+                   recycle_sec=float(os.environ.get('PSQL_RECYCLE_SEC', 600.0)))
+
+    def register_schema(self, ddl: str):
+        # run once on the first connection, so a backend never has to be opened explicitly
+        self.schema.append(ddl)
+
+    async def _start(self) -> aiopg.Pool:
+        if self._pool is not None:
+            return self._pool
+        if self._starting is None:
+            self._starting = asyncio.Lock()
+        async with self._starting:
+            if self._pool is not None:
+                return self._pool
+            try:
+                pool = await asyncio.wait_for(
+                    aiopg.create_pool(self.dsn, minsize=self.min_size, maxsize=self.max_size,
+                                      pool_recycle=self.recycle_sec),
+                    self.acquire_timeout_sec)
+            except (asyncio.TimeoutError, psycopg2.Error, OSError) as e:
+                raise DbUnavailable(f'cannot connect: {e!r}') from e
+            try:
+                async with pool.acquire() as conn:
+                    async with conn.cursor() as cur:
+                        for ddl in self.schema:
+                            await cur.execute(ddl)
+            except BaseException:
+                pool.close()
+                await pool.wait_closed()
+                raise
+            print(f'[DB] pool started, {self.min_size}..{self.max_size} connections')
+            self._pool = pool
+            return pool
+
+    async def _healthy(self, conn: aiopg.Connection) -> bool:
+        if conn.closed:
+            return False
+        released_at = self._released_at.get(conn)
+        if released_at is None or time.monotonic() - released_at < self.health_check_idle_sec:
+            return True
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT 1;')
+        except psycopg2.Error:
+            metrics.DB_HEALTH_CHECKS.labels('failed').inc()
+            return False
+        metrics.DB_HEALTH_CHECKS.labels('ok').inc()
+        return True
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiopg.Connection]:
+        pool = await self._start()
+        t = time.perf_counter()
+        # an idle connection that fails its check is dropped and replaced once
+        for attempt in range(2):
+            try:
+                left = max(0.0, self.acquire_timeout_sec - (time.perf_counter() - t))
+                conn = await asyncio.wait_for(pool.acquire(), left)
+            except asyncio.TimeoutError:
+                metrics.DB_ACQUIRE_TIMEOUTS.inc()
+                raise DbUnavailable(f'no connection within {self.acquire_timeout_sec}s')
+            except psycopg2.Error as e:
+                raise DbUnavailable(f'cannot connect: {e!r}') from e
+            if await self._healthy(conn):
+                break
+            conn.close()
+            await pool.release(conn)
+        else:
+            raise DbUnavailable('no healthy connection')
+        metrics.DB_ACQUIRE_LATENCY.observe(time.perf_counter() - t)
+        try:
+            yield conn
+        finally:
+            self._released_at[conn] = time.monotonic()
+            await pool.release(conn)
+
+    async def close(self, app=None):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    def size(self) -> int:
+        return self._pool.size if self._pool is not None else 0
+
+    def freesize(self) -> int:
+        return self._pool.freesize if self._pool is not None else 0
+
+
+pool = DbPool.from_env()
+metrics.instrument_db_pool(pool)
@@ -0,0 +1,75 @@
+import asyncio
+import contextvars
+import os
+import time
+from typing import Optional
+
+from aiohttp import web
+from aiohttp.web_middlewares import middleware
+
+TIMEOUT_HEADER = 'X-Request-Timeout-Ms'
+
+default_timeout_sec = float(os.environ.get('REQUEST_TIMEOUT_SEC', 10))
+# a client may ask for less than the default budget, but never for less than this
+min_client_timeout_sec = float(os.environ.get('REQUEST_MIN_TIMEOUT_SEC', 1.0))
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('deadline', default=None)
+_shortened: contextvars.ContextVar[bool] = contextvars.ContextVar('deadline_shortened', default=False)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def call_timeout(timeout_sec: float) -> float:
+    left = remaining()
+    if left is None:
+        return timeout_sec
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(timeout_sec, left)
+
+
+def lift():
+    # for a response already under way: its status is sent, so running out of the request budget
+    # could only truncate it; what follows is bounded by each downstream call's own timeout
+    _deadline.set(None)
+    _shortened.set(False)
+
+
+def budget_spent(exc: BaseException) -> bool:
+    # True when `exc` is the request running out of its own budget rather than a downstream
+    # being slow; the gateway's default budget covers any single call, so only a budget the
+    # client shortened can cut a call short
+    if isinstance(exc, DeadlineExceeded):
+        return True
+    if not isinstance(exc, asyncio.TimeoutError) or not _shortened.get():
+        return False
+    left = remaining()
+    return left is not None and left <= 0.001
+
+
+@middleware
+async def deadline_middleware(req: web.Request, handler):
+    timeout_sec = default_timeout_sec
+    if TIMEOUT_HEADER in req.headers:
+        try:
+            requested_sec = max(min_client_timeout_sec, int(req.headers[TIMEOUT_HEADER]) / 1000)
+            timeout_sec = min(timeout_sec, requested_sec)
+        except ValueError:
+            pass
+    token = _deadline.set(time.monotonic() + timeout_sec)
+    shortened_token = _shortened.set(timeout_sec < default_timeout_sec)
+    try:
+        return await handler(req)
+    except asyncio.TimeoutError:
+        return web.Response(status=504, text='Request deadline exceeded')
+    finally:
+        _shortened.reset(shortened_token)
+        _deadline.reset(token)
@@ -1,6 +1,7 @@
 from aiohttp import web
 from aiohttp.web_middlewares import middleware
 
+from clients import DownstreamError
 from schema import ErrorResponse
 
 
@@ -10,3 +11,5 @@ async def exc_handler(req: web.Request, handler):
         return await handler(req)
     except ErrorResponse as e:
         return e
+    except DownstreamError as e:
+        return web.Response(status=e.status, body=e.body)
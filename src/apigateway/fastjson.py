@@ -0,0 +1,19 @@
+from typing import Any, Optional
+
+import orjson
+from aiohttp import web
+
+loads = orjson.loads
+
+
+def dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj)
+
+
+def dumps_str(obj: Any) -> str:
+    # for aiohttp's json_serialize hook, which wants str
+    return orjson.dumps(obj).decode()
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[dict] = None) -> web.Response:
+    return web.Response(body=orjson.dumps(data), status=status, headers=headers, content_type='application/json')
@@ -1,49 +1,90 @@
 import asyncio
 import os
 import time
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 import aiohttp
 from aiohttp import web
 import aiohttp.web_exceptions
 
-from circuit_breaker import CircuitBreaker
+from cache import AsyncTTLCache
+from cb_shared import SharedCircuitBreaker
+from circuit_breaker import CircuitBreaker, ServiceError
+from clients import clients, DownstreamError, BufferedResponse
+import deadline
+import fastjson
+from fastjson import json_response
+from idempotency import IdempotencyStore, IdempotencyKeyReused, IdempotencyKeyInFlight, IDEMPOTENCY_HEADER, fingerprint
+import metrics
+import prefork
+from retry_queue import RetryQueue
 from route import routes
+from schema import ErrorResponse
+from singleflight import SingleFlight
 
 
-cb = CircuitBreaker()
-retry_coros = []
+# with several workers the breaker state lives in memory shared by all of them
+cb = SharedCircuitBreaker.from_env() if prefork.workers > 1 else CircuitBreaker.from_env()
+retry_queue = RetryQueue.from_env(cb)
+flight_cache = AsyncTTLCache.from_env('flight', max_size=4096, ttl_sec=300.0)
+flights_page_cache = AsyncTTLCache.from_env('flights_page', max_size=256, ttl_sec=10.0)
+idempotency = IdempotencyStore.from_env()
+reads = SingleFlight('reads')
 
+cb.listeners.append(metrics.count_transition)
+cb.state_listeners.append(metrics.observe_state)
+metrics.register_caches(flight_cache, flights_page_cache)
 
-async def get_flight_by_number(flight_number: str) -> dict:
-    with cb.guard('flight'):
-        flight_baseurl = os.environ.get('FLIGHT_BASEURL', 'http://0.0.0.0:8060/api/v1')
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{flight_baseurl}/flight/{flight_number}') as resp:
-                return await resp.json()
 
+async def shared_get(service: str, path: str, user_name: str, params: Optional[dict] = None) -> BufferedResponse:
+    params = params or {}
 
-@routes.get('/flights')
-async def get_flights(request: web.Request):
-    page = int(request.rel_url.query.get('page'))
-    size = int(request.rel_url.query.get('size'))
+    async def load() -> BufferedResponse:
+        with cb.guard(service):
+            resp = await clients.hedged_get(service, path, headers={'X-User-Name': user_name}, params=params)
+            if resp.status >= 500:
+                raise ServiceError(service)
+        return resp
+
+    return await reads.do((service, path, user_name, tuple(sorted(params.items()))), load)
+
+
+async def load_flights(flight_numbers: list[str]) -> dict[str, dict]:
     with cb.guard('flight'):
-        flight_baseurl = os.environ.get('FLIGHT_BASEURL', 'http://0.0.0.0:8060/api/v1')
-        async with aiohttp.ClientSession() as session:
-            u = f'{flight_baseurl}/flights'
-            if page is not None or size is not None:
-                u += '?'
-            if page is not None:
-                u += f'page={page - 1}'
-                if size is not None:
-                    u += '&'
-            if size is not None:
-                u += f'size={size}'
-
-            async with session.get(u) as resp:
-                flights = await resp.json()
+        resp = await clients.hedged_get('flight', '/flights/batch', params={'numbers': ','.join(sorted(flight_numbers))})
+        if resp.status >= 500:
+            raise ServiceError('flight')
+    # a rejected lookup fails this request only, exc_handler answers with its status
+    if resp.status != 200:
+        raise DownstreamError('flight', resp.status, resp.body)
+    return {f['flightNumber']: f for f in resp.json()}
+
+
+# what a flight lookup raises when flight_service fails, times out or its breaker is open;
+# the calls that did go out are already counted against the breaker by its guard
+FLIGHT_UNAVAILABLE = (ServiceError, aiohttp.ClientError, asyncio.TimeoutError,
+                      aiohttp.web_exceptions.HTTPInternalServerError)
+
+
+async def get_flights_by_numbers(flight_numbers) -> dict[str, dict]:
+    flight_numbers = set(flight_numbers)
+    if len(flight_numbers) == 0:
+        return {}
+    try:
+        return await flight_cache.get_many_or_load(flight_numbers, load_flights)
+    except Exception:
+        stale = {n: flight_cache.get_stale(n) for n in flight_numbers}
+        if any(f is None for f in stale.values()):
+            raise
+        return stale
+
+
+async def get_flight_by_number(flight_number: str) -> Optional[dict]:
+    return (await get_flights_by_numbers([flight_number])).get(flight_number)
+
 
+def encode_flights_page(flights: dict) -> bytes:
     dat = flights.copy()
     dat['items'] = []
     for f in flights['items']:
@@ -54,8 +95,100 @@ async def get_flights(request: web.Request):
             "date": f['date'],
             "price": f['price'],
         })
+    return fastjson.dumps(dat)
 
-    return aiohttp.web.json_response(dat)
+
+def query_int(query, name: str, minimum: int) -> Optional[int]:
+    if name not in query:
+        return None
+    try:
+        value = int(query[name])
+    except ValueError:
+        value = None
+    if value is None or value < minimum:
+        raise ErrorResponse(400, f'{name} must be an integer not less than {minimum}')
+    return value
+
+
+@routes.get('/flights')
+async def get_flights(request: web.Request):
+    query = request.rel_url.query
+    params = {}
+    # pages are numbered from 1 here and from 0 in flight_service
+    page = query_int(query, 'page', 1)
+    if page is not None:
+        params['page'] = page - 1
+    size = query_int(query, 'size', 1)
+    if size is not None:
+        params['size'] = size
+    if 'after' in query:
+        params['after'] = query['after']
+    async def load_page(key):
+        with cb.guard('flight'):
+            resp = await clients.hedged_get('flight', '/flights', params=params)
+            if resp.status >= 500:
+                raise ServiceError('flight')
+            if resp.status == 200:
+                return encode_flights_page(resp.json())
+        raise DownstreamError('flight', resp.status, resp.body)
+
+    # the cache holds the encoded public page, so hits are served without touching json at all
+    key = tuple(sorted(params.items()))
+    try:
+        body = await flights_page_cache.get_or_load(key, load_page)
+    except DownstreamError as e:
+        return aiohttp.web.Response(status=e.status, body=e.body)
+    except Exception:
+        body = flights_page_cache.get_stale(key)
+        if body is None:
+            raise
+
+    return aiohttp.web.Response(body=body, content_type='application/json')
+
+
+NDJSON = 'application/x-ndjson'
+tickets_stream_batch_size = int(os.environ.get('TICKETS_STREAM_BATCH_SIZE', 100))
+
+
+def ticket_item(t: dict, flights: dict[str, dict]) -> dict:
+    flight_number = t['flight_number']
+    flight_data = flights.get(flight_number, {})
+    return {
+        "ticketUid": t['ticket_uid'],
+        "status": t['status'],
+        'flightNumber': flight_number,
+        'fromAirport': flight_data.get('fromAirport'),
+        'toAirport': flight_data.get('toAirport'),
+        'date': flight_data.get('date'),
+        'price': t['price']
+    }
+
+
+async def read_ticket_batches(content: aiohttp.StreamReader, batch_size: int):
+    batch = []
+    async for line in content:
+        if line.strip():
+            batch.append(fastjson.loads(line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def get_tickets_page(request: web.Request, headers: dict):
+    params = {k: request.query[k] for k in ('size', 'after') if k in request.query}
+    resp = await shared_get('ticket', '/tickets', headers['X-User-Name'], params)
+    if resp.status != 200:
+        return resp.to_response()
+    tickets: list = resp.json()
+    next_cursor = resp.headers.get('X-Next-Cursor')
+
+    flights = await get_flights_by_numbers(t['flight_number'] for t in tickets)
+    res = json_response([ticket_item(t, flights) for t in tickets])
+    if next_cursor is not None:
+        res.headers['X-Next-Cursor'] = next_cursor
+    return res
 
 
 @routes.get('/tickets')
@@ -66,43 +199,56 @@ async def get_tickets(request: web.Request):
         headers['X-User-Name'] = user_name
     else:
         return aiohttp.web.Response(status=400)
-    with cb.guard('ticket'):
-        ticket_baseurl = os.environ.get('TICKET_BASEURL', 'http://0.0.0.0:8070/api/v1')
-        async with aiohttp.ClientSession(headers=headers) as session:
-            u = f'{ticket_baseurl}/tickets'
-            async with session.get(u) as resp:
-                tickets: dict = await resp.json()
-
-    dat = []
-    for t in tickets:
-        flight_number = t['flight_number']
-        flight_data = await get_flight_by_number(flight_number)
-        dat.append({
-            "ticketUid": t['ticket_uid'],
-            "status": t['status'],
-            'flightNumber': flight_number,
-            'fromAirport': flight_data['fromAirport'],
-            'toAirport': flight_data['toAirport'],
-            'date': flight_data['date'],
-            'price': t['price']
-        })
+    if 'size' in request.query or 'after' in request.query:
+        return await get_tickets_page(request, headers)
 
-    return aiohttp.web.json_response(dat)
+    # Tickets are pulled from ticket_service as NDJSON and forwarded batch by batch,
+    # either as NDJSON or as one chunked JSON array, so a heavy user never sits in memory whole.
+    # Only opening the stream counts for the breaker: long streams are not slow calls.
+    with cb.guard('ticket'):
+        upstream = await clients.open_stream('ticket', '/tickets', headers={**headers, 'Accept': NDJSON})
+        if upstream.status != 200:
+            upstream.release()
+            raise ServiceError('ticket')
+
+    ndjson = NDJSON in request.headers.get('Accept', '')
+    res = web.StreamResponse(headers={'Content-Type': NDJSON if ndjson else 'application/json'})
+    await res.prepare(request)
+    # a long stream outlives the request budget, each batch's flight lookup keeps its own timeout
+    deadline.lift()
+    empty = True
+    try:
+        async with upstream:
+            async for tickets in read_ticket_batches(upstream.content, tickets_stream_batch_size):
+                try:
+                    flights = await get_flights_by_numbers(t['flight_number'] for t in tickets)
+                except FLIGHT_UNAVAILABLE as e:
+                    # tickets are still worth sending without their flight details
+                    print(f'[TICKETS] flights unavailable for a batch of {user_name}: {e!r}')
+                    flights = {}
+                items = [fastjson.dumps(ticket_item(t, flights)) for t in tickets]
+                if ndjson:
+                    await res.write(b''.join(item + b'\n' for item in items))
+                else:
+                    await res.write((b'[' if empty else b',') + b','.join(items))
+                empty = False
+    except Exception as e:
+        # the status line is already sent: fail the stream so the client sees a broken body
+        print(f'[TICKETS] stream for {user_name} interrupted: {e!r}')
+        raise ServiceError('ticket') from e
+    if not ndjson:
+        await res.write(b'[]' if empty else b']')
+    await res.write_eof()
+    return res
 
 
 @routes.get('/privilege')
 async def get_privilege(request: web.Request):
     user_name = request.headers.get('X-User-Name')
-    headers = {}
-    if user_name is not None:
-        headers['X-User-Name'] = user_name
-    else:
+    if user_name is None:
         return aiohttp.web.Response(status=400)
-    with cb.guard('bonus'):
-        bonus_baseurl = os.environ.get('BONUS_BASEURL', 'http://0.0.0.0:8080/api/v1')
-        async with aiohttp.ClientSession(headers={'X-User-Name': user_name}) as session:
-            async with session.get(f'{bonus_baseurl}/privilege') as resp:
-                return web.json_response(await resp.json())
+    params = {k: request.query[k] for k in ('history', 'historyLimit', 'after') if k in request.query}
+    return (await shared_get('bonus', '/privilege', user_name, params)).to_response()
 
 
 @routes.get('/me')
@@ -111,44 +257,27 @@ async def get_me(request: web.Request):
     if user_name is None:
         raise aiohttp.web_exceptions.HTTPBadRequest()
 
-    headers = {}
-    if user_name is not None:
-        headers['X-User-Name'] = user_name
-    try:
-        with cb.guard('ticket'):
-            ticket_baseurl = os.environ.get('TICKET_BASEURL', 'http://0.0.0.0:8070/api/v1')
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.get(f'{ticket_baseurl}/tickets') as resp:
-                    tickets = await resp.json()
-    except:
-        tickets = []
-
-    try:
-        with cb.guard('bonus'):
-            bonus_baseurl = os.environ.get('BONUS_BASEURL', 'http://0.0.0.0:8080/api/v1')
-            async with aiohttp.ClientSession(headers={'X-User-Name': user_name}) as session:
-                async with session.get(f'{bonus_baseurl}/privilege') as resp:
-                    dat = await resp.json()
-                    privilege_data = {
-                        "balance": dat['balance'],
-                        "status": dat['status']
-                    }
-    except:
-        privilege_data = None
-
-    dat = []
-    for t in tickets:
-        flight_data = await get_flight_by_number(t['flight_number'])
-        dat.append({
-            "ticketUid": t['ticket_uid'],
-            "flightNumber": t['flight_number'],
-            'fromAirport': flight_data['fromAirport'],
-            'toAirport': flight_data['toAirport'],
-            'date': flight_data['date'],
-            "price": t['price'],
-            "status": t['status']
-        })
-    return aiohttp.web.json_response({
+    async def load_tickets() -> list:
+        try:
+            tickets = (await shared_get('ticket', '/tickets', user_name)).json()
+        except Exception:
+            return []
+
+        flights = await get_flights_by_numbers(t['flight_number'] for t in tickets)
+        return [ticket_item(t, flights) for t in tickets]
+
+    async def load_privilege() -> Optional[dict]:
+        try:
+            dat = (await shared_get('bonus', '/privilege/balance', user_name)).json()
+            return {
+                "balance": dat['balance'],
+                "status": dat['status']
+            }
+        except Exception:
+            return None
+
+    dat, privilege_data = await asyncio.gather(load_tickets(), load_privilege())
+    return json_response({
         'tickets': dat,
         'privilege': privilege_data
     })
@@ -159,7 +288,21 @@ async def post_ticket(request: web.Request):
     if 'X-User-Name' not in request.headers.keys():
         return aiohttp.web.Response(status=400)
     user_name = request.headers['X-User-Name']
-    dat = await request.json()
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return await create_ticket(request, user_name)
+    body = await request.read()
+    try:
+        return await idempotency.run(f'{user_name}:{key}', fingerprint(user_name.encode(), body),
+                                     lambda: create_ticket(request, user_name))
+    except IdempotencyKeyReused:
+        return aiohttp.web.Response(status=422, text=f'{IDEMPOTENCY_HEADER} was already used for another request')
+    except IdempotencyKeyInFlight:
+        return aiohttp.web.Response(status=409, text=f'A request with this {IDEMPOTENCY_HEADER} is still in progress')
+
+
+async def create_ticket(request: web.Request, user_name: str) -> web.Response:
+    dat = await request.json(loads=fastjson.loads)
     if 'flightNumber' not in dat.keys():
         return aiohttp.web.Response(status=400)
     if 'price' not in dat.keys():
@@ -170,62 +313,38 @@ async def post_ticket(request: web.Request):
     price = dat['price']
     paid_from_balance = dat['paidFromBalance']
 
-    with cb.guard('flight'):
-        flight_baseurl = os.environ.get('FLIGHT_BASEURL', 'http://0.0.0.0:8060/api/v1')
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{flight_baseurl}/flight/{flight_number}') as resp:
-                if resp.status != 200:
-                    return aiohttp.web.Response(status=resp.status)
-                flight_info = await resp.json()
+    headers = {'X-User-Name': user_name}
+
+    flight_info = await get_flight_by_number(flight_number)
+    if flight_info is None:
+        return aiohttp.web.Response(status=404)
 
     with cb.guard('ticket'):
-        ticket_baseurl = os.environ.get('TICKET_BASEURL', 'http://0.0.0.0:8070/api/v1')
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{ticket_baseurl}/ticket', json=dat, headers={'X-User-Name': user_name}) as resp:
-                ticket = await resp.json()
+        async with clients.post('ticket', '/ticket', json=dat, headers=headers) as resp:
+            ticket = await resp.json(loads=fastjson.loads)
     ticket_uid = ticket['ticketUid']
 
-    with cb.guard('bonus'):
-        bonus_baseurl = os.environ.get('BONUS_BASEURL', 'http://0.0.0.0:8080/api/v1')
-        async with aiohttp.ClientSession(headers={'X-User-Name': user_name}) as session:
-            async with session.get(f'{bonus_baseurl}/privilege') as resp:
-                privilege_data = await resp.json()
-
-    priv_balance = privilege_data['balance']
-
-    paid_bonuses = 0
-    paid_money = price
-    operation = 'FILL_IN_BALANCE'
-    operation_price = price
-
-    if paid_from_balance:
-        paid_bonuses = min(priv_balance, price)
-        paid_money -= paid_bonuses
-        operation = 'DEBIT_THE_ACCOUNT'
-        operation_price = paid_bonuses
-
-    with cb.guard('bonus'):
-        async with aiohttp.ClientSession(headers={'X-User-Name': user_name}) as session:
-            async with session.post(f'{bonus_baseurl}/privilege', json={
-                'operationType': operation,
-                'price': operation_price,
+    try:
+        with cb.guard('bonus'):
+            async with clients.post('bonus', '/privilege', headers=headers, json={
+                'operationType': 'DEBIT_THE_ACCOUNT' if paid_from_balance else 'FILL_IN_BALANCE',
+                'price': price,
                 'ticket_uid': str(ticket_uid)
             }) as resp:
                 if resp.status >= 500:
-                    raise aiohttp.web_exceptions.HTTPInternalServerError()
-
-    try:
-        with cb.guard('bonus'):
-            bonus_baseurl = os.environ.get('BONUS_BASEURL', 'http://0.0.0.0:8080/api/v1')
-            async with aiohttp.ClientSession(headers={'X-User-Name': user_name}) as session:
-                async with session.get(f'{bonus_baseurl}/privilege') as resp:
-                    privilege_data = await resp.json()
+                    raise ServiceError('bonus')
+                privilege_data = await resp.json(loads=fastjson.loads)
     except Exception as e:
-        await raw_revoke_ticket(ticket_uid)
-        await raw_revoke_bonus(ticket_uid)
-        raise e
+        await retry_queue.run_or_enqueue('revoke_ticket', ticket_uid)
+        await retry_queue.run_or_enqueue('revoke_bonus', ticket_uid)
+        raise aiohttp.web_exceptions.HTTPInternalServerError() from e
 
-    return aiohttp.web.json_response({
+    paid_bonuses = 0
+    if paid_from_balance:
+        paid_bonuses = -privilege_data['balanceDiff']
+    paid_money = price - paid_bonuses
+
+    return json_response({
         "ticketUid": ticket_uid,
         "flightNumber": flight_info['flightNumber'],
         "fromAirport": flight_info['fromAirport'],
@@ -242,6 +361,111 @@ async def post_ticket(request: web.Request):
     })
 
 
+tickets_batch_max_size = int(os.environ.get('TICKETS_BATCH_MAX_SIZE', 100))
+
+
+@routes.post('/tickets:batch')
+async def post_tickets_batch(request: web.Request):
+    if 'X-User-Name' not in request.headers.keys():
+        return aiohttp.web.Response(status=400)
+    user_name = request.headers['X-User-Name']
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return await create_tickets_batch(request, user_name)
+    body = await request.read()
+    try:
+        return await idempotency.run(f'{user_name}:{key}', fingerprint(user_name.encode(), b'batch', body),
+                                     lambda: create_tickets_batch(request, user_name))
+    except IdempotencyKeyReused:
+        return aiohttp.web.Response(status=422, text=f'{IDEMPOTENCY_HEADER} was already used for another request')
+    except IdempotencyKeyInFlight:
+        return aiohttp.web.Response(status=409, text=f'A request with this {IDEMPOTENCY_HEADER} is still in progress')
+
+
+def parse_batch(dat, field: str) -> Optional[list]:
+    if not isinstance(dat, dict) or not isinstance(dat.get(field), list):
+        return None
+    if len(dat[field]) > tickets_batch_max_size:
+        return None
+    return dat[field]
+
+
+async def create_tickets_batch(request: web.Request, user_name: str) -> web.Response:
+    items = parse_batch(await request.json(loads=fastjson.loads), 'items')
+    if items is None:
+        return aiohttp.web.Response(status=400)
+    for item in items:
+        if not isinstance(item, dict) or any(k not in item for k in ('flightNumber', 'price', 'paidFromBalance')):
+            return aiohttp.web.Response(status=400)
+
+    headers = {'X-User-Name': user_name}
+
+    flights = await get_flights_by_numbers(item['flightNumber'] for item in items)
+    results: list[Optional[dict]] = [None] * len(items)
+    booked = []
+    for i, item in enumerate(items):
+        if item['flightNumber'] in flights:
+            booked.append(i)
+        else:
+            results[i] = {'code': 404, 'flightNumber': item['flightNumber'], 'message': 'Flight not found'}
+    if not booked:
+        return json_response({'items': results, 'privilege': None})
+
+    # one multi-row insert and one bonus transaction for the whole group, whatever its size;
+    # only 5xx and transport errors count against a breaker, a rejected request is the client's
+    with cb.guard('ticket'):
+        resp = await clients.fetch('ticket', 'POST', '/tickets/batch', headers=headers,
+                                   json={'items': [items[i] for i in booked]})
+        if resp.status >= 500:
+            raise ServiceError('ticket')
+    if resp.status != 200:
+        return aiohttp.web.Response(status=resp.status, body=resp.body)
+    ticket_uids = [t['ticketUid'] for t in resp.json()]
+
+    try:
+        with cb.guard('bonus'):
+            resp = await clients.fetch('bonus', 'POST', '/privilege/batch', headers=headers, json={'items': [{
+                'operationType': 'DEBIT_THE_ACCOUNT' if items[i]['paidFromBalance'] else 'FILL_IN_BALANCE',
+                'price': items[i]['price'],
+                'ticket_uid': ticket_uid
+            } for i, ticket_uid in zip(booked, ticket_uids)]})
+            if resp.status >= 500:
+                raise ServiceError('bonus')
+        if resp.status != 200:
+            raise DownstreamError('bonus', resp.status, resp.body)
+        privilege_data = resp.json()
+    except Exception as e:
+        # the bonus transaction is all or nothing, so every ticket of the group goes back
+        await revoke_tickets_batch(ticket_uids, user_name)
+        if isinstance(e, DownstreamError):
+            return aiohttp.web.Response(status=e.status, body=e.body)
+        raise aiohttp.web_exceptions.HTTPInternalServerError() from e
+
+    for i, ticket_uid, bonus in zip(booked, ticket_uids, privilege_data['items']):
+        item = items[i]
+        flight_info = flights[item['flightNumber']]
+        paid_bonuses = -bonus['balanceDiff'] if item['paidFromBalance'] else 0
+        results[i] = {'code': 200, 'ticket': {
+            "ticketUid": ticket_uid,
+            "flightNumber": flight_info['flightNumber'],
+            "fromAirport": flight_info['fromAirport'],
+            "toAirport": flight_info['toAirport'],
+            "date": flight_info['date'],
+            "price": item['price'],
+            "paidByMoney": item['price'] - paid_bonuses,
+            "paidByBonuses": paid_bonuses,
+            "status": "PAID",
+        }}
+
+    return json_response({
+        'items': results,
+        'privilege': {
+            "balance": privilege_data['balance'],
+            "status": privilege_data['status']
+        }
+    })
+
+
 @routes.get('/tickets/{ticketUid}')
 async def get_ticket(request: web.Request):
     r = request.match_info
@@ -254,50 +478,41 @@ async def get_ticket(request: web.Request):
     user_name = request.headers['X-User-Name']
 
     with cb.guard('ticket'):
-        ticket_baseurl = os.environ.get('TICKET_BASEURL', 'http://0.0.0.0:8070/api/v1')
-        async with aiohttp.ClientSession(headers={'X-User-Name': user_name}) as session:
-            async with session.get(f'{ticket_baseurl}/tickets/{ticket_uid}') as resp:
-                dat = await resp.json()
-
-    flight_data = await get_flight_by_number(dat['flight_number'])
-    return aiohttp.web.json_response({
+        resp = await clients.hedged_get('ticket', f'/tickets/{ticket_uid}', headers={'X-User-Name': user_name})
+        if resp.status >= 500:
+            raise ServiceError('ticket')
+    if resp.status != 200:
+        return aiohttp.web.Response(status=resp.status, body=resp.body)
+    dat = resp.json()
+
+    flight_data = await get_flight_by_number(dat['flight_number']) or {}
+    return json_response({
         "ticketUid": dat['ticket_uid'],
         "flightNumber": dat['flight_number'],
-        'fromAirport': flight_data['fromAirport'],
-        'toAirport': flight_data['toAirport'],
-        'date': flight_data['date'],
+        'fromAirport': flight_data.get('fromAirport'),
+        'toAirport': flight_data.get('toAirport'),
+        'date': flight_data.get('date'),
         "price": dat['price'],
         "status": dat['status']
     })
 
 
-async def retry_foo(foo, *args):
-    await asyncio.sleep(5)
-    return await foo(*args)
-
-
 async def raw_revoke_bonus(ticket_uid):
-    try:
-        with cb.guard('bonus'):
-            bonus_baseurl = os.environ.get('BONUS_BASEURL', 'http://0.0.0.0:8080/api/v1')
-            async with aiohttp.ClientSession() as session:
-                async with session.delete(f'{bonus_baseurl}/privilege/{ticket_uid}') as resp:
-                    if resp.status >= 400:
-                        return web.Response(status=204)
-                    _ = await resp.json()
-    except:
-        retry_coros.append(asyncio.create_task(retry_foo(raw_revoke_bonus, ticket_uid)))
+    with cb.guard('bonus'):
+        async with clients.delete('bonus', f'/privilege/{ticket_uid}') as resp:
+            if resp.status >= 500:
+                raise ServiceError('bonus')
 
 
 async def raw_revoke_ticket(ticket_uid):
-    try:
-        with cb.guard('ticket'):
-            ticket_baseurl = os.environ.get('TICKET_BASEURL', 'http://0.0.0.0:8070/api/v1')
-            async with aiohttp.ClientSession() as session:
-                async with session.delete(f'{ticket_baseurl}/ticket/{ticket_uid}') as resp:
-                    _ = await resp.json()
-    except:
-        retry_coros.append(asyncio.create_task(retry_foo(raw_revoke_ticket, ticket_uid)))
+    with cb.guard('ticket'):
+        async with clients.delete('ticket', f'/tickets/{ticket_uid}') as resp:
+            if resp.status >= 500:
+                raise ServiceError('ticket')
+
+
+retry_queue.register('revoke_bonus', 'bonus', raw_revoke_bonus)
+retry_queue.register('revoke_ticket', 'ticket', raw_revoke_ticket)
 
 
 @routes.delete('/tickets/{ticketUid}')
@@ -307,7 +522,59 @@ async def revoke_ticket(request: web.Request):
         return aiohttp.web.Response(status=400)
     ticket_uid = r['ticketUid']
 
-    await raw_revoke_bonus(ticket_uid)
-    await raw_revoke_ticket(ticket_uid)
+    await retry_queue.run_or_enqueue('revoke_bonus', ticket_uid)
+    await retry_queue.run_or_enqueue('revoke_ticket', ticket_uid)
 
     return web.Response(status=204)
+
+
+async def raw_revoke_batch(service: str, path: str, ticket_uids: list[str], user_name: str) -> dict:
+    with cb.guard(service):
+        resp = await clients.fetch(service, 'DELETE', path, headers={'X-User-Name': user_name},
+                                   json={'ticketUids': ticket_uids})
+        if resp.status >= 500:
+            raise ServiceError(service)
+    if resp.status != 200:
+        raise DownstreamError(service, resp.status, resp.body)
+    return resp.json()
+
+
+async def revoke_tickets_batch(ticket_uids: list[str], user_name: str) -> Optional[set[str]]:
+    # same order as revoke_ticket; when a batch call fails every ticket of it goes to
+    # the retry queue and None tells the caller the outcome is not known yet
+    try:
+        await raw_revoke_batch('bonus', '/privilege/batch', ticket_uids, user_name)
+    except Exception as e:
+        for ticket_uid in ticket_uids:
+            await retry_queue.enqueue('revoke_bonus', ticket_uid, e)
+    try:
+        dat = await raw_revoke_batch('ticket', '/tickets/batch', ticket_uids, user_name)
+    except Exception as e:
+        for ticket_uid in ticket_uids:
+            await retry_queue.enqueue('revoke_ticket', ticket_uid, e)
+        return None
+    return set(dat['revoked'])
+
+
+@routes.delete('/tickets:batch')
+async def revoke_tickets(request: web.Request):
+    if 'X-User-Name' not in request.headers.keys():
+        return aiohttp.web.Response(status=400)
+    user_name = request.headers['X-User-Name']
+    ticket_uids = parse_batch(await request.json(loads=fastjson.loads), 'ticketUids')
+    if ticket_uids is None:
+        return aiohttp.web.Response(status=400)
+    try:
+        ticket_uids = list(dict.fromkeys(str(UUID(str(ticket_uid))) for ticket_uid in ticket_uids))
+    except ValueError:
+        return aiohttp.web.Response(status=400)
+    if not ticket_uids:
+        return json_response({'items': []})
+
+    revoked = await revoke_tickets_batch(ticket_uids, user_name)
+    if revoked is None:
+        items = [{'ticketUid': ticket_uid, 'code': 202} for ticket_uid in ticket_uids]
+    else:
+        items = [{'ticketUid': ticket_uid, 'code': 204 if ticket_uid in revoked else 404}
+                 for ticket_uid in ticket_uids]
+    return json_response({'items': items})
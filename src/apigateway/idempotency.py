@@ -0,0 +1,289 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+
+import deadline
+import metrics
+import db_conn
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+@dataclass
+class IdempotentResult:
+    status: int
+    body: bytes
+    content_type: str
+
+    @classmethod
+    def from_response(cls, res: web.Response) -> IdempotentResult:
+        return cls(res.status, res.body or b'', res.content_type)
+
+    def to_response(self, replayed: bool = False) -> web.Response:
+        res = web.Response(status=self.status, body=self.body, content_type=self.content_type)
+        if replayed:
+            res.headers[REPLAYED_HEADER] = 'true'
+        return res
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    task: Optional[asyncio.Task] = None
+    result: Optional[IdempotentResult] = None
+    expires_at: float = 0.0
+
+
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+class IdempotencyKeyInFlight(Exception):
+    pass
+
+
+def fingerprint(*parts: bytes) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(len(part).to_bytes(8, 'big'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class PostgresIdempotencyBackend:
+    ttl_sec: float
+    pending_ttl_sec: float
+
+    # A key is claimed by inserting a pending row (no status yet) before the booking starts,
+    # so only one worker or replica ever books it. The row gets the result once the booking
+    # is done, or is deleted when it failed. A pending row older than `pending_ttl_sec`
+    # belongs to a worker that died mid-way and may be claimed again.
+    def __init__(self, pool: db_conn.DbPool, ttl_sec: float, pending_ttl_sec: float = 60.0):
+        self.pool = pool
+        self.ttl_sec = ttl_sec
+        self.pending_ttl_sec = pending_ttl_sec
+        pool.register_schema('''
+            CREATE TABLE IF NOT EXISTS idempotency_record
+(
+    key          VARCHAR(255) PRIMARY KEY,
+    fingerprint  VARCHAR(64)              NOT NULL,
+    status       INT,
+    body         BYTEA,
+    content_type VARCHAR(255),
+    created_at   TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);''')
+
+    async def open(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('DELETE FROM idempotency_record '
+                                  'WHERE created_at < now() - make_interval(secs => %s);', (self.ttl_sec,))
+
+    # None when the key is now ours, otherwise the stored fingerprint and result,
+    # the result being None while another request still holds the key
+    async def claim(self, key: str, fp: str) -> Optional[tuple[str, Optional[IdempotentResult]]]:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                while True:
+                    await cur.execute('INSERT INTO idempotency_record (key, fingerprint) '
+                                      'VALUES (%s, %s) '
+                                      'ON CONFLICT (key) DO UPDATE '
+                                      '    SET fingerprint=EXCLUDED.fingerprint, status=NULL, body=NULL, '
+                                      '        content_type=NULL, created_at=now() '
+                                      '    WHERE idempotency_record.created_at < now() - make_interval(secs => '
+                                      '        CASE WHEN idempotency_record.status IS NULL THEN %s ELSE %s END) '
+                                      'RETURNING key;',
+                                      (key, fp, self.pending_ttl_sec, self.ttl_sec))
+                    if await cur.fetchone() is not None:
+                        return None
+                    await cur.execute('SELECT fingerprint, status, body, content_type '
+                                      'FROM idempotency_record '
+                                      'WHERE key=%s;', (key,))
+                    row = await cur.fetchone()
+                    # the holder gave the key up in between, try to claim it again
+                    if row is not None:
+                        break
+        fp, status, body, content_type = row
+        if status is None:
+            return fp, None
+        return fp, IdempotentResult(status, bytes(body), content_type)
+
+    async def finish(self, key: str, fp: str, result: IdempotentResult):
+        # also records a booking that ran without a claim while the database was unreachable
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('INSERT INTO idempotency_record '
+                                  '     (key, fingerprint, status, body, content_type) '
+                                  'VALUES (%s, %s, %s, %s, %s) '
+                                  'ON CONFLICT (key) DO UPDATE '
+                                  '    SET status=EXCLUDED.status, body=EXCLUDED.body, '
+                                  '        content_type=EXCLUDED.content_type '
+                                  '    WHERE idempotency_record.fingerprint=EXCLUDED.fingerprint '
+                                  '      AND idempotency_record.status IS NULL;',
+                                  (key, fp, result.status, result.body, result.content_type))
+
+    async def release(self, key: str, fp: str):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('DELETE FROM idempotency_record '
+                                  'WHERE key=%s AND fingerprint=%s AND status IS NULL;', (key, fp))
+
+
+class IdempotencyStore:
+    max_size: int = 10000
+    ttl_sec: float = 86400
+    pending_wait_sec: float = 5.0
+    pending_poll_sec: float = 0.1
+
+    def __init__(self, max_size=10000, ttl_sec=86400.0, backend: Optional[PostgresIdempotencyBackend] = None,
+                 pending_wait_sec=5.0, pending_poll_sec=0.1):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.backend = backend
+        self.pending_wait_sec = pending_wait_sec
+        self.pending_poll_sec = pending_poll_sec
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> IdempotencyStore:
+        ttl_sec = float(os.environ.get('IDEMPOTENCY_TTL_SEC', 86400))
+        backend = None
+        if os.environ.get('IDEMPOTENCY_BACKEND', 'memory') == 'postgres':
+            backend = PostgresIdempotencyBackend(db_conn.pool, ttl_sec,
+                                                 pending_ttl_sec=float(os.environ.get('IDEMPOTENCY_PENDING_TTL_SEC', 60)))
+        return cls(max_size=int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000)), ttl_sec=ttl_sec, backend=backend,
+                   pending_wait_sec=float(os.environ.get('IDEMPOTENCY_PENDING_WAIT_SEC', 5.0)))
+
+    async def start(self, app: Optional[web.Application] = None):
+        if self.backend is None:
+            return
+        # the pool starts lazily, a database that is down now only costs replays for a while
+        try:
+            await self.backend.open()
+        except Exception as e:
+            print(f'[IDEMPOTENCY] cannot clean up old records: {e!r}')
+
+    def _lookup(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.result is not None and entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _insert(self, key: str, entry: _Entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _remember(self, key: str, result: IdempotentResult):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.result = result
+            entry.task = None
+            entry.expires_at = time.monotonic() + self.ttl_sec
+
+    async def _replay(self, entry: _Entry, fp: str) -> web.Response:
+        if entry.fingerprint != fp:
+            metrics.IDEMPOTENCY_REQUESTS.labels('conflict').inc()
+            raise IdempotencyKeyReused()
+        if entry.result is not None:
+            metrics.IDEMPOTENCY_REQUESTS.labels('replayed').inc()
+            return entry.result.to_response(replayed=True)
+        metrics.IDEMPOTENCY_REQUESTS.labels('collapsed').inc()
+        result, _ = await asyncio.shield(entry.task)
+        return result.to_response(replayed=True)
+
+    async def _claim(self, key: str, fp: str) -> tuple[bool, Optional[IdempotentResult]]:
+        # (True, None) when this request books the key, (False, result) when another worker or
+        # replica already did; a booking still running elsewhere is waited on for a while
+        left = deadline.remaining()
+        wait_sec = self.pending_wait_sec if left is None else min(self.pending_wait_sec, left)
+        give_up_at = time.monotonic() + wait_sec
+        while True:
+            try:
+                stored = await self.backend.claim(key, fp)
+            except Exception as e:
+                # without the database only this worker's entries guard the key
+                print(f'[IDEMPOTENCY] failed to claim {key}: {e!r}')
+                return False, None
+            if stored is None:
+                return True, None
+            stored_fp, result = stored
+            if stored_fp != fp:
+                metrics.IDEMPOTENCY_REQUESTS.labels('conflict').inc()
+                raise IdempotencyKeyReused()
+            if result is not None:
+                metrics.IDEMPOTENCY_REQUESTS.labels('replayed').inc()
+                return False, result
+            if time.monotonic() + self.pending_poll_sec > give_up_at:
+                metrics.IDEMPOTENCY_REQUESTS.labels('in_flight').inc()
+                raise IdempotencyKeyInFlight()
+            await asyncio.sleep(self.pending_poll_sec)
+
+    async def _release(self, key: str, fp: str):
+        try:
+            await self.backend.release(key, fp)
+        except Exception as e:
+            print(f'[IDEMPOTENCY] failed to release {key}: {e!r}')
+
+    async def _complete(self, key: str, fp: str,
+                        foo: Callable[[], Awaitable[web.Response]]) -> tuple[IdempotentResult, bool]:
+        claimed = False
+        try:
+            if self.backend is not None:
+                claimed, stored = await self._claim(key, fp)
+                if stored is not None:
+                    self._remember(key, stored)
+                    return stored, True
+            metrics.IDEMPOTENCY_REQUESTS.labels('new').inc()
+            result = IdempotentResult.from_response(await foo())
+        except BaseException:
+            self._entries.pop(key, None)
+            if claimed:
+                await self._release(key, fp)
+            raise
+        if result.status >= 500:
+            # let the client retry a failed booking under the same key
+            self._entries.pop(key, None)
+            if claimed:
+                await self._release(key, fp)
+            return result, False
+        self._remember(key, result)
+        if self.backend is not None:
+            try:
+                await self.backend.finish(key, fp, result)
+            except Exception as e:
+                print(f'[IDEMPOTENCY] failed to persist {key}: {e!r}')
+        return result, False
+
+    async def run(self, key: str, fp: str, foo: Callable[[], Awaitable[web.Response]]) -> web.Response:
+        entry = self._lookup(key)
+        if entry is not None:
+            return await self._replay(entry, fp)
+
+        # the booking runs in its own task: a client that disconnects mid-way neither
+        # leaves a half-done booking behind nor cancels the duplicates waiting on it
+        task = asyncio.create_task(self._complete(key, fp, foo))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._insert(key, _Entry(fp, task=task))
+        result, replayed = await asyncio.shield(task)
+        return result.to_response(replayed=replayed)
+
+    def stats(self) -> dict:
+        in_flight = sum(1 for e in self._entries.values() if e.result is None)
+        return {
+            'size': len(self._entries),
+            'inFlight': in_flight,
+        }
@@ -4,14 +4,30 @@ from typing import Optional, Any
 
 from aiohttp import web
 
+import admission
+import db_conn
+import deadline
 import exc_handler
+import metrics
+import prefork
 import serializer
+from fastjson import json_response
+from clients import clients
 from handlers import *
 
-if __name__ == '__main__':
-    app = web.Application(middlewares=[])
 
-    api_app = web.Application(middlewares=[serializer.serializer, exc_handler.exc_handler])
+def make_app() -> web.Application:
+    app = web.Application(middlewares=[metrics.metrics_middleware, admission.admission_middleware])
+    app.on_startup.append(clients.start)
+    app.on_startup.append(retry_queue.start)
+    app.on_startup.append(idempotency.start)
+    app.on_startup.append(metrics.start_sampling)
+    app.on_cleanup.append(clients.close)
+    app.on_cleanup.append(retry_queue.stop)
+    app.on_cleanup.append(db_conn.pool.close)
+    app.on_cleanup.append(metrics.stop_sampling)
+
+    api_app = web.Application(middlewares=[deadline.deadline_middleware, serializer.serializer, exc_handler.exc_handler])
     api_app.router.add_routes(routes)
     app.add_subapp('/api/v1/', api_app)
 
@@ -23,6 +39,26 @@ if __name__ == '__main__':
         return aiohttp.web.Response(status=200)
 
 
+    @manage_routes.get('/manage/metrics')
+    async def prometheus_metrics(r):
+        return await metrics.metrics_handler(r)
+
+
+    @manage_routes.get('/manage/cache')
+    async def cache_stats(r):
+        return json_response({
+            'flight': flight_cache.stats(),
+            'flightsPage': flights_page_cache.stats(),
+            'idempotency': idempotency.stats(),
+            'reads': reads.stats(),
+            'admission': admission.controller.stats(),
+        })
+
+
     app.add_routes(manage_routes)
 
-    web.run_app(app, port=8080)
+    return app
+
+
+if __name__ == '__main__':
+    prefork.run(make_app, port=8080)
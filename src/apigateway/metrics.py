@@ -0,0 +1,195 @@
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+from typing import Callable
+
+import aiohttp
+from aiohttp import web
+from aiohttp.web_middlewares import middleware
+
+import prefork  # before prometheus_client, see prefork.multiproc_dir
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, generate_latest, multiprocess,
+                               CONTENT_TYPE_LATEST, REGISTRY)
+
+REQUESTS = Counter('gateway_http_requests_total', 'Requests handled by the gateway',
+                   ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram('gateway_http_request_duration_seconds', 'Gateway request latency',
+                            ['method', 'route'])
+IN_FLIGHT = Gauge('gateway_http_requests_in_flight', 'Requests currently handled by the gateway',
+                  multiprocess_mode='livesum')
+
+DOWNSTREAM_LATENCY = Histogram('gateway_downstream_request_duration_seconds', 'Latency of calls to downstream services',
+                               ['service', 'method', 'status'])
+DOWNSTREAM_ERRORS = Counter('gateway_downstream_request_errors_total', 'Downstream calls failed without a response',
+                            ['service', 'method'])
+DOWNSTREAM_TIMEOUT = Gauge('gateway_downstream_timeout_seconds', 'Adaptive timeout currently applied to GETs',
+                           ['service'], multiprocess_mode='livemax')
+HEDGES = Counter('gateway_downstream_hedges_total',
+                 'Hedged GETs: second request sent, answered first (won) or refused by the budget (denied)',
+                 ['service', 'result'])
+
+CB_STATE = Gauge('gateway_circuit_breaker_state', 'Current breaker state (1 for the active state)',
+                 ['service', 'state'], multiprocess_mode='livemostrecent')
+CB_TRANSITIONS = Counter('gateway_circuit_breaker_transitions_total', 'Circuit breaker state transitions',
+                         ['service', 'from_state', 'to_state'])
+
+RETRY_ENQUEUED = Counter('gateway_retry_enqueued_total', 'Operations put into the retry queue', ['operation'])
+RETRY_ATTEMPTS = Counter('gateway_retry_attempts_total', 'Retry attempts by result', ['operation', 'result'])
+RETRY_PENDING = Gauge('gateway_retry_pending', 'Operations waiting in the retry queue', ['service'],
+                      multiprocess_mode='livemostrecent')
+
+SINGLEFLIGHT_CALLS = Counter('gateway_singleflight_calls_total',
+                             'Reads that started a downstream call (leader) or joined one in flight (collapsed)',
+                             ['group', 'result'])
+
+IDEMPOTENCY_REQUESTS = Counter('gateway_idempotency_requests_total',
+                               'Requests carrying an Idempotency-Key by outcome', ['result'])
+
+DB_POOL_SIZE = Gauge('gateway_db_pool_size', 'Connections opened by the gateway Postgres pool',
+                     multiprocess_mode='livesum')
+DB_POOL_FREE = Gauge('gateway_db_pool_free', 'Idle connections in the gateway Postgres pool',
+                     multiprocess_mode='livesum')
+DB_POOL_MAX = Gauge('gateway_db_pool_max', 'Upper limit of the gateway Postgres pool',
+                    multiprocess_mode='livesum')
+DB_ACQUIRE_LATENCY = Histogram('gateway_db_pool_acquire_duration_seconds', 'Time spent waiting for a pool connection')
+DB_ACQUIRE_TIMEOUTS = Counter('gateway_db_pool_acquire_timeouts_total', 'Acquisitions that gave up waiting')
+DB_HEALTH_CHECKS = Counter('gateway_db_pool_health_checks_total', 'Checks of connections that sat idle, by result',
+                           ['result'])
+
+
+# Values that live in other objects are copied into metrics by samplers: at every scrape and,
+# with several workers, every `sample_interval_sec`, since the scrape only reaches one of them.
+# set_function and custom collectors would only ever report the worker being scraped.
+sample_interval_sec = float(os.environ.get('METRICS_SAMPLE_INTERVAL_SEC', 1.0))
+_samplers: list[Callable[[], None]] = []
+
+
+def sample():
+    for sampler in _samplers:
+        sampler()
+
+
+async def start_sampling(app: web.Application):
+    if prefork.multiproc_dir is None:
+        return
+
+    async def run():
+        while True:
+            sample()
+            await asyncio.sleep(sample_interval_sec)
+
+    app['metrics_sampling'] = asyncio.create_task(run())
+
+
+async def stop_sampling(app: web.Application):
+    task = app.get('metrics_sampling')
+    if task is not None:
+        task.cancel()
+
+
+def instrument_db_pool(pool):
+    def sampler():
+        DB_POOL_SIZE.set(pool.size())
+        DB_POOL_FREE.set(pool.freesize())
+        DB_POOL_MAX.set(pool.max_size)
+
+    _samplers.append(sampler)
+
+ADMISSION_REQUESTS = Counter('gateway_admission_requests_total',
+                             'Admission decisions: admitted, queued, rate_limited, queue_full, queue_timeout',
+                             ['result'])
+ADMISSION_IN_FLIGHT = Gauge('gateway_admission_in_flight', 'Requests holding a concurrency slot',
+                            multiprocess_mode='livesum')
+ADMISSION_QUEUED = Gauge('gateway_admission_queued', 'Requests waiting for a concurrency slot',
+                         multiprocess_mode='livesum')
+
+
+def instrument_admission(admission):
+    def sampler():
+        ADMISSION_IN_FLIGHT.set(admission.limiter.in_flight)
+        ADMISSION_QUEUED.set(admission.limiter.queued())
+
+    _samplers.append(sampler)
+
+
+def _route_name(req: web.Request) -> str:
+    route = req.match_info.route
+    if route is None or route.resource is None:
+        return 'unmatched'
+    return route.resource.canonical
+
+
+@middleware
+async def metrics_middleware(req: web.Request, handler):
+    route = _route_name(req)
+    status = 500
+    t = time.perf_counter()
+    IN_FLIGHT.inc()
+    try:
+        res = await handler(req)
+        status = res.status
+        return res
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        IN_FLIGHT.dec()
+        REQUEST_LATENCY.labels(req.method, route).observe(time.perf_counter() - t)
+        REQUESTS.labels(req.method, route, str(status)).inc()
+
+
+def downstream_trace_config(service_name: str) -> aiohttp.TraceConfig:
+    async def on_request_start(session, ctx: SimpleNamespace, params):
+        ctx.t = time.perf_counter()
+
+    async def on_request_end(session, ctx: SimpleNamespace, params):
+        DOWNSTREAM_LATENCY.labels(service_name, params.method, str(params.response.status)).observe(
+            time.perf_counter() - ctx.t)
+
+    async def on_request_exception(session, ctx: SimpleNamespace, params):
+        DOWNSTREAM_ERRORS.labels(service_name, params.method).inc()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+def count_transition(service_name: str, from_state, to_state):
+    CB_TRANSITIONS.labels(service_name, from_state.name, to_state.name).inc()
+
+
+def observe_state(service_name: str, from_state, to_state):
+    CB_STATE.labels(service_name, from_state.name).set(0)
+    CB_STATE.labels(service_name, to_state.name).set(1)
+
+
+CACHE_ENTRIES = Gauge('gateway_cache_entries', 'Entries held by the cache', ['cache'], multiprocess_mode='livesum')
+CACHE_LOOKUPS = Counter('gateway_cache_lookups', 'Cache lookups by result', ['cache', 'result'])
+
+
+def register_caches(*caches):
+    # the caches count lookups themselves, only the growth since the last sample is added
+    counted: dict[tuple[str, str], int] = {}
+
+    def sampler():
+        for cache in caches:
+            stats = cache.stats()
+            CACHE_ENTRIES.labels(cache.name).set(stats['size'])
+            for result, stat in (('hit', 'hits'), ('miss', 'misses'), ('coalesced', 'coalesced'),
+                                 ('stale', 'staleHits')):
+                CACHE_LOOKUPS.labels(cache.name, result).inc(stats[stat] - counted.get((cache.name, result), 0))
+                counted[(cache.name, result)] = stats[stat]
+
+    _samplers.append(sampler)
+
+
+async def metrics_handler(req: web.Request):
+    sample()
+    registry = REGISTRY
+    if prefork.multiproc_dir is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return web.Response(body=generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
@@ -0,0 +1,92 @@
+import glob
+import os
+import shutil
+import signal
+import tempfile
+import time
+import traceback
+from typing import Callable, Optional
+
+from aiohttp import web
+
+workers = int(os.environ.get('GATEWAY_WORKERS', 1))
+respawn_delay_sec = float(os.environ.get('GATEWAY_RESPAWN_DELAY_SEC', 1.0))
+
+# With several workers prometheus_client keeps every sample in files under this directory
+# and a scrape, served by whichever worker, adds them up. It reads the variable when first
+# imported, so this module has to be imported before it (metrics does so).
+multiproc_dir: Optional[str] = None
+_own_multiproc_dir = False
+if workers > 1:
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir is None:
+        multiproc_dir = os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='gateway-metrics-')
+        _own_multiproc_dir = True
+    else:
+        # files left by an earlier run would be counted as live
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+
+def _worker(make_app: Callable[[], web.Application], port: int, index: int):
+    code = 0
+    try:
+        # every worker binds the port itself, the kernel spreads connections between them
+        web.run_app(make_app(), port=port, reuse_port=True, print=print if index == 0 else None)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    os._exit(code)
+
+
+def run(make_app: Callable[[], web.Application], port: int):
+    if workers <= 1:
+        web.run_app(make_app(), port=port)
+        return
+
+    children: dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _worker(make_app, port, index)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for i in range(workers):
+        spawn(i)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f'[PREFORK] started {workers} workers: {", ".join(map(str, children))}')
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        # drop the dead worker's in-flight and pool gauges, its counters keep counting
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+        if stopping:
+            continue
+        print(f'[PREFORK] worker {index} (pid {pid}) exited with status {status}, restarting')
+        time.sleep(respawn_delay_sec)
+        if not stopping:
+            spawn(index)
+
+    if _own_multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
@@ -0,0 +1,338 @@
+from __future__ import annotations
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Union
+
+from aiohttp import web
+
+import db_conn
+import metrics
+from circuit_breaker import CircuitBreaker, CircuitBreakerState
+
+
+@dataclass
+class RetryOperation:
+    id: int
+    operation: str
+    service: str
+    key: str
+    attempts: int
+
+
+class SqliteRetryStore:
+    path: str
+    lease_sec: float = 60.0
+
+    def __init__(self, path: str, lease_sec=60.0):
+        self.path = path
+        self.lease_sec = lease_sec
+        self._conn: Optional[sqlite3.Connection] = None
+        # sqlite3 connections must stay on the thread that created them
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='retry-store')
+
+    async def _run(self, foo, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, foo, *args)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS retry_operation
+(
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    operation       TEXT    NOT NULL,
+    service         TEXT    NOT NULL,
+    key             TEXT    NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL    NOT NULL,
+    last_error      TEXT,
+    leased_until    REAL    NOT NULL DEFAULT 0,
+    UNIQUE (operation, key)
+);''')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(retry_operation);')]
+        if 'leased_until' not in columns:
+            self._conn.execute('ALTER TABLE retry_operation ADD COLUMN leased_until REAL NOT NULL DEFAULT 0;')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS retry_operation_due '
+                           'ON retry_operation (service, next_attempt_at);')
+        self._conn.commit()
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._run(self._close)
+
+    def _add(self, operation: str, service: str, key: str, next_attempt_at: float) -> bool:
+        cur = self._conn.execute('INSERT OR IGNORE INTO retry_operation '
+                                 '     (operation, service, key, next_attempt_at) '
+                                 'VALUES (?, ?, ?, ?);', (operation, service, key, next_attempt_at))
+        self._conn.commit()
+        return cur.rowcount == 1
+
+    async def add(self, operation: str, service: str, key: str, next_attempt_at: float) -> bool:
+        return await self._run(self._add, operation, service, key, next_attempt_at)
+
+    def _due(self, service: str, now: float, limit: int) -> list[RetryOperation]:
+        # every prefork worker drains the same file: the write lock taken up front makes
+        # picking and leasing one step, so an operation runs in one worker at a time
+        self._conn.execute('BEGIN IMMEDIATE;')
+        try:
+            cur = self._conn.execute('SELECT id, operation, service, key, attempts '
+                                     'FROM retry_operation '
+                                     'WHERE service=? AND next_attempt_at<=? AND leased_until<=? '
+                                     'ORDER BY next_attempt_at ASC '
+                                     'LIMIT ?;', (service, now, time.time(), limit))
+            ops = [RetryOperation(*row) for row in cur.fetchall()]
+            self._conn.executemany('UPDATE retry_operation SET leased_until=? WHERE id=?;',
+                                   [(time.time() + self.lease_sec, op.id) for op in ops])
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            raise
+        return ops
+
+    async def due(self, service: str, now: float, limit: int) -> list[RetryOperation]:
+        return await self._run(self._due, service, now, limit)
+
+    def _done(self, op_id: int):
+        self._conn.execute('DELETE FROM retry_operation WHERE id=?;', (op_id,))
+        self._conn.commit()
+
+    async def done(self, op_id: int):
+        await self._run(self._done, op_id)
+
+    def _reschedule(self, op_id: int, attempts: int, next_attempt_at: float, error: str):
+        self._conn.execute('UPDATE retry_operation '
+                           'SET attempts=?, next_attempt_at=?, last_error=?, leased_until=0 '
+                           'WHERE id=?;', (attempts, next_attempt_at, error, op_id))
+        self._conn.commit()
+
+    async def reschedule(self, op_id: int, attempts: int, next_attempt_at: float, error: str):
+        await self._run(self._reschedule, op_id, attempts, next_attempt_at, error)
+
+    def _pending(self) -> dict[str, int]:
+        cur = self._conn.execute('SELECT service, count(*) FROM retry_operation GROUP BY service;')
+        return dict(cur.fetchall())
+
+    async def pending(self) -> dict[str, int]:
+        return await self._run(self._pending)
+
+
+class PostgresRetryStore:
+    lease_sec: float = 60.0
+
+    def __init__(self, pool: db_conn.DbPool, lease_sec=60.0):
+        self.pool = pool
+        self.lease_sec = lease_sec
+        pool.register_schema('''
+            CREATE TABLE IF NOT EXISTS retry_operation
+(
+    id              BIGSERIAL PRIMARY KEY,
+    operation       VARCHAR(64)      NOT NULL,
+    service         VARCHAR(64)      NOT NULL,
+    key             VARCHAR(255)     NOT NULL,
+    attempts        INT              NOT NULL DEFAULT 0,
+    next_attempt_at DOUBLE PRECISION NOT NULL,
+    last_error      TEXT,
+    leased_until    DOUBLE PRECISION NOT NULL DEFAULT 0,
+    UNIQUE (operation, key)
+);
+            ALTER TABLE retry_operation ADD COLUMN IF NOT EXISTS leased_until DOUBLE PRECISION NOT NULL DEFAULT 0;
+            CREATE INDEX IF NOT EXISTS retry_operation_due
+                ON retry_operation (service, next_attempt_at);''')
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def add(self, operation: str, service: str, key: str, next_attempt_at: float) -> bool:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('INSERT INTO retry_operation '
+                                  '     (operation, service, key, next_attempt_at) '
+                                  'VALUES (%s, %s, %s, %s) '
+                                  'ON CONFLICT (operation, key) DO NOTHING;',
+                                  (operation, service, key, next_attempt_at))
+                return cur.rowcount == 1
+
+    async def due(self, service: str, now: float, limit: int) -> list[RetryOperation]:
+        # claimed operations are leased for `lease_sec`, so other gateway instances skip
+        # them, even when draining everything, and a crashed one only delays them
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('UPDATE retry_operation '
+                                  'SET leased_until=%s '
+                                  'WHERE id IN (SELECT id '
+                                  '             FROM retry_operation '
+                                  '             WHERE service=%s AND next_attempt_at<=%s AND leased_until<=%s '
+                                  '             ORDER BY next_attempt_at ASC '
+                                  '             LIMIT %s '
+                                  '             FOR UPDATE SKIP LOCKED) '
+                                  'RETURNING id, operation, service, key, attempts;',
+                                  (time.time() + self.lease_sec, service, now, time.time(), limit))
+                return [RetryOperation(*row) for row in await cur.fetchall()]
+
+    async def done(self, op_id: int):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('DELETE FROM retry_operation WHERE id=%s;', (op_id,))
+
+    async def reschedule(self, op_id: int, attempts: int, next_attempt_at: float, error: str):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('UPDATE retry_operation '
+                                  'SET attempts=%s, next_attempt_at=%s, last_error=%s, leased_until=0 '
+                                  'WHERE id=%s;', (attempts, next_attempt_at, error, op_id))
+
+    async def pending(self) -> dict[str, int]:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT service, count(*) FROM retry_operation GROUP BY service;')
+                return dict(await cur.fetchall())
+
+
+@dataclass
+class _Handler:
+    service: str
+    foo: Callable[[str], Awaitable[None]]
+
+
+class RetryQueue:
+    store: Union[SqliteRetryStore, PostgresRetryStore]
+    cb: CircuitBreaker
+    base_delay_sec: float = 1.0
+    max_delay_sec: float = 300.0
+    poll_interval_sec: float = 1.0
+    batch_size: int = 50
+    concurrency: int = 4
+
+    def __init__(self, store: Union[SqliteRetryStore, PostgresRetryStore], cb: CircuitBreaker, base_delay_sec=1.0, max_delay_sec=300.0,
+                 poll_interval_sec=1.0, batch_size=50, concurrency=4):
+        self.store = store
+        self.cb = cb
+        self.base_delay_sec = base_delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.poll_interval_sec = poll_interval_sec
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.handlers: dict[str, _Handler] = {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drain: set[str] = set()
+        self._worker: Optional[asyncio.Task] = None
+        cb.state_listeners.append(self._on_transition)
+
+    @classmethod
+    def from_env(cls, cb: CircuitBreaker) -> RetryQueue:
+        lease_sec = float(os.environ.get('RETRY_LEASE_SEC', 60.0))
+        if os.environ.get('RETRY_QUEUE_BACKEND', 'sqlite') == 'postgres':
+            store = PostgresRetryStore(db_conn.pool, lease_sec=lease_sec)
+        else:
+            store = SqliteRetryStore(os.environ.get('RETRY_QUEUE_PATH', 'retry-queue.sqlite3'), lease_sec=lease_sec)
+        return cls(store, cb,
+                   base_delay_sec=float(os.environ.get('RETRY_BASE_DELAY_SEC', 1.0)),
+                   max_delay_sec=float(os.environ.get('RETRY_MAX_DELAY_SEC', 300.0)),
+                   poll_interval_sec=float(os.environ.get('RETRY_POLL_INTERVAL_SEC', 1.0)),
+                   batch_size=int(os.environ.get('RETRY_BATCH_SIZE', 50)),
+                   concurrency=int(os.environ.get('RETRY_CONCURRENCY', 4)))
+
+    def register(self, operation: str, service: str, foo: Callable[[str], Awaitable[None]]):
+        self.handlers[operation] = _Handler(service, foo)
+
+    async def start(self, app: Optional[web.Application] = None):
+        await self.store.open()
+        self._wakeup = asyncio.Event()
+        self._semaphores = {h.service: asyncio.Semaphore(self.concurrency) for h in self.handlers.values()}
+        self._drain.update(self._semaphores)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, app: Optional[web.Application] = None):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.store.close()
+
+    async def enqueue(self, operation: str, key: str, error: Optional[BaseException] = None):
+        handler = self.handlers[operation]
+        added = await self.store.add(operation, handler.service, key, time.time() + self.base_delay_sec)
+        if added:
+            print(f'[RQ] queued {operation} {key}: {error!r}')
+            metrics.RETRY_ENQUEUED.labels(operation).inc()
+
+    async def run_or_enqueue(self, operation: str, key: str):
+        try:
+            await self.handlers[operation].foo(key)
+        except Exception as e:
+            await self.enqueue(operation, key, e)
+
+    def _on_transition(self, service_name: str, old: CircuitBreakerState, new: CircuitBreakerState):
+        if new == CircuitBreakerState.CLOSED and service_name in self._semaphores:
+            self._drain.add(service_name)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay_sec, self.base_delay_sec * 2 ** attempts)
+        return random.uniform(delay / 2, delay)
+
+    async def _attempt(self, op: RetryOperation):
+        handler = self.handlers.get(op.operation)
+        async with self._semaphores[op.service]:
+            try:
+                await handler.foo(op.key)
+            except Exception as e:
+                metrics.RETRY_ATTEMPTS.labels(op.operation, 'failed').inc()
+                await self.store.reschedule(op.id, op.attempts + 1, time.time() + self.backoff(op.attempts + 1),
+                                            repr(e))
+                return False
+        metrics.RETRY_ATTEMPTS.labels(op.operation, 'done').inc()
+        await self.store.done(op.id)
+        return True
+
+    async def _drain_service(self, service: str, drain_all: bool):
+        while True:
+            if self.cb.get_state(service) == CircuitBreakerState.OPENED:
+                return
+            now = float('inf') if drain_all else time.time()
+            batch = await self.store.due(service, now, self.batch_size)
+            batch = [op for op in batch if op.operation in self.handlers]
+            if not batch:
+                return
+            results = await asyncio.gather(*(self._attempt(op) for op in batch))
+            if not all(results) or len(batch) < self.batch_size:
+                return
+
+    async def _run(self):
+        while True:
+            try:
+                drain, self._drain = self._drain, set()
+                await asyncio.gather(*(self._drain_service(service, service in drain)
+                                       for service in self._semaphores))
+                pending = await self.store.pending()
+                for service in self._semaphores:
+                    metrics.RETRY_PENDING.labels(service).set(pending.get(service, 0))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'[RQ] worker failed: {e!r}')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class ErrorResponse(Exception):
+    status: int
+    message: str
+
+    def to_json(self) -> dict:
+        return {'message': self.message}
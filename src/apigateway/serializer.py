@@ -1,20 +1,23 @@
 from aiohttp import web
 from aiohttp.web_middlewares import middleware
 
+from fastjson import json_response
+
 
 @middleware
 async def serializer(req: web.Request, handler):
     res = await handler(req)
-    if isinstance(res, web.Response):
+    if isinstance(res, web.StreamResponse):
         return res
-    if 'status' in dir(res):
-        return web.json_response(res.to_json(), status=res.status)
+    plain = isinstance(res, (dict, list, str))
+    if not plain and hasattr(res, 'status'):
+        return json_response(res.to_json(), status=res.status)
     if req.method == 'DELETE':
         return web.Response(status=204)
     if req.method == 'POST':
         return web.Response(status=201)
     if isinstance(res, list):
-        return web.json_response(list(map(lambda x: x.to_json(), res)))
-    if not isinstance(res, str) and not isinstance(res, dict):
+        return json_response([x.to_json() for x in res])
+    if not plain:
         res = res.to_json()
-    return web.json_response(res)
+    return json_response(res)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+import deadline
+import metrics
+
+
+# Concurrent calls for the same key share one in-flight load. The load runs in its own
+# task, so the caller that started it can go away without failing the ones waiting on it;
+# every caller still waits no longer than its own request deadline.
+class SingleFlight:
+    name: str
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self.leaders = 0
+        self.collapsed = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def _start(self, keys: list, loader: Callable[[list], Awaitable[dict]]) -> asyncio.Task:
+        task = asyncio.create_task(loader(keys))
+        for key in keys:
+            self._calls[key] = task
+
+        def done(t: asyncio.Task):
+            for key in keys:
+                if self._calls.get(key) is t:
+                    del self._calls[key]
+            # waiters re-raise it themselves, nobody has to retrieve it
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(done)
+        return task
+
+    @staticmethod
+    async def _wait(task: asyncio.Task):
+        left = deadline.remaining()
+        if left is None:
+            return await asyncio.shield(task)
+        return await asyncio.wait_for(asyncio.shield(task), max(left, 0))
+
+    async def do_many(self, keys: Iterable[Hashable], loader: Callable[[list], Awaitable[dict]]) -> dict:
+        waiting: dict[asyncio.Task, list] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            task = self._calls.get(key)
+            if task is not None:
+                waiting.setdefault(task, []).append(key)
+            else:
+                missing.append(key)
+        collapsed = sum(len(ks) for ks in waiting.values())
+        if collapsed:
+            self.collapsed += collapsed
+            metrics.SINGLEFLIGHT_CALLS.labels(self.name, 'collapsed').inc(collapsed)
+        if missing:
+            self.leaders += 1
+            metrics.SINGLEFLIGHT_CALLS.labels(self.name, 'leader').inc()
+            waiting[self._start(missing, loader)] = missing
+
+        ret = {}
+        for task, task_keys in waiting.items():
+            loaded = await self._wait(task)
+            for key in task_keys:
+                if key in loaded:
+                    ret[key] = loaded[key]
+        return ret
+
+    async def do(self, key: Hashable, foo: Callable[[], Awaitable[Any]]) -> Any:
+        async def load_one(keys: list) -> dict:
+            return {key: await foo()}
+
+        return (await self.do_many([key], load_one))[key]
+
+    def stats(self) -> dict:
+        return {
+            'inFlight': len(set(self._calls.values())),
+            'leaders': self.leaders,
+            'collapsed': self.collapsed,
+        }
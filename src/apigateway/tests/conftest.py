@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the gateway modules import each other as top-level modules, as `python main.py` sees them
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
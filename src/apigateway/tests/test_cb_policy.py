@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+import cb_policy
+from cb_policy import LatencySketch, CountWindow, TimeWindow, FailureRatePolicy, MeanLatencyPolicy, SlowCallPolicy
+
+
+def test_count_window_keeps_last_calls():
+    window = CountWindow(3)
+    window.add(1.0, False)
+    window.add(0.1, True)
+    window.add(0.1, True)
+    window.add(0.2, True)
+
+    assert window.count == 3
+    assert window.success_count == 3
+    assert window.time_sum == pytest.approx(0.4)
+    assert sum(window.latency.counts) == 3
+    assert window.latency.quantile(1.0) < 1.0
+
+
+def test_count_window_wraps_around_many_times():
+    window = CountWindow(4)
+    for i in range(10):
+        window.add(0.01 * (i + 1), i % 2 == 0)
+
+    assert window.count == 4
+    assert window.success_count == 2
+    assert window.time_sum == pytest.approx(0.07 + 0.08 + 0.09 + 0.10)
+
+
+def test_count_window_reset():
+    window = CountWindow(2)
+    window.add(0.5, False)
+    window.reset()
+
+    assert (window.count, window.success_count, window.time_sum) == (0, 0, 0.0)
+    assert window.latency.quantile(0.5) == 0.0
+
+
+def test_latency_sketch_quantile_is_within_a_bucket():
+    sketch = LatencySketch()
+    for ms in range(1, 101):
+        sketch.add(LatencySketch.index(ms / 1000))
+
+    assert 0.050 <= sketch.quantile(0.5) <= 0.050 * LatencySketch.growth
+    assert 0.099 <= sketch.quantile(0.99) <= 0.099 * LatencySketch.growth
+
+
+def test_time_window_forgets_old_buckets(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cb_policy, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    window = TimeWindow(10.0, buckets=10)
+    window.add(0.1, False)
+    now[0] += 5
+    window.add(0.1, True)
+    assert (window.count, window.success_count) == (2, 1)
+
+    now[0] += 6
+    window.advance()
+    assert (window.count, window.success_count) == (1, 1)
+
+    now[0] += 10
+    window.advance()
+    assert window.count == 0
+    assert sum(window.latency.counts) == 0
+
+
+def test_failure_rate_policy():
+    policy = FailureRatePolicy(min_success_rate=0.5, min_calls=4)
+    window = CountWindow(10)
+    for ok in (False, False, False):
+        window.add(0.1, ok)
+    assert not policy.should_open(window)
+
+    window.add(0.1, True)
+    assert policy.should_open(window)
+
+    for _ in range(4):
+        window.add(0.1, True)
+    assert not policy.should_open(window)
+
+
+def test_mean_latency_policy():
+    policy = MeanLatencyPolicy(threshold_sec=1.0, min_calls=2)
+    window = CountWindow(10)
+    window.add(3.0, True)
+    assert not policy.should_open(window)
+
+    window.add(0.1, True)
+    assert policy.should_open(window)
+
+    for _ in range(2):
+        window.add(0.1, True)
+    assert not policy.should_open(window)
+
+
+def test_slow_call_policy_looks_at_the_tail():
+    policy = SlowCallPolicy(threshold_sec=1.0, quantile=0.9, min_calls=10)
+    window = CountWindow(100)
+    for _ in range(95):
+        window.add(0.01, True)
+    for _ in range(5):
+        window.add(5.0, True)
+    assert not policy.should_open(window)
+
+    for _ in range(10):
+        window.add(5.0, True)
+    assert policy.should_open(window)
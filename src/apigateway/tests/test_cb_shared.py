@@ -0,0 +1,102 @@
+import multiprocessing
+
+from cb_policy import FailureRatePolicy
+from cb_shared import SharedCircuitBreaker
+from circuit_breaker import CircuitBreakerState
+
+fork = multiprocessing.get_context('fork')
+
+
+def make_cb() -> SharedCircuitBreaker:
+    return SharedCircuitBreaker(policies=[FailureRatePolicy(min_success_rate=0.5, min_calls=4)],
+                                store_limit=4, half_open_threshold_sec=10)
+
+
+def in_worker(target, *args):
+    # a forked child sees the same shared mapping, just like a gateway worker does
+    worker = fork.Process(target=target, args=args)
+    worker.start()
+    worker.join(10)
+    assert worker.exitcode == 0
+
+
+def trip(cb: SharedCircuitBreaker, service_name: str):
+    for _ in range(4):
+        cb.try_acquire(service_name)
+        cb.observe(service_name, 0.1, False)
+    assert cb.get_state(service_name) == CircuitBreakerState.OPENED
+
+
+def test_workers_share_the_breaker_state():
+    cb = make_cb()
+    in_worker(trip, cb, 'ticket')
+
+    assert cb.get_state('ticket') == CircuitBreakerState.OPENED
+    assert cb.get_state('bonus') == CircuitBreakerState.CLOSED
+
+
+def test_only_state_listeners_hear_another_workers_transition():
+    cb = make_cb()
+    counted, seen = [], []
+    cb.listeners.append(lambda name, old, new: counted.append((name, old, new)))
+    cb.state_listeners.append(lambda name, old, new: seen.append((name, old, new)))
+    in_worker(trip, cb, 'ticket')
+
+    cb.get_state('ticket')
+    cb.get_state('ticket')
+    assert counted == []
+    assert seen == [('ticket', CircuitBreakerState.CLOSED, CircuitBreakerState.OPENED)]
+
+
+def test_own_transitions_reach_both_kinds_of_listeners():
+    cb = make_cb()
+    counted, seen = [], []
+    cb.listeners.append(lambda name, old, new: counted.append((name, old, new)))
+    cb.state_listeners.append(lambda name, old, new: seen.append((name, old, new)))
+    trip(cb, 'ticket')
+
+    assert counted == seen == [('ticket', CircuitBreakerState.CLOSED, CircuitBreakerState.OPENED)]
+
+
+def hold_lock(cb: SharedCircuitBreaker, locked, done):
+    with cb._lock.held(blocking=True):
+        locked.set()
+        done.wait(10)
+
+
+def test_busy_lock_drops_updates_instead_of_writing_unlocked():
+    cb = make_cb()
+    cb.get_state('ticket')
+    locked, done = fork.Event(), fork.Event()
+    worker = fork.Process(target=hold_lock, args=(cb, locked, done))
+    worker.start()
+    try:
+        assert locked.wait(10)
+        for _ in range(4):
+            assert cb.try_acquire('ticket') == CircuitBreakerState.CLOSED
+            cb.observe('ticket', 0.1, False)
+        assert cb.window('ticket').count == 0
+    finally:
+        done.set()
+        worker.join(10)
+
+    trip(cb, 'ticket')
+
+
+def test_busy_lock_lets_no_probe_through():
+    cb = make_cb()
+    cb.half_open_threshold_sec = 0
+    trip(cb, 'ticket')
+    locked, done = fork.Event(), fork.Event()
+    worker = fork.Process(target=hold_lock, args=(cb, locked, done))
+    worker.start()
+    try:
+        assert locked.wait(10)
+        # the half-open move itself needs the lock, and so does taking a probe slot
+        assert cb.get_state('ticket') == CircuitBreakerState.OPENED
+        assert cb.try_acquire('ticket') == CircuitBreakerState.OPENED
+    finally:
+        done.set()
+        worker.join(10)
+
+    assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import aiohttp.web_exceptions
+import pytest
+
+import circuit_breaker
+import deadline
+from cb_policy import FailureRatePolicy
+from circuit_breaker import CircuitBreaker, CircuitBreakerState
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # only the breaker's view of time: the event loop keeps the real clock
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker, 'time', SimpleNamespace(monotonic=lambda: now[0],
+                                                                 perf_counter=time.perf_counter))
+    return now
+
+
+def make_cb(**kwargs) -> CircuitBreaker:
+    kwargs.setdefault('store_limit', 4)
+    kwargs.setdefault('half_open_threshold_sec', 10)
+    return CircuitBreaker(policies=[FailureRatePolicy(min_success_rate=0.5, min_calls=4)], **kwargs)
+
+
+def fail(cb: CircuitBreaker, service_name: str, times: int):
+    for _ in range(times):
+        state = cb.try_acquire(service_name)
+        cb.observe(service_name, 0.1, False, probe=state == CircuitBreakerState.HALF_OPENED)
+    # the breaker opens on the next state check, which also stamps the time it opened
+    return cb.get_state(service_name)
+
+
+def test_opens_once_the_window_has_enough_failures(clock):
+    cb = make_cb()
+    fail(cb, 'ticket', 3)
+    assert cb.get_state('ticket') == CircuitBreakerState.CLOSED
+
+    fail(cb, 'ticket', 1)
+    assert cb.get_state('ticket') == CircuitBreakerState.OPENED
+    assert cb.get_state('bonus') == CircuitBreakerState.CLOSED
+
+
+def test_open_guard_rejects_without_calling(clock):
+    cb = make_cb()
+    fail(cb, 'ticket', 4)
+
+    with pytest.raises(aiohttp.web_exceptions.HTTPInternalServerError):
+        with cb.guard('ticket'):
+            pytest.fail('the call must not run while the breaker is open')
+
+
+def test_half_open_limits_probes(clock):
+    cb = make_cb(half_open_probes=2)
+    fail(cb, 'ticket', 4)
+    clock[0] += 10
+
+    assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
+    assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
+    assert cb.try_acquire('ticket') == CircuitBreakerState.OPENED
+
+    cb.observe('ticket', 0.1, True, probe=True)
+    assert cb.get_state('ticket') == CircuitBreakerState.HALF_OPENED
+    assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
+
+
+def test_probe_successes_close_and_reset_the_window(clock):
+    cb = make_cb(half_open_probes=2)
+    fail(cb, 'ticket', 4)
+    clock[0] += 10
+
+    for _ in range(2):
+        assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
+    cb.observe('ticket', 0.1, True, probe=True)
+    cb.observe('ticket', 0.1, True, probe=True)
+
+    assert cb.get_state('ticket') == CircuitBreakerState.CLOSED
+    assert cb.window('ticket').count == 0
+
+
+def test_failed_probe_reopens(clock):
+    cb = make_cb()
+    fail(cb, 'ticket', 4)
+    clock[0] += 10
+
+    assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
+    cb.observe('ticket', 0.1, False, probe=True)
+    assert cb.get_state('ticket') == CircuitBreakerState.OPENED
+
+    clock[0] += 9
+    assert cb.get_state('ticket') == CircuitBreakerState.OPENED
+    clock[0] += 1
+    assert cb.get_state('ticket') == CircuitBreakerState.HALF_OPENED
+
+
+def test_listeners_see_every_transition(clock):
+    cb = make_cb()
+    seen = []
+    cb.listeners.append(lambda name, old, new: seen.append((name, old, new)))
+    fail(cb, 'ticket', 4)
+    clock[0] += 10
+    cb.try_acquire('ticket')
+    cb.observe('ticket', 0.1, True, probe=True)
+
+    assert seen == [('ticket', CircuitBreakerState.CLOSED, CircuitBreakerState.OPENED),
+                    ('ticket', CircuitBreakerState.OPENED, CircuitBreakerState.HALF_OPENED),
+                    ('ticket', CircuitBreakerState.HALF_OPENED, CircuitBreakerState.CLOSED)]
+
+
+def test_guard_counts_errors_as_failures(clock):
+    cb = make_cb()
+    for _ in range(4):
+        with pytest.raises(RuntimeError):
+            with cb.guard('ticket'):
+                raise RuntimeError()
+
+    assert cb.get_state('ticket') == CircuitBreakerState.OPENED
+
+
+def test_guard_ignores_timeouts_of_a_client_shortened_deadline():
+    cb = make_cb()
+
+    async def call():
+        # what deadline_middleware sets up for a client asking for less than the default budget
+        deadline._deadline.set(time.monotonic() + 0.01)
+        deadline._shortened.set(True)
+        with cb.guard('ticket'):
+            await asyncio.wait_for(asyncio.sleep(1), deadline.call_timeout(5))
+
+    for _ in range(4):
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(call())
+
+    assert cb.window('ticket').count == 0
+    assert cb.get_state('ticket') == CircuitBreakerState.CLOSED
+
+
+def test_guard_releases_the_probe_on_a_spent_deadline(clock):
+    cb = make_cb()
+    fail(cb, 'ticket', 4)
+    clock[0] += 10
+
+    with pytest.raises(asyncio.TimeoutError):
+        with cb.guard('ticket'):
+            raise deadline.DeadlineExceeded()
+
+    assert cb.get_state('ticket') == CircuitBreakerState.HALF_OPENED
+    assert cb.try_acquire('ticket') == CircuitBreakerState.HALF_OPENED
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+
+import deadline
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_load():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'flight'
+
+    async def main():
+        sf = SingleFlight('test')
+        results = await asyncio.gather(*(sf.do('AFL031', load) for _ in range(5)))
+        return sf, results
+
+    sf, results = asyncio.run(main())
+    assert results == ['flight'] * 5
+    assert len(calls) == 1
+    assert (sf.leaders, sf.collapsed) == (1, 4)
+    assert not sf.in_flight('AFL031')
+
+
+def test_do_many_loads_only_the_keys_not_in_flight():
+    loaded = []
+
+    async def load(keys):
+        loaded.append(sorted(keys))
+        await asyncio.sleep(0.01)
+        return {key: key.lower() for key in keys}
+
+    async def main():
+        sf = SingleFlight('test')
+        first = asyncio.create_task(sf.do_many(['A', 'B'], load))
+        await asyncio.sleep(0)
+        second = await sf.do_many(['B', 'C', 'C'], load)
+        return await first, second
+
+    first, second = asyncio.run(main())
+    assert first == {'A': 'a', 'B': 'b'}
+    assert second == {'B': 'b', 'C': 'c'}
+    assert loaded == [['A', 'B'], ['C']]
+
+
+def test_cancelled_leader_does_not_fail_followers():
+    async def load():
+        await asyncio.sleep(0.02)
+        return 'flight'
+
+    async def main():
+        sf = SingleFlight('test')
+        leader = asyncio.create_task(sf.do('AFL031', load))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(sf.do('AFL031', load))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == 'flight'
+
+
+def test_errors_reach_every_caller_and_free_the_key():
+    attempts = []
+
+    async def load():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise RuntimeError('downstream failed')
+        return 'flight'
+
+    async def main():
+        sf = SingleFlight('test')
+        results = await asyncio.gather(sf.do('AFL031', load), sf.do('AFL031', load), return_exceptions=True)
+        assert not sf.in_flight('AFL031')
+        return results, await sf.do('AFL031', load)
+
+    results, retry = asyncio.run(main())
+    assert [type(r) for r in results] == [RuntimeError, RuntimeError]
+    assert retry == 'flight'
+    assert len(attempts) == 2
+
+
+def test_follower_waits_no_longer_than_its_deadline():
+    async def load():
+        await asyncio.sleep(0.2)
+        return 'flight'
+
+    async def follow(sf: SingleFlight):
+        deadline._deadline.set(time.monotonic() + 0.01)
+        return await sf.do('AFL031', load)
+
+    async def main():
+        sf = SingleFlight('test')
+        leader = asyncio.create_task(sf.do('AFL031', load))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.create_task(follow(sf))
+        # the shared load outlives the follower that gave up on it
+        return await leader
+
+    assert asyncio.run(main()) == 'flight'
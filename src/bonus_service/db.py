@@ -0,0 +1,51 @@
+# Kept byte-identical in ticket_service, flight_service and bonus_service: each service
+# is its own build context, so they cannot share a module. Change all three together.
+import os
+import weakref
+from dataclasses import dataclass
+
+import aiopg
+
+pool_min_size = int(os.environ.get('DB_POOL_MIN', 1))
+pool_max_size = int(os.environ.get('DB_POOL_MAX', 10))
+# off by default: the statements run as plain queries until a benchmark shows PREPARE pays off
+use_prepared = os.environ.get('DB_PREPARED_STATEMENTS', '0') == '1'
+
+
+@dataclass(frozen=True)
+class PreparedStatement:
+    name: str
+    param_types: tuple[str, ...]
+    query: str
+
+    def prepare_sql(self) -> str:
+        return f'PREPARE {self.name} ({", ".join(self.param_types)}) AS {self.query};'
+
+    def execute_sql(self) -> str:
+        return f'EXECUTE {self.name} ({", ".join(["%s"] * len(self.param_types))});'
+
+    def text_sql(self) -> str:
+        sql = self.query
+        for i in range(len(self.param_types), 0, -1):
+            sql = sql.replace(f'${i}', '%s')
+        return sql + ';'
+
+
+# statements are prepared lazily on each connection the first time they are used there,
+# so a fresh connection (or one made before migrations ran) never fails on PREPARE
+_prepared: weakref.WeakKeyDictionary[aiopg.Connection, set[str]] = weakref.WeakKeyDictionary()
+
+
+async def execute(cur: aiopg.Cursor, statement: PreparedStatement, args: tuple):
+    if not use_prepared:
+        await cur.execute(statement.text_sql(), args)
+        return
+    prepared = _prepared.setdefault(cur.connection, set())
+    if statement.name not in prepared:
+        await cur.execute(statement.prepare_sql())
+        prepared.add(statement.name)
+    await cur.execute(statement.execute_sql(), args)
+
+
+async def create_pool(dsn: str) -> aiopg.Pool:
+    return await aiopg.create_pool(dsn, minsize=pool_min_size, maxsize=pool_max_size)
@@ -1,17 +1,29 @@
+import base64
+import binascii
 import os
-from datetime import timezone
-from typing import Annotated
+from datetime import datetime, timezone
+from typing import Annotated, Optional
 from uuid import UUID
 
 import aiopg
 import fastapi.exceptions
-from fastapi import FastAPI, Header, APIRouter
+from fastapi import FastAPI, Header, APIRouter, Query
+from fastapi.responses import ORJSONResponse
 
-from schema import PrivilegeResponse, PrivilegeHistoryItemResponse, PushPrivilegeRequest, PrivilegeHistoryOperationType
+import db
+import metrics
+import migrate
+import queries
+from schema import PrivilegeResponse, PrivilegeHistoryItemResponse, PushPrivilegeRequest, PushPrivilegeResponse, \
+    PrivilegeHistoryOperationType, PrivilegeBalanceResponse, PrivilegeStatus, PushPrivilegeBatchRequest, \
+    PushPrivilegeBatchItem, PushPrivilegeBatchResponse, DropPrivilegeBatchRequest, DropPrivilegeBatchResponse
 
-app = FastAPI(root_path='/api/v1', )
+app = FastAPI(root_path='/api/v1', default_response_class=ORJSONResponse)
+metrics.init('bonus_service')
+app.middleware('http')(metrics.metrics_middleware)
 
 pool: aiopg.Pool
+max_history_limit = int(os.environ.get('PRIVILEGE_MAX_HISTORY_LIMIT', 1000))
 
 manage_router = APIRouter(prefix="/manage")
 
@@ -21,16 +33,46 @@ async def healthcheck():
     return fastapi.responses.Response()
 
 
+@manage_router.get('/metrics')
+async def prometheus_metrics():
+    return metrics.metrics_response()
+
+
 app.include_router(manage_router)
 
 
+def encode_cursor(dt: datetime, history_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{dt.isoformat()}|{history_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        dt, history_id = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode()).decode().split('|')
+        return datetime.fromisoformat(dt), int(history_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise fastapi.exceptions.HTTPException(400, 'Invalid cursor')
+
+
+@app.get('/privilege/balance')
+async def get_user_balance(x_user_name: Annotated[str, Header()]) -> PrivilegeBalanceResponse:
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await db.execute(cur, queries.PRIVILEGE_BY_USERNAME, (x_user_name,))
+            dat = await cur.fetchone()
+    if dat is None:
+        return PrivilegeBalanceResponse(balance=0, status=PrivilegeStatus.BRONZE)
+    _, status, balance = dat
+    return PrivilegeBalanceResponse(balance=balance or 0, status=status)
+
+
 @app.get('/privilege')
-async def get_user_privilege(x_user_name: Annotated[str, Header()]) -> PrivilegeResponse:
+async def get_user_privilege(x_user_name: Annotated[str, Header()],
+                             history: bool = True,
+                             historyLimit: Annotated[Optional[int], Query(ge=1, le=max_history_limit)] = None,
+                             after: Optional[str] = None) -> PrivilegeResponse:
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, status, balance '
-                              'FROM privilege '
-                              'WHERE username=%s;', (x_user_name,))
+            await db.execute(cur, queries.PRIVILEGE_BY_USERNAME, (x_user_name,))
             dat = await cur.fetchone()
 
             if dat is None:
@@ -45,69 +87,168 @@ async def get_user_privilege(x_user_name: Annotated[str, Header()]) -> Privilege
             privilege_id, status, balance = dat
             if balance is None:
                 balance = 0
-            history = []
-            await cur.execute('SELECT   ticket_uid, '
-                              '         datetime, '
-                              '         balance_diff, '
-                              '         operation_type '
-                              'FROM privilege_history '
-                              'WHERE privilege_id=%s;', (privilege_id,))
-            async for ticket_uid, dt, balance_diff, op_type in cur:
-                history.append(PrivilegeHistoryItemResponse(
-                    date=dt.replace(tzinfo=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    ticketUid=ticket_uid,
-                    balanceDiff=balance_diff,
-                    operationType=op_type
-                ))
-            return PrivilegeResponse(balance=balance, status=status, history=history)
+            if not history:
+                return PrivilegeResponse(balance=balance, status=status, history=[])
+
+            after_dt, after_id = decode_cursor(after) if after is not None else (datetime.min, 0)
+            await db.execute(cur, queries.PRIVILEGE_HISTORY_PAGE,
+                             (privilege_id, after_dt, after_id, historyLimit + 1 if historyLimit is not None else None))
+            rows = await cur.fetchall()
+
+    next_cursor = None
+    if historyLimit is not None and len(rows) > historyLimit:
+        rows = rows[:historyLimit]
+        next_cursor = encode_cursor(rows[-1][2], rows[-1][0])
+    items = []
+    for _, ticket_uid, dt, balance_diff, op_type in rows:
+        items.append(PrivilegeHistoryItemResponse(
+            date=dt.replace(tzinfo=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            ticketUid=ticket_uid,
+            balanceDiff=balance_diff,
+            operationType=op_type
+        ))
+    return PrivilegeResponse(balance=balance, status=status, history=items, nextCursor=next_cursor)
+
+
+def compute_balance_diff(body: PushPrivilegeRequest, balance: int) -> int:
+    if body.operationType == PrivilegeHistoryOperationType.FILL_IN_BALANCE:
+        return int(body.price * 0.1)
+    return -1 * min(balance, body.price)
 
 
 @app.post('/privilege')
-async def push_privilege(body: PushPrivilegeRequest, x_user_name: Annotated[str, Header()]):
+async def push_privilege(body: PushPrivilegeRequest, x_user_name: Annotated[str, Header()]) -> PushPrivilegeResponse:
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, status, balance '
-                              'FROM privilege '
-                              'WHERE username=%s;', (x_user_name,))
-            privilege_id, status, balance = await cur.fetchone()
-            balance_diff = body.price
-            if body.operationType == PrivilegeHistoryOperationType.FILL_IN_BALANCE:
-                balance_diff = int(balance_diff * 0.1)
-            else:
-                balance_diff = -1 * min(balance, balance_diff)
-            await cur.execute('INSERT INTO privilege_history '
-                              '     (privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
-                              'VALUES (%s, %s, CURRENT_TIMESTAMP, %s, %s);',
-                              (privilege_id, body.ticket_uid, balance_diff, str(body.operationType.name)))
-
-            await cur.execute('UPDATE privilege '
-                              'SET balance=balance+%s '
-                              'WHERE id=%s;', (balance_diff, privilege_id))
+            async with cur.begin():
+                await cur.execute('INSERT INTO privilege '
+                                  '     (username, balance) '
+                                  'VALUES '
+                                  '     (%s, 0) '
+                                  'ON CONFLICT (username) DO NOTHING;', (x_user_name,))
+                await cur.execute('SELECT   id, COALESCE(balance, 0) '
+                                  'FROM privilege '
+                                  'WHERE username=%s '
+                                  'FOR UPDATE;', (x_user_name,))
+                privilege_id, balance = await cur.fetchone()
+                balance_diff = compute_balance_diff(body, balance)
+                await cur.execute('INSERT INTO privilege_history '
+                                  '     (privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+                                  'VALUES (%s, %s, CURRENT_TIMESTAMP, %s, %s);',
+                                  (privilege_id, body.ticket_uid, balance_diff, str(body.operationType.name)))
+
+                await cur.execute('UPDATE privilege '
+                                  'SET balance=COALESCE(balance, 0)+%s '
+                                  'WHERE id=%s '
+                                  'RETURNING balance, status;', (balance_diff, privilege_id))
+                balance, status = await cur.fetchone()
+    return PushPrivilegeResponse(balance=balance, status=status, balanceDiff=balance_diff)
+
+
+@app.post('/privilege/batch')
+async def push_privilege_batch(body: PushPrivilegeBatchRequest,
+                               x_user_name: Annotated[str, Header()]) -> PushPrivilegeBatchResponse:
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            async with cur.begin():
+                await cur.execute('INSERT INTO privilege '
+                                  '     (username, balance) '
+                                  'VALUES '
+                                  '     (%s, 0) '
+                                  'ON CONFLICT (username) DO NOTHING;', (x_user_name,))
+                await cur.execute('SELECT   id, COALESCE(balance, 0) '
+                                  'FROM privilege '
+                                  'WHERE username=%s '
+                                  'FOR UPDATE;', (x_user_name,))
+                privilege_id, balance = await cur.fetchone()
+
+                # items apply in order, a debit sees the accruals before it
+                items = []
+                args = []
+                total = 0
+                for item in body.items:
+                    balance_diff = compute_balance_diff(item, balance + total)
+                    total += balance_diff
+                    items.append(PushPrivilegeBatchItem(ticket_uid=item.ticket_uid, balanceDiff=balance_diff))
+                    args += [privilege_id, item.ticket_uid, balance_diff, str(item.operationType.name)]
+                if items:
+                    await cur.execute('INSERT INTO privilege_history '
+                                      '     (privilege_id, ticket_uid, datetime, balance_diff, operation_type) '
+                                      'VALUES ' + ', '.join(['(%s, %s, CURRENT_TIMESTAMP, %s, %s)'] * len(items)) + ';',
+                                      args)
+
+                await cur.execute('UPDATE privilege '
+                                  'SET balance=COALESCE(balance, 0)+%s '
+                                  'WHERE id=%s '
+                                  'RETURNING balance, status;', (total, privilege_id))
+                balance, status = await cur.fetchone()
+    return PushPrivilegeBatchResponse(balance=balance, status=status, items=items)
+
+
+@app.delete('/privilege/batch')
+async def drop_privilege_batch(body: DropPrivilegeBatchRequest,
+                               x_user_name: Annotated[str, Header()]) -> DropPrivilegeBatchResponse:
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            async with cur.begin():
+                await cur.execute('SELECT   id, COALESCE(balance, 0) '
+                                  'FROM privilege '
+                                  'WHERE username=%s '
+                                  'FOR UPDATE;', (x_user_name,))
+                dat = await cur.fetchone()
+                if dat is None:
+                    return DropPrivilegeBatchResponse(dropped=[])
+                privilege_id, balance = dat
+
+                await cur.execute('DELETE FROM privilege_history '
+                                  'WHERE privilege_id=%s AND ticket_uid = ANY(%s) '
+                                  'RETURNING ticket_uid, balance_diff;', (privilege_id, body.ticketUids))
+                # a ticket may have more than one history row, its correction is their sum
+                diffs = {}
+                for ticket_uid, balance_diff in await cur.fetchall():
+                    diffs[ticket_uid] = diffs.get(ticket_uid, 0) + balance_diff
+                # entry by entry in request order, exactly as that many single drops would go
+                dropped = [ticket_uid for ticket_uid in dict.fromkeys(body.ticketUids) if ticket_uid in diffs]
+                for ticket_uid in dropped:
+                    balance -= min(balance, diffs[ticket_uid])
+                await cur.execute('UPDATE privilege '
+                                  'SET balance=%s '
+                                  'WHERE id=%s;', (balance, privilege_id))
+    return DropPrivilegeBatchResponse(dropped=dropped)
 
 
 @app.delete('/privilege/{ticketUid}')
 async def drop_privilege(ticketUid: UUID):
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, privilege_id, balance_diff, operation_type '
-                              'FROM privilege_history '
-                              'WHERE ticket_uid=%s;', (ticketUid,))
-            dat = await cur.fetchone()
-            if dat is None:
-                raise fastapi.exceptions.HTTPException(404)
+            async with cur.begin():
+                await cur.execute('SELECT   privilege_id '
+                                  'FROM privilege_history '
+                                  'WHERE ticket_uid=%s;', (ticketUid,))
+                dat = await cur.fetchone()
+                if dat is None:
+                    raise fastapi.exceptions.HTTPException(404)
 
-            history_id, privilege_id, balance_diff, op_type = dat
-            await cur.execute('SELECT   id, status, balance '
-                              'FROM privilege '
-                              'WHERE id=%s;', (privilege_id,))
+                # the privilege row is locked before its history, like every other writer does
+                privilege_id, = dat
+                await cur.execute('SELECT   balance '
+                                  'FROM privilege '
+                                  'WHERE id=%s '
+                                  'FOR UPDATE;', (privilege_id,))
+                balance, = await cur.fetchone()
 
-            privilege_id, status, balance = await cur.fetchone()
-            await cur.execute('DELETE FROM privilege_history '
-                              'WHERE ticket_uid=%s;', (ticketUid,))
+                # a concurrent revoke of the same ticket finds nothing left to delete
+                await cur.execute('DELETE FROM privilege_history '
+                                  'WHERE ticket_uid=%s AND privilege_id=%s '
+                                  'RETURNING balance_diff;', (ticketUid, privilege_id))
+                dat = await cur.fetchall()
+                if not dat:
+                    raise fastapi.exceptions.HTTPException(404)
 
-            await cur.execute('UPDATE privilege '
-                              'SET balance=balance-%s '
-                              'WHERE id=%s;', (min(balance, balance_diff), privilege_id))
+                balance_diff = sum(diff for diff, in dat)
+                await cur.execute('UPDATE privilege '
+                                  'SET balance=balance-%s '
+                                  'WHERE id=%s;', (min(balance, balance_diff), privilege_id))
 
 
 @app.on_event("startup")
@@ -118,29 +259,7 @@ async def startup_event():
     host = os.environ.get('DB_HOST', '0.0.0.0')
     password = os.environ.get('DB_PASSWORD', '0.0.0.0')
     dsn = f'dbname={dbname} user={user} password={password} host={host}'
-    pool = await aiopg.create_pool(dsn)
+    pool = await db.create_pool(dsn)
+    metrics.instrument_pool(pool)
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('''
-            CREATE TABLE IF NOT EXISTS privilege
-(
-    id       SERIAL PRIMARY KEY,
-    username VARCHAR(80) NOT NULL UNIQUE,
-    status   VARCHAR(80) NOT NULL DEFAULT 'BRONZE'
-        CHECK (status IN ('BRONZE', 'SILVER', 'GOLD')),
-    balance  INT
-);
-            ''')
-            await cur.execute('''
-            CREATE TABLE IF NOT EXISTS privilege_history
-(
-    id             SERIAL PRIMARY KEY,
-    privilege_id   INT REFERENCES privilege (id),
-    ticket_uid     uuid        NOT NULL,
-    datetime       TIMESTAMP   NOT NULL,
-    balance_diff   INT         NOT NULL,
-    operation_type VARCHAR(20) NOT NULL
-        CHECK (operation_type IN ('FILL_IN_BALANCE', 'DEBIT_THE_ACCOUNT'))
-);
-''')
\ No newline at end of file
+    await migrate.migrate(pool)
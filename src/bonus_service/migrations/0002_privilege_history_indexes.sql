@@ -0,0 +1,3 @@
+-- migrate: no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS privilege_history_privilege_id_datetime_idx
+    ON privilege_history (privilege_id, datetime, id);
@@ -0,0 +1,3 @@
+-- migrate: no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS privilege_history_ticket_uid_idx
+    ON privilege_history (ticket_uid);
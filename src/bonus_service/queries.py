@@ -0,0 +1,18 @@
+from db import PreparedStatement
+
+PRIVILEGE_BY_USERNAME = PreparedStatement('privilege_by_username', ('varchar',),
+                                          'SELECT   id, status, balance '
+                                          'FROM privilege '
+                                          'WHERE username=$1')
+
+PRIVILEGE_HISTORY_PAGE = PreparedStatement('privilege_history_page', ('int', 'timestamp', 'int', 'bigint'),
+                                           'SELECT   id, '
+                                           '         ticket_uid, '
+                                           '         datetime, '
+                                           '         balance_diff, '
+                                           '         operation_type '
+                                           'FROM privilege_history '
+                                           'WHERE privilege_id=$1 '
+                                           '  AND (datetime, id) > ($2, $3) '
+                                           'ORDER BY datetime ASC, id ASC '
+                                           'LIMIT $4')
@@ -1,6 +1,5 @@
-import datetime
 from enum import Enum
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 from pydantic import BaseModel
@@ -28,9 +27,44 @@ class PrivilegeResponse(BaseModel):
     balance: int
     status: PrivilegeStatus
     history: List[PrivilegeHistoryItemResponse]
+    nextCursor: Optional[str] = None
+
+
+class PrivilegeBalanceResponse(BaseModel):
+    balance: int
+    status: PrivilegeStatus
 
 
 class PushPrivilegeRequest(BaseModel):
     operationType: PrivilegeHistoryOperationType
     price: int
     ticket_uid: UUID
+
+
+class PushPrivilegeResponse(BaseModel):
+    balance: int
+    status: PrivilegeStatus
+    balanceDiff: int
+
+
+class PushPrivilegeBatchRequest(BaseModel):
+    items: List[PushPrivilegeRequest]
+
+
+class PushPrivilegeBatchItem(BaseModel):
+    ticket_uid: UUID
+    balanceDiff: int
+
+
+class PushPrivilegeBatchResponse(BaseModel):
+    balance: int
+    status: PrivilegeStatus
+    items: List[PushPrivilegeBatchItem]
+
+
+class DropPrivilegeBatchRequest(BaseModel):
+    ticketUids: List[UUID]
+
+
+class DropPrivilegeBatchResponse(BaseModel):
+    dropped: List[UUID]
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from typing import Optional, Iterable
+
+import aiopg
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+from schema import Airport
+
+AIRPORT_CHANNEL = 'airport_changed'
+
+
+class AirportDirectory:
+    airports: dict[int, Airport]
+    ttl_sec: float
+    hits: int
+    misses: int
+    reloads: int
+
+    def __init__(self, ttl_sec: float = 300):
+        self.airports = {}
+        self.ttl_sec = ttl_sec
+        self.expires_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._pool: Optional[aiopg.Pool] = None
+        self._lock = asyncio.Lock()
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self, pool: aiopg.Pool, dsn: str):
+        self._pool = pool
+        await self.reload()
+        self._listener = asyncio.create_task(self._listen(dsn))
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+    def invalidate(self):
+        self.expires_at = 0.0
+
+    async def reload(self):
+        async with self._lock:
+            if time.monotonic() < self.expires_at:
+                return
+            airports = {}
+            async with self._pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('SELECT   id, '
+                                      '         name, '
+                                      '         city, '
+                                      '         country '
+                                      'FROM airport;')
+                    async for airport_id, name, city, country in cur:
+                        airports[airport_id] = Airport(id=airport_id, name=name, city=city, country=country, )
+            self.airports = airports
+            self.expires_at = time.monotonic() + self.ttl_sec
+            self.reloads += 1
+
+    async def _fetch(self, airport_ids: list[int]):
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT   id, '
+                                  '         name, '
+                                  '         city, '
+                                  '         country '
+                                  'FROM airport '
+                                  'WHERE id = ANY(%s);', (airport_ids,))
+                async for airport_id, name, city, country in cur:
+                    self.airports[airport_id] = Airport(id=airport_id, name=name, city=city, country=country, )
+
+    async def get_many(self, airport_ids: Iterable[int]) -> dict[int, Airport]:
+        if time.monotonic() >= self.expires_at:
+            await self.reload()
+        airport_ids = set(airport_ids)
+        missing = [i for i in airport_ids if i not in self.airports]
+        self.hits += len(airport_ids) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            await self._fetch(missing)
+        return {i: self.airports[i] for i in airport_ids if i in self.airports}
+
+    async def get(self, airport_id: int) -> Optional[Airport]:
+        return (await self.get_many([airport_id])).get(airport_id)
+
+    async def all(self) -> list[Airport]:
+        if time.monotonic() >= self.expires_at:
+            await self.reload()
+        self.hits += 1
+        return sorted(self.airports.values(), key=lambda a: a.id)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.airports),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'ttlSec': self.ttl_sec,
+            'expiresInSec': max(0.0, self.expires_at - time.monotonic()),
+        }
+
+    async def _listen(self, dsn: str):
+        while True:
+            try:
+                async with aiopg.connect(dsn) as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(f'LISTEN {AIRPORT_CHANNEL};')
+                    # anything may have changed while we were not listening
+                    self.invalidate()
+                    while True:
+                        await conn.notifies.get()
+                        print('[airports] airport table changed, invalidating cache')
+                        self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'[airports] listener failed: {e!r}')
+                await asyncio.sleep(5)
+
+
+airports = AirportDirectory()
+
+
+class AirportCacheCollector:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def collect(self):
+        stats = self.directory.stats()
+        entries = GaugeMetricFamily('flight_service_airport_cache_entries', 'Airports held in memory')
+        entries.add_metric([], stats['size'])
+        lookups = CounterMetricFamily('flight_service_airport_cache_lookups', 'Airport cache lookups by result',
+                                      labels=['result'])
+        lookups.add_metric(['hit'], stats['hits'])
+        lookups.add_metric(['miss'], stats['misses'])
+        reloads = CounterMetricFamily('flight_service_airport_cache_reloads', 'Full reloads of the airport cache')
+        reloads.add_metric([], stats['reloads'])
+        yield entries
+        yield lookups
+        yield reloads
+
+
+def instrument_airports(directory):
+    REGISTRY.register(AirportCacheCollector(directory))
@@ -1,18 +1,33 @@
-import datetime
+import base64
+import binascii
+import bisect
 import os
-from collections import namedtuple
-from typing import Optional, List
+import time
+from typing import Annotated, Optional, List
 
 import aiopg
 import fastapi
-from fastapi import FastAPI, APIRouter
-
+from fastapi import FastAPI, APIRouter, Query
+from fastapi.responses import ORJSONResponse
+
+from airports import airports, instrument_airports
+import db
+import metrics
+import migrate
+import queries
 from schema import Airport, Flight, PagedResponse
 
-app = FastAPI(root_path='/api/v1', )
+app = FastAPI(root_path='/api/v1', default_response_class=ORJSONResponse)
+metrics.init('flight_service')
+app.middleware('http')(metrics.metrics_middleware)
 
 pool: aiopg.Pool
 
+flight_count: Optional[int] = None
+flight_count_expires_at: float = 0.0
+flight_count_ttl_sec = float(os.environ.get('FLIGHT_COUNT_TTL_SEC', 10))
+max_page_size = int(os.environ.get('FLIGHT_MAX_PAGE_SIZE', 1000))
+
 manage_router = APIRouter(prefix="/manage")
 
 
@@ -21,112 +36,144 @@ async def healthcheck():
     return fastapi.responses.Response()
 
 
+@manage_router.get('/metrics')
+async def prometheus_metrics():
+    return metrics.metrics_response()
+
+
+@manage_router.get('/airports')
+async def airport_cache_stats():
+    return airports.stats()
+
+
+@manage_router.post('/airports/refresh')
+async def airport_cache_refresh():
+    airports.invalidate()
+    await airports.reload()
+    return airports.stats()
+
+
 app.include_router(manage_router)
 
 
 @app.get('/airport/{airport_id}')
 async def get_airport_by_id(airport_id: int) -> Airport:
+    airport = await airports.get(airport_id)
+    if airport is None:
+        raise fastapi.exceptions.HTTPException(404)
+    return airport
+
+
+async def flights_from_rows(rows) -> List[Flight]:
+    known_airports = await airports.get_many(i for row in rows for i in (row[3], row[4]))
+    ret = []
+    for flight_id, flight_number, dt, from_id, to_id, price in rows:
+        from_airport = known_airports[from_id]
+        to_airport = known_airports[to_id]
+        ret.append(Flight(id=flight_id,
+                          flightNumber=flight_number,
+                          date=dt.strftime('%Y-%m-%d %H:%M'),
+                          fromAirport=from_airport.city + ' ' + from_airport.name,
+                          toAirport=to_airport.city + ' ' + to_airport.name,
+                          price=price))
+    return ret
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode()).decode())
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise fastapi.exceptions.HTTPException(400, 'Invalid cursor')
+
+
+async def count_flights() -> int:
+    global flight_count, flight_count_expires_at
+    if flight_count is not None and time.monotonic() < flight_count_expires_at:
+        return flight_count
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, '
-                              '         name, '
-                              '         city, '
-                              '         country '
-                              'FROM airport '
-                              'WHERE id=%s;', (airport_id,))
-            dat = await cur.fetchone()
-            if dat is None:
-                raise fastapi.exceptions.HTTPException(404)
-            airport_id, name, city, country = dat
-            return Airport(id=airport_id, name=name, city=city, country=country, )
+            await cur.execute('SELECT count(*) FROM flight;')
+            flight_count, = await cur.fetchone()
+    flight_count_expires_at = time.monotonic() + flight_count_ttl_sec
+    return flight_count
 
 
 @app.get('/flight/{flightNumber}')
 async def get_flight_by_number(flightNumber: str) -> Flight:
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   flight.id, '
-                              '         flight.flight_number, '
-                              '         flight.datetime, '
-                              '         flight.from_airport_id, '
-                              '         flight.to_airport_id, '
-                              '         flight.price '
-                              'FROM flight '
-                              'WHERE flight_number=%s '
-                              'ORDER BY flight.datetime DESC '
-                              'LIMIT 1;', (flightNumber,))
+            await db.execute(cur, queries.FLIGHT_BY_NUMBER, (flightNumber,))
             dat = await cur.fetchone()
             if dat is None:
                 raise fastapi.exceptions.HTTPException(404)
-            flight_id, flight_number, flight_datetime, flight_from_airport_id, flight_to_airport_id, flight_price = dat
-    from_airport = await get_airport_by_id(flight_from_airport_id)
-    to_airport = await get_airport_by_id(flight_to_airport_id)
+    return (await flights_from_rows([dat]))[0]
+
 
-    return Flight(id=flight_id,
-                  flightNumber=flight_number,
-                  date=flight_datetime.strftime('%Y-%m-%d %H:%M'),
-                  fromAirport=from_airport.city + ' ' + from_airport.name,
-                  toAirport=to_airport.city + ' ' + to_airport.name,
-                  price=flight_price)
+@app.get('/flights/batch')
+async def get_flights_by_numbers(numbers: str) -> List[Flight]:
+    flight_numbers = list({n for n in numbers.split(',') if n})
+    if not flight_numbers:
+        return []
+
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await db.execute(cur, queries.FLIGHTS_BY_NUMBERS, (flight_numbers,))
+            rows = await cur.fetchall()
+    return await flights_from_rows(rows)
 
 
 @app.get('/flights')
-async def get_all_flights(page: Optional[int] = None,
-                          size: Optional[int] = None) -> PagedResponse[Flight]:
+async def get_all_flights(page: Annotated[Optional[int], Query(ge=0)] = None,
+                          size: Annotated[Optional[int], Query(ge=1, le=max_page_size)] = None,
+                          after: Optional[str] = None) -> PagedResponse[Flight]:
     size = size or 100
     page = page or 0
     offset = page * size
-    ret = []
-
-    FlightRaw = namedtuple('FlightRaw', ['flight_id', 'flight_number', 'dt', 'from_id', 'to_id', 'price'])
 
-    flight_raws = []
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   flight.id, '
-                              '         flight.flight_number, '
-                              '         flight.datetime, '
-                              '         flight.from_airport_id, '
-                              '         flight.to_airport_id, '
-                              '         flight.price '
-                              'FROM flight '
-                              'ORDER BY flight.id ASC '
-                              'OFFSET %s '
-                              'LIMIT %s;', (offset, size,))
-            async for row in cur:
-                flight_raws.append(FlightRaw(*row))
-
-    for flight_raw in flight_raws:
-        from_airport = await get_airport_by_id(flight_raw.from_id)
-        to_airport = await get_airport_by_id(flight_raw.to_id)
-        ret.append(Flight(id=flight_raw.flight_id,
-                          flightNumber=flight_raw.flight_number,
-                          date=flight_raw.dt.strftime('%Y-%m-%d %H:%M'),
-                          fromAirport=from_airport.city + ' ' + from_airport.name,
-                          toAirport=to_airport.city + ' ' + to_airport.name,
-                          price=flight_raw.price))
-
-    return PagedResponse(page=page, pageSize=size, totalElements=len(ret), items=ret)
+            if after is not None:
+                await cur.execute('SELECT ' + queries.FLIGHT_COLUMNS + queries.FLIGHT_FROM +
+                                  'WHERE flight.id > %s '
+                                  'ORDER BY flight.id ASC '
+                                  'LIMIT %s;', (decode_cursor(after), size + 1,))
+            else:
+                await cur.execute('SELECT ' + queries.FLIGHT_COLUMNS + queries.FLIGHT_FROM +
+                                  'ORDER BY flight.id ASC '
+                                  'OFFSET %s '
+                                  'LIMIT %s;', (offset, size + 1,))
+            rows = await cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = encode_cursor(rows[-1][0])
+    ret = await flights_from_rows(rows)
+
+    return PagedResponse(page=page, pageSize=size, totalElements=await count_flights(), items=ret,
+                         nextCursor=next_cursor)
 
 
 @app.get('/airports')
-async def get_all_airports(page: Optional[int] = None, size: Optional[int] = None) -> List[Airport]:
+async def get_all_airports(response: fastapi.Response,
+                           page: Annotated[Optional[int], Query(ge=0)] = None,
+                           size: Annotated[Optional[int], Query(ge=1, le=max_page_size)] = None,
+                           after: Optional[str] = None) -> List[Airport]:
     size = size or 100
-    offset = (page or 0) * size
-    ret = []
-
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, '
-                              '         name, '
-                              '         city, '
-                              '         country '
-                              'FROM airport '
-                              'ORDER BY id ASC '
-                              'OFFSET %s '
-                              'LIMIT %s;', (offset, size,))
-            async for airport_id, name, city, country in cur:
-                ret.append(Airport(id=airport_id, name=name, city=city, country=country, ))
+    all_airports = await airports.all()
+    if after is not None:
+        offset = bisect.bisect_right(all_airports, decode_cursor(after), key=lambda a: a.id)
+    else:
+        offset = (page or 0) * size
+    ret = all_airports[offset:offset + size]
+
+    response.headers['X-Total-Count'] = str(len(all_airports))
+    if offset + size < len(all_airports):
+        response.headers['X-Next-Cursor'] = encode_cursor(ret[-1].id)
     return ret
 
 
@@ -138,41 +185,16 @@ async def startup_event():
     host = os.environ.get('DB_HOST', '0.0.0.0')
     password = os.environ.get('DB_PASSWORD', '0.0.0.0')
     dsn = f'dbname={dbname} user={user} password={password} host={host}'
-    pool = await aiopg.create_pool(dsn)
+    pool = await db.create_pool(dsn)
+    metrics.instrument_pool(pool)
+    instrument_airports(airports)
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('''
-            CREATE TABLE IF NOT EXISTS airport
-(
-    id      SERIAL PRIMARY KEY,
-    name    VARCHAR(255),
-    city    VARCHAR(255),
-    country VARCHAR(255)
-);''')
-            await cur.execute('''
-            CREATE TABLE IF NOT EXISTS flight
-(
-    id              SERIAL PRIMARY KEY,
-    flight_number   VARCHAR(20)              NOT NULL,
-    datetime        TIMESTAMP WITH TIME ZONE NOT NULL,
-    from_airport_id INT REFERENCES airport (id),
-    to_airport_id   INT REFERENCES airport (id),
-    price           INT                      NOT NULL
-);
-            ''')
-
-            await cur.execute('INSERT INTO airport '
-                              ' (id, name, city, country) '
-                              'VALUES '
-                              ' (%s, %s, %s, %s)', (1, 'Шереметьево', 'Москва', 'Россия'))
-
-            await cur.execute('INSERT INTO airport '
-                              ' (id, name, city, country) '
-                              'VALUES '
-                              ' (%s, %s, %s, %s)', (2, 'Пулково', 'Санкт-Петербург', 'Россия'))
-
-            await cur.execute('INSERT INTO flight '
-                              '   (flight_number, datetime, from_airport_id, to_airport_id, price) '
-                              'VALUES '
-                              '   (%s, %s, %s, %s, %s);', ('AFL031', '2021-10-08 20:00', 2, 1, 1500))
+    await migrate.migrate(pool)
+
+    airports.ttl_sec = float(os.environ.get('AIRPORT_CACHE_TTL_SEC', airports.ttl_sec))
+    await airports.start(pool, dsn)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await airports.stop()
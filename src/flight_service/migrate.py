@@ -0,0 +1,94 @@
+# Kept byte-identical in ticket_service, flight_service and bonus_service: each service
+# is its own build context, so they cannot share a module. Change all three together.
+import asyncio
+import re
+from pathlib import Path
+
+import aiopg
+from psycopg2 import sql
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+# first line of a migration that must run outside a transaction (CREATE INDEX CONCURRENTLY);
+# postgres wraps a multi-statement query into one implicit transaction, so such a file
+# has to hold a single statement
+NO_TRANSACTION = '-- migrate: no-transaction'
+# any constant works as long as every replica of a service uses the same one
+LOCK_ID = 0x6d696772
+LOCK_RETRY_SEC = 1.0
+INDEX_NAME = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(?:"([^"]+)"|(\w+))',
+                        re.IGNORECASE)
+
+
+def pending_migrations(applied: set[str], path: Path = MIGRATIONS_DIR) -> list[Path]:
+    return [p for p in sorted(path.glob('*.sql')) if p.stem not in applied]
+
+
+def declared_indexes(path: Path = MIGRATIONS_DIR) -> set[str]:
+    # names as postgres stores them: unquoted identifiers fold to lower case
+    names = set()
+    for migration in path.glob('*.sql'):
+        for quoted, plain in INDEX_NAME.findall(migration.read_text()):
+            names.add(quoted or plain.lower())
+    return names
+
+
+async def acquire_lock(cur):
+    # Replicas starting together wait here instead of racing on the same DDL. They poll rather
+    # than block in pg_advisory_lock: a blocked session holds a snapshot, and CREATE INDEX
+    # CONCURRENTLY in the replica holding the lock would wait for that snapshot forever.
+    while True:
+        await cur.execute('SELECT pg_try_advisory_lock(%s);', (LOCK_ID,))
+        locked, = await cur.fetchone()
+        if locked:
+            return
+        print('[MIGRATE] another replica is migrating, waiting')
+        await asyncio.sleep(LOCK_RETRY_SEC)
+
+
+async def drop_invalid_indexes(cur, names: set[str]):
+    # a CREATE INDEX CONCURRENTLY that died half-way leaves an INVALID index behind, which
+    # IF NOT EXISTS would then skip forever; with the lock held none of ours can be in progress.
+    # Only our own are dropped: any other invalid index may be someone's build still running.
+    if not names:
+        return
+    await cur.execute('SELECT c.relname '
+                      'FROM pg_index i '
+                      '         JOIN pg_class c ON c.oid = i.indexrelid '
+                      '         JOIN pg_namespace n ON n.oid = c.relnamespace '
+                      'WHERE NOT i.indisvalid AND n.nspname = current_schema() AND c.relname = ANY(%s);',
+                      (sorted(names),))
+    for name, in await cur.fetchall():
+        print(f'[MIGRATE] dropping invalid index {name}')
+        await cur.execute(sql.SQL('DROP INDEX CONCURRENTLY IF EXISTS {};').format(sql.Identifier(name)))
+
+
+async def migrate(pool: aiopg.Pool, path: Path = MIGRATIONS_DIR):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await acquire_lock(cur)
+            try:
+                await cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations
+(
+    version    VARCHAR(255) PRIMARY KEY,
+    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);''')
+                await cur.execute('SELECT version FROM schema_migrations;')
+                applied = {version for version, in await cur.fetchall()}
+                await drop_invalid_indexes(cur, declared_indexes(path))
+
+                for migration in pending_migrations(applied, path):
+                    sql = migration.read_text()
+                    print(f'[MIGRATE] applying {migration.name}')
+                    if sql.startswith(NO_TRANSACTION):
+                        await cur.execute(sql)
+                        await cur.execute('INSERT INTO schema_migrations (version) VALUES (%s);',
+                                          (migration.stem,))
+                    else:
+                        async with cur.begin():
+                            await cur.execute(sql)
+                            await cur.execute('INSERT INTO schema_migrations (version) VALUES (%s);',
+                                              (migration.stem,))
+            finally:
+                await cur.execute('SELECT pg_advisory_unlock(%s);', (LOCK_ID,))
+
@@ -15,3 +15,17 @@ CREATE TABLE IF NOT EXISTS flight
     to_airport_id   INT REFERENCES airport (id),
     price           INT                      NOT NULL
 );
+
+CREATE OR REPLACE FUNCTION notify_airport_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('airport_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS airport_changed ON airport;
+CREATE TRIGGER airport_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON airport
+    FOR EACH STATEMENT
+EXECUTE FUNCTION notify_airport_changed();
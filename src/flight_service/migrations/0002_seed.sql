@@ -0,0 +1,14 @@
+INSERT INTO airport
+    (id, name, city, country)
+VALUES
+    (1, 'Шереметьево', 'Москва', 'Россия'),
+    (2, 'Пулково', 'Санкт-Петербург', 'Россия')
+ON CONFLICT (id) DO NOTHING;
+
+-- the ids above were given explicitly, the sequence has to catch up with them
+SELECT setval(pg_get_serial_sequence('airport', 'id'), (SELECT max(id) FROM airport));
+
+INSERT INTO flight
+    (flight_number, datetime, from_airport_id, to_airport_id, price)
+SELECT 'AFL031', '2021-10-08 20:00', 2, 1, 1500
+WHERE NOT EXISTS (SELECT 1 FROM flight WHERE flight_number = 'AFL031');
@@ -0,0 +1,3 @@
+-- migrate: no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flight_flight_number_datetime_idx
+    ON flight (flight_number, datetime DESC);
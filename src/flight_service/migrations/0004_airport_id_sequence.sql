@@ -0,0 +1,2 @@
+-- databases seeded before 0002 advanced the airport sequence still hand out taken ids
+SELECT setval(pg_get_serial_sequence('airport', 'id'), (SELECT max(id) FROM airport));
@@ -0,0 +1,21 @@
+from db import PreparedStatement
+
+FLIGHT_COLUMNS = ('         flight.id, '
+                  '         flight.flight_number, '
+                  '         flight.datetime, '
+                  '         flight.from_airport_id, '
+                  '         flight.to_airport_id, '
+                  '         flight.price ')
+
+FLIGHT_FROM = 'FROM flight '
+
+FLIGHT_BY_NUMBER = PreparedStatement('flight_by_number', ('varchar',),
+                                     'SELECT ' + FLIGHT_COLUMNS + FLIGHT_FROM +
+                                     'WHERE flight.flight_number=$1 '
+                                     'ORDER BY flight.datetime DESC '
+                                     'LIMIT 1')
+
+FLIGHTS_BY_NUMBERS = PreparedStatement('flights_by_numbers', ('varchar[]',),
+                                       'SELECT DISTINCT ON (flight.flight_number) ' + FLIGHT_COLUMNS + FLIGHT_FROM +
+                                       'WHERE flight.flight_number = ANY($1) '
+                                       'ORDER BY flight.flight_number, flight.datetime DESC')
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import datetime
 from dataclasses import dataclass
-from typing import Any, Generic, TypeVar, List, Annotated
+from typing import Any, Generic, TypeVar, List, Annotated, Optional
 
 from pydantic import BaseModel
 
@@ -31,3 +31,4 @@ class PagedResponse(BaseModel, Generic[T]):
     pageSize: int
     totalElements: int
     items: List[T]
+    nextCursor: Optional[str] = None
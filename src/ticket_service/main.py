@@ -1,3 +1,5 @@
+import base64
+import binascii
 import os
 import uuid
 from typing import List, Optional, Annotated
@@ -6,11 +8,19 @@ from uuid import UUID
 import aiohttp as aiohttp
 import aiopg
 import fastapi
-from fastapi import FastAPI, Header, APIRouter
+from fastapi import FastAPI, Header, APIRouter, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from schema import Ticket, PagedResponse, TicketCreationSchema, TicketCreationResponse, TicketStatus
+import db
+import metrics
+import migrate
+import queries
+from schema import Ticket, PagedResponse, TicketCreationSchema, TicketCreationResponse, TicketStatus, \
+    TicketBatchCreationSchema, TicketRevokeBatchSchema, TicketRevokeBatchResponse
 
-app = FastAPI(root_path='/api/v1', )
+app = FastAPI(root_path='/api/v1', default_response_class=ORJSONResponse)
+metrics.init('ticket_service')
+app.middleware('http')(metrics.metrics_middleware)
 
 pool: aiopg.Pool
 
@@ -22,6 +32,11 @@ async def healthcheck():
     return fastapi.responses.Response()
 
 
+@manage_router.get('/metrics')
+async def prometheus_metrics():
+    return metrics.metrics_response()
+
+
 app.include_router(manage_router)
 
 
@@ -31,19 +46,49 @@ async def query_flight(flight_number: str) -> dict:
             return await resp.json()
 
 
+@app.post('/tickets/batch')
+async def post_tickets_batch(body: TicketBatchCreationSchema,
+                             x_user_name: Annotated[str, Header()]) -> List[TicketCreationResponse]:
+    if not body.items:
+        return []
+    ret = []
+    args = []
+    for item in body.items:
+        ticket_uid = uuid.uuid4()
+        ret.append(TicketCreationResponse(ticketUid=ticket_uid,
+                                          flightNumber=item.flightNumber,
+                                          status=TicketStatus.PAID,
+                                          price=item.price))
+        args += [ticket_uid, x_user_name, item.flightNumber, item.price, 'PAID']
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('INSERT INTO ticket '
+                              '     (ticket_uid, username, flight_number, price, status) '
+                              'VALUES ' + ', '.join(['(%s, %s, %s, %s, %s)'] * len(body.items)) + ';',
+                              args)
+    return ret
+
+
+@app.delete('/tickets/batch')
+async def revoke_tickets_batch(body: TicketRevokeBatchSchema,
+                               x_user_name: Annotated[str, Header()]) -> TicketRevokeBatchResponse:
+    if not body.ticketUids:
+        return TicketRevokeBatchResponse(revoked=[])
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('UPDATE ticket '
+                              'SET status=%s '
+                              'WHERE ticket_uid = ANY(%s) AND username=%s '
+                              'RETURNING ticket_uid;', ('CANCELED', body.ticketUids, x_user_name))
+            rows = await cur.fetchall()
+    return TicketRevokeBatchResponse(revoked=[ticket_uid for ticket_uid, in rows])
+
+
 @app.get('/tickets/{ticketUid}')
 async def get_ticket_by_uid(ticketUid: UUID) -> Ticket:
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, '
-                              '         ticket_uid, '
-                              '         username, '
-                              '         flight_number, '
-                              '         price, '
-                              '         status '
-                              'FROM ticket '
-                              'WHERE ticket_uid=%s '
-                              'ORDER BY ticket.id ASC;', (ticketUid,))
+            await db.execute(cur, queries.TICKET_BY_UID, (ticketUid,))
             ticket_id, ticket_uid, username, flight_number, price, status = await cur.fetchone()
     return Ticket(ticket_id=ticket_id,
                   ticket_uid=ticket_uid,
@@ -63,27 +108,60 @@ async def revoke_ticket_by_uid(ticketUid: UUID):
     return {}
 
 
-@app.get('/tickets')
-async def get_tickets(x_user_name: Annotated[str, Header()]) -> List[Ticket]:
-    ret = []
+NDJSON = 'application/x-ndjson'
+
+stream_batch_size = int(os.environ.get('TICKET_STREAM_BATCH_SIZE', 500))
+max_page_size = int(os.environ.get('TICKET_MAX_PAGE_SIZE', 1000))
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
 
-    flight_raws = []
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode()).decode())
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise fastapi.exceptions.HTTPException(400, 'Invalid cursor')
+
+
+async def fetch_tickets(username: str, after_id: int, limit: Optional[int]) -> list[Ticket]:
+    ret = []
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('SELECT   id, '
-                              '         ticket_uid, '
-                              '         username, '
-                              '         flight_number, '
-                              '         price, '
-                              '         status '
-                              'FROM ticket '
-                              'WHERE username=%s '
-                              'ORDER BY ticket.id ASC;', (x_user_name,))
+            await db.execute(cur, queries.TICKETS_BY_USERNAME, (username, after_id, limit))
             async for ticket_id, ticket_uid, username, flight_number, price, status in cur:
                 ret.append(
                     Ticket(ticket_id=ticket_id, ticket_uid=ticket_uid, username=username, flight_number=flight_number,
                            price=price, status=status, ))
+    return ret
 
+
+async def stream_tickets(username: str, after_id: int):
+    # one short query per batch, so a slow reader never pins a pool connection
+    while True:
+        batch = await fetch_tickets(username, after_id, stream_batch_size)
+        if batch:
+            yield ''.join(t.model_dump_json() + '\n' for t in batch)
+        if len(batch) < stream_batch_size:
+            return
+        after_id = batch[-1].ticket_id
+
+
+@app.get('/tickets', response_model=List[Ticket])
+async def get_tickets(x_user_name: Annotated[str, Header()],
+                      response: fastapi.Response,
+                      accept: Annotated[Optional[str], Header()] = None,
+                      size: Annotated[Optional[int], Query(ge=1, le=max_page_size)] = None,
+                      after: Optional[str] = None):
+    after_id = decode_cursor(after) if after is not None else 0
+    if accept is not None and NDJSON in accept:
+        return StreamingResponse(stream_tickets(x_user_name, after_id), media_type=NDJSON)
+
+    ret = await fetch_tickets(x_user_name, after_id, size + 1 if size is not None else None)
+    if size is not None and len(ret) > size:
+        ret = ret[:size]
+        response.headers['X-Next-Cursor'] = encode_cursor(ret[-1].ticket_id)
     return ret
 
 
@@ -112,19 +190,7 @@ async def startup_event():
     host = os.environ.get('DB_HOST', '0.0.0.0')
     password = os.environ.get('DB_PASSWORD', '0.0.0.0')
     dsn = f'dbname={dbname} user={user} password={password} host={host}'
-    pool = await aiopg.create_pool(dsn)
+    pool = await db.create_pool(dsn)
+    metrics.instrument_pool(pool)
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('''
-            CREATE TABLE IF NOT EXISTS ticket
-(
-    id            SERIAL PRIMARY KEY,
-    ticket_uid    uuid UNIQUE NOT NULL,
-    username      VARCHAR(80) NOT NULL,
-    flight_number VARCHAR(20) NOT NULL,
-    price         INT         NOT NULL,
-    status        VARCHAR(20) NOT NULL
-        CHECK (status IN ('PAID', 'CANCELED'))
-);
-            ''')
+    await migrate.migrate(pool)
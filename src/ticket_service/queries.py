@@ -0,0 +1,20 @@
+from db import PreparedStatement
+
+TICKET_COLUMNS = ('id, '
+                  'ticket_uid, '
+                  'username, '
+                  'flight_number, '
+                  'price, '
+                  'status ')
+
+TICKET_BY_UID = PreparedStatement('ticket_by_uid', ('uuid',),
+                                  'SELECT ' + TICKET_COLUMNS +
+                                  'FROM ticket '
+                                  'WHERE ticket_uid=$1')
+
+TICKETS_BY_USERNAME = PreparedStatement('tickets_by_username', ('varchar', 'int', 'bigint'),
+                                        'SELECT ' + TICKET_COLUMNS +
+                                        'FROM ticket '
+                                        'WHERE username=$1 AND id > $2 '
+                                        'ORDER BY ticket.id ASC '
+                                        'LIMIT $3')
@@ -39,6 +39,18 @@ class TicketCreationResponse(BaseModel):
     status: TicketStatus
 
 
+class TicketBatchCreationSchema(BaseModel):
+    items: List[TicketCreationSchema]
+
+
+class TicketRevokeBatchSchema(BaseModel):
+    ticketUids: List[UUID]
+
+
+class TicketRevokeBatchResponse(BaseModel):
+    revoked: List[UUID]
+
+
 T = TypeVar('T')
 
 